@@ -46,10 +46,27 @@ def create_app():
     # ✅ Crear índices una sola vez al arrancar la app
     with app.app_context():
         mongo.db.messages.create_index("timestamp")
+        mongo.db.notification_outbox.create_index([("status", 1), ("created_at", 1)])
+        # Búsqueda de la entrada pendiente/última enviada por (destino, tema)
+        mongo.db.notification_outbox.create_index(
+            [("target", 1), ("user", 1), ("topic", 1), ("status", 1)]
+        )
+        # Las notificaciones entregadas se purgan solas a los 7 días
+        mongo.db.notification_outbox.create_index(
+            "sent_at", expireAfterSeconds=7 * 24 * 3600
+        )
+        # Productos del catálogo local por subcategoría (refresco incremental)
+        mongo.db.mercadona_products.create_index("subcategory_id")
+        # Histórico de precios: filas de un producto ordenadas por día
+        mongo.db.mercadona_price_history.create_index([("product_id", 1), ("day", 1)])
 
     # Importar blueprints después de inicializar mongo
     from app.api import api
     from app.auth import auth
+    from app.avatars import avatar_cache, avatar_url, backfill_image_hashes
+    from app.mercadona import (configure_backend, create_backend,
+                               product_catalog)
+    from app.notifications import outbox_worker
     from app.routes import main
     from app.socket_utils import register_chat_events
 
@@ -60,10 +77,40 @@ def create_app():
     # Registrar eventos de chat
     register_chat_events()
 
+    # Miniaturas de avatares en <instance>/avatars y hash de contenido
+    # (URL cacheable) para los usuarios creados antes de tenerlo
+    avatar_cache.init_app(app)
+    with app.app_context():
+        backfill_image_hashes()
+
+    # Worker de entrega de notificaciones push (outbox)
+    if os.getenv("NOTIFICATION_WORKER", "1") == "1":
+        outbox_worker.start(app)
+
+    # Caché de Mercadona compartida entre workers: SQLite en <instance> salvo
+    # que MERCADONA_CACHE_URL indique otro backend (memory://, redis://...)
+    os.makedirs(app.instance_path, exist_ok=True)
+    cache_url = os.getenv(
+        "MERCADONA_CACHE_URL",
+        f"sqlite:///{os.path.join(app.instance_path, 'mercadona_cache.sqlite3')}",
+    )
+    try:
+        configure_backend(create_backend(cache_url))
+    except Exception as e:
+        app.logger.warning(f"⚠️ Caché de Mercadona solo en memoria: {e}")
+
+    # Copia local del catálogo de Mercadona para las búsquedas
+    if os.getenv("CATALOG_SYNC", "1") == "1":
+        product_catalog.start(app)
+
     @app.context_processor
     def inject_vapid_key():
         return dict(vapid_public_key=VAPID_PUBLIC_KEY)
 
+    @app.context_processor
+    def inject_avatar_url():
+        return dict(avatar_url=avatar_url)
+
     @app.before_request
     def aplicar_tema_por_defecto():
         if "theme" not in session:
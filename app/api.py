@@ -8,12 +8,18 @@ from datetime import datetime, timedelta
 from functools import wraps
 from urllib.parse import urlparse
 
-import requests
 from bson import ObjectId
 from flask import Blueprint, current_app, flash, jsonify, request, session
-from pywebpush import WebPushException, webpush
 
 from app import mongo
+from app.avatars import avatar_cache, avatar_url, image_version
+from app.data import count_tasks, find_user, find_user_by_id, find_users
+from app.http_client import http_client
+from app.notifications import (device_rate_limiter, find_invalid_subscriptions,
+                               push_metrics, queue_push_to_all,
+                               queue_push_to_user,
+                               remove_invalid_subscriptions,
+                               subscription_cache)
 from app.socket_utils import notificar_tarea_a_usuario
 
 # Configure logging
@@ -39,24 +45,6 @@ def login_required(f):
     return decorated_function
 
 
-# ==========================================
-# Utilidad para obtener claims VAPID
-# ==========================================
-def get_vapid_claims(endpoint_url):
-    """
-    Genera el diccionario de claims VAPID para webpush.
-    """
-    try:
-        parsed = urlparse(endpoint_url)
-        return {
-            "aud": f"{parsed.scheme}://{parsed.netloc}",
-            "sub": "mailto:joso.jmf@gmail.com",
-        }
-    except Exception as e:
-        logger.error(f"Error get_vapid_claims: {e}")
-        return None
-
-
 # ==========================================
 # Definición del Blueprint API
 # ==========================================
@@ -73,9 +61,10 @@ def get_users():
     Devuelve todos los usuarios de la base de datos.
     """
     try:
-        users = list(mongo.db.users.find())
+        users = find_users("user_with_tasks")
         for user in users:
             user["_id"] = str(user["_id"])
+            user["avatar"] = avatar_url(user)
         return jsonify(users)
     except Exception as e:
         logger.error(f"Error get_users: {e}")
@@ -101,7 +90,7 @@ def toggle_encasa():
     except Exception:
         return jsonify({"error": "ID no válido"}), 400
 
-    user = mongo.db.users.find_one({"_id": obj_id})
+    user = find_user({"_id": obj_id})
     if not user:
         return jsonify({"error": "Usuario no encontrado"}), 404
 
@@ -116,7 +105,7 @@ def toggle_encasa():
     hora = (datetime.now() + timedelta(hours=2)).strftime("%H:%M")
     mensaje = f"{user['nombre']} {'ha llegado a casa 🏠' if new_status else 'ha salido de casa 🚶‍♂️'} a las {hora}"
 
-    send_push_to_all(title="House App", body=mensaje, url="/usuarios")
+    queue_push_to_all(title="House App", body=mensaje, url="/usuarios")
 
     return jsonify({"success": True, "new_status": new_status})
 
@@ -146,7 +135,7 @@ def add_task():
     except ValueError:
         return jsonify({"error": "Formato de fecha inválido"}), 400
 
-    user = mongo.db.users.find_one({"nombre": asignee})
+    user = find_user({"nombre": asignee}, "user_names")
     if not user:
         return jsonify({"error": "Usuario no encontrado"}), 404
 
@@ -164,7 +153,7 @@ def add_task():
     mongo.db.users.update_one({"_id": user["_id"]}, {"$push": {"tareas": nueva_tarea}})
 
     # Enviar notificación solo al usuario asignado
-    send_push_to_user(
+    queue_push_to_user(
         user_name=asignee,
         title="Nueva tarea asignada 📋",
         body=f"Se te ha asignado: {titulo}",
@@ -192,7 +181,7 @@ def completar_tarea():
 
     try:
         # Registrar tarea completada antes de eliminar
-        user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
+        user = find_user_by_id(user_id, "user_names")
         if user:
             completed_task = {
                 "titulo": tarea["titulo"],
@@ -245,6 +234,7 @@ def save_subscription():
             mongo.db.subscriptions.update_one(
                 {"user": user}, {"$push": {"subscriptions": subscription}}
             )
+            subscription_cache.invalidate()
     else:
         mongo.db.subscriptions.insert_one(
             {
@@ -253,6 +243,7 @@ def save_subscription():
                 "created_at": datetime.now(),
             }
         )
+        subscription_cache.invalidate()
 
     return jsonify({"message": "Suscripción guardada correctamente"})
 
@@ -306,10 +297,11 @@ def agregar_item():
         result = mongo.db.lista_compra.insert_one(new_item)
 
         # Notificar a todos los usuarios
-        send_push_to_all(
+        queue_push_to_all(
             title="Lista de compra actualizada 🛒",
             body=f"{session.get('user')} añadió: {nombre}",
             url="/lista_compra",
+            topic="shopping",
         )
 
         return jsonify({"success": True, "id": str(result.inserted_id)})
@@ -366,10 +358,11 @@ def eliminar_item(item_id):
         mongo.db.lista_compra.delete_one({"_id": ObjectId(item_id)})
 
         # Notificar eliminación
-        send_push_to_all(
+        queue_push_to_all(
             title="Producto eliminado de la lista 🗑️",
             body=f"{session.get('user')} eliminó: {item['nombre']}",
             url="/lista_compra",
+            topic="shopping",
         )
 
         return jsonify({"success": True})
@@ -386,7 +379,7 @@ def eliminar_toda_lista():
         result = mongo.db.lista_compra.delete_many({})
 
         # Notificar limpieza completa
-        send_push_to_all(
+        queue_push_to_all(
             title="Lista de compra vaciada 🧹",
             body=f"{session.get('user')} vació completamente la lista",
             url="/lista_compra",
@@ -434,23 +427,13 @@ def marcar_comprado(item_id):
 def get_user_profile(nombre):
     """Obtener perfil de usuario con avatar"""
     try:
-        user = mongo.db.users.find_one({"nombre": nombre})
+        user = find_user({"nombre": nombre})
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
 
-        imagen_data = user.get("imagen")
-        if not imagen_data:
-            return jsonify(
-                {
-                    "avatar": "/static/images/default-avatar.png",
-                    "nombre": user.get("nombre"),
-                    "encasa": user.get("encasa", False),
-                }
-            )
-
         return jsonify(
             {
-                "avatar": f"data:image/jpeg;base64,{imagen_data}",
+                "avatar": avatar_cache.get_url(user.get("nombre")),
                 "nombre": user.get("nombre"),
                 "encasa": user.get("encasa", False),
                 "last_status_change": user.get("last_status_change"),
@@ -511,7 +494,7 @@ def get_comprehensive_family_data():
     """Obtener todos los datos familiares de la base de datos"""
     try:
         # 1. Usuarios y su estado
-        users = list(mongo.db.users.find())
+        users = find_users("user_with_tasks")
         users_info = []
         total_tasks = 0
 
@@ -825,7 +808,7 @@ Responde de manera práctica, específica y útil usando esta información."""
             "stream": False,
         }
 
-        resp = requests.post(
+        resp = http_client.post(
             "https://api.groq.com/openai/v1/chat/completions",
             json=payload,
             headers=headers,
@@ -896,9 +879,7 @@ def ai_status():
             try:
                 db_stats = {
                     "total_users": mongo.db.users.count_documents({}),
-                    "active_tasks": sum(
-                        len(user.get("tareas", [])) for user in mongo.db.users.find()
-                    ),
+                    "active_tasks": count_tasks(),
                     "shopping_items": mongo.db.lista_compra.count_documents({}),
                     "last_data_update": datetime.now().strftime("%H:%M"),
                 }
@@ -1030,9 +1011,7 @@ def get_stats():
         stats = {
             "total_users": mongo.db.users.count_documents({}),
             "users_at_home": mongo.db.users.count_documents({"encasa": True}),
-            "total_tasks": sum(
-                len(user.get("tareas", [])) for user in mongo.db.users.find()
-            ),
+            "total_tasks": count_tasks(),
             "shopping_items": mongo.db.lista_compra.count_documents({}),
             "completed_tasks_today": mongo.db.completed_tasks.count_documents(
                 {
@@ -1062,29 +1041,8 @@ def cleanup_subscriptions():
         if session.get("user") != "Joso":  # Ajusta según tu sistema de permisos
             return jsonify({"error": "Permisos insuficientes"}), 403
 
-        removed_count = 0
-        subscripciones = mongo.db.subscriptions.find()
-
-        for sub_doc in subscripciones:
-            user_name = sub_doc.get("user")
-            valid_subs = []
-
-            for sub in sub_doc.get("subscriptions", []):
-                # Probar si la suscripción sigue siendo válida
-                try:
-                    endpoint = sub.get("endpoint")
-                    if endpoint and get_vapid_claims(endpoint):
-                        valid_subs.append(sub)
-                    else:
-                        removed_count += 1
-                except:
-                    removed_count += 1
-
-            # Actualizar con solo las suscripciones válidas
-            if len(valid_subs) != len(sub_doc.get("subscriptions", [])):
-                mongo.db.subscriptions.update_one(
-                    {"user": user_name}, {"$set": {"subscriptions": valid_subs}}
-                )
+        # Suscripciones sin endpoint válido: se eliminan en un único bulk_write
+        removed_count = remove_invalid_subscriptions(find_invalid_subscriptions())
 
         return jsonify({"success": True, "removed_count": removed_count})
     except Exception as e:
@@ -1093,110 +1051,20 @@ def cleanup_subscriptions():
 
 
 # ===================================================
-# Funciones de notificaciones mejoradas
+# Endpoint: Métricas de notificaciones push
 # ===================================================
-def send_push_to_user(
-    user_name, title, body, url="/", icon="/static/icons/house-icon.png"
-):
-    """Enviar notificación push a un usuario específico - MEJORADO"""
-    try:
-        vapid_private_key = current_app.config.get("VAPID_PRIVATE_KEY")
-        if not vapid_private_key:
-            logger.error("VAPID_PRIVATE_KEY no configurada")
-            return False
-
-        subscription_doc = mongo.db.subscriptions.find_one({"user": user_name})
-        if not subscription_doc:
-            logger.warning(f"No hay suscripciones para {user_name}")
-            return False
-
-        success_count = 0
-        for sub in subscription_doc.get("subscriptions", []):
-            try:
-                endpoint = sub.get("endpoint")
-                if not endpoint:
-                    continue
-
-                claims = get_vapid_claims(endpoint)
-                if not claims:
-                    continue
-
-                webpush(
-                    subscription_info=sub,
-                    data=json.dumps(
-                        {"title": title, "body": body, "icon": icon, "url": url}
-                    ),
-                    vapid_private_key=vapid_private_key,
-                    vapid_claims=claims,
-                )
-                success_count += 1
-                logger.info(f"✅ Notificación enviada a {user_name}")
-
-            except WebPushException as ex:
-                logger.error(f"❌ Error al enviar push a {user_name}: {repr(ex)}")
-                # Limpiar suscripciones inválidas
-                if ex.response and ex.response.status_code in [410, 404]:
-                    mongo.db.subscriptions.update_one(
-                        {"user": user_name}, {"$pull": {"subscriptions": sub}}
-                    )
-            except Exception as e:
-                logger.error(f"❌ Error inesperado enviando push: {e}")
-
-        return success_count > 0
-
-    except Exception as e:
-        logger.error(f"❌ Error en send_push_to_user: {e}")
-        return False
-
-
-def send_push_to_all(title, body, url="/", icon="/static/icons/house-icon.png"):
-    """Enviar notificación push a todos los usuarios suscritos - MEJORADO"""
-    try:
-        vapid_private_key = current_app.config.get("VAPID_PRIVATE_KEY")
-        if not vapid_private_key:
-            logger.error("VAPID_PRIVATE_KEY no configurada")
-            return
-
-        subscripciones = mongo.db.subscriptions.find()
-        total_sent = 0
-
-        for sub_doc in subscripciones:
-            user_name = sub_doc.get("user", "Unknown")
-            for sub in sub_doc.get("subscriptions", []):
-                try:
-                    endpoint = sub.get("endpoint")
-                    if not endpoint:
-                        continue
-
-                    claims = get_vapid_claims(endpoint)
-                    if not claims:
-                        continue
-
-                    webpush(
-                        subscription_info=sub,
-                        data=json.dumps(
-                            {"title": title, "body": body, "icon": icon, "url": url}
-                        ),
-                        vapid_private_key=vapid_private_key,
-                        vapid_claims=claims,
-                    )
-                    total_sent += 1
-                    logger.info(f"✅ Notificación enviada a {user_name}")
-
-                except WebPushException as ex:
-                    logger.error(f"❌ Error al enviar push a {user_name}: {repr(ex)}")
-                    # Limpiar suscripciones inválidas
-                    if ex.response and ex.response.status_code in [410, 404]:
-                        mongo.db.subscriptions.update_one(
-                            {"user": user_name}, {"$pull": {"subscriptions": sub}}
-                        )
-                except Exception as e:
-                    logger.error(f"❌ Error inesperado al enviar push: {e}")
-
-        logger.info(f"📊 Total notificaciones enviadas: {total_sent}")
-
-    except Exception as e:
-        logger.error(f"❌ Error en send_push_to_all: {e}")
+@api.route("/api/notifications/metrics", methods=["GET"])
+@login_required
+def notifications_metrics():
+    """Contadores y latencia por endpoint de los envíos push"""
+    return jsonify(
+        {
+            "success": True,
+            "push": push_metrics.get_stats(),
+            "subscriptions": subscription_cache.get_stats(),
+            "rate_limiter": device_rate_limiter.get_stats(),
+        }
+    )
 
 
 @api.route("/api/clear_all_tasks", methods=["POST"])
@@ -1283,10 +1151,11 @@ def add_mercadona_to_list():
 
         # Notificar
         action_text = "actualizó cantidad de" if action == "updated" else "añadió"
-        send_push_to_all(
+        queue_push_to_all(
             title="🛒 Producto desde Mercadona",
             body=f"{session.get('user')} {action_text}: {formatted_name}",
             url="/lista_compra",
+            topic="shopping",
         )
 
         return jsonify(
@@ -1367,12 +1236,16 @@ def change_user_image(user_id):
 
         # Verificar que el usuario existe
         obj_id = ObjectId(user_id)
-        user = mongo.db.users.find_one({"_id": obj_id})
+        user = find_user({"_id": obj_id}, "user_names")
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
 
         # Actualizar imagen
-        mongo.db.users.update_one({"_id": obj_id}, {"$set": {"imagen": imagen}})
+        mongo.db.users.update_one(
+            {"_id": obj_id},
+            {"$set": {"imagen": imagen, "imagen_hash": image_version(imagen)}},
+        )
+        avatar_cache.invalidate(user_id)
 
         return jsonify({"success": True, "message": "Imagen actualizada correctamente"})
 
@@ -1643,8 +1516,8 @@ def add_user():
             return jsonify({"error": "El nombre es obligatorio"}), 400
 
         # Verificar si ya existe
-        if mongo.db.users.find_one(
-            {"nombre": {"$regex": f"^{nombre}$", "$options": "i"}}
+        if find_user(
+            {"nombre": {"$regex": f"^{nombre}$", "$options": "i"}}, "user_names"
         ):
             return jsonify({"error": "Ya existe un usuario con ese nombre"}), 409
 
@@ -1660,6 +1533,7 @@ def add_user():
             "nombre": nombre,
             "encasa": True,
             "imagen": imagen,
+            "imagen_hash": image_version(imagen) if imagen else None,
             "tareas": [],
             "calendario": [],
             "created_by": session.get("user"),
@@ -1667,6 +1541,7 @@ def add_user():
         }
 
         result = mongo.db.users.insert_one(new_user)
+        avatar_cache.invalidate(result.inserted_id)
 
         return jsonify({"success": True, "user_id": str(result.inserted_id)}), 201
     except Exception as e:
@@ -1685,7 +1560,7 @@ def delete_user(user_id):
         )
         obj_id = ObjectId(user_id)
         # Obtener información del usuario antes de eliminar
-        user = mongo.db.users.find_one({"_id": obj_id})
+        user = find_user({"_id": obj_id}, "user_names")
         if not user:
             logger.warning(f"Usuario no encontrado: {user_id}")
             return (
@@ -1703,10 +1578,12 @@ def delete_user(user_id):
 
         # Eliminar usuario
         mongo.db.users.delete_one({"_id": obj_id})
+        avatar_cache.invalidate(user_id)
 
         # Limpiar datos relacionados
         nombre_usuario = user.get("nombre")
         result_subs = mongo.db.subscriptions.delete_many({"user": nombre_usuario})
+        subscription_cache.invalidate()
         result_tasks = mongo.db.completed_tasks.delete_many(
             {"completed_by": nombre_usuario}
         )
@@ -1,15 +1,15 @@
 from flask import (Blueprint, redirect, render_template, request, session,
                    url_for)
 
-from app import mongo
-from app.globals import user_sockets
+from app.data import find_users
+from app.notifications.presence import unregister_user
 
 auth = Blueprint("auth", __name__)
 
 
 @auth.route("/login")
 def login():
-    users = list(mongo.db.users.find())
+    users = find_users("user_summary")
     return render_template("login.html", users=users)
 
 
@@ -28,8 +28,7 @@ def logout():
     username = session.get("user")  # estaba mal: era 'user', no 'username'
     session.clear()
 
-    if username in user_sockets:
-        del user_sockets[username]
+    if unregister_user(username):
         print(f"[LOGOUT] {username} eliminado de sockets")
 
     return redirect(url_for("auth.login"))
@@ -0,0 +1,325 @@
+import base64
+import binascii
+import glob
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from bson import ObjectId
+
+from app import mongo
+
+try:
+    from PIL import Image
+except ImportError:  # Sin Pillow se sirve siempre la imagen original
+    Image = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_AVATAR_URL = "/static/images/default.jpg"
+
+# Tamaños de miniatura permitidos (lado en píxeles)
+AVATAR_SIZES = (48, 96, 192)
+
+MIMETYPE_EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp"}
+
+
+def decode_image(imagen_data):
+    """
+    Decodificar la imagen guardada en users.imagen (data URI o base64 plano).
+    Devuelve (bytes, mimetype) o (None, None) si no es válida.
+    """
+    if not imagen_data:
+        return None, None
+
+    mimetype = "image/jpeg"
+    imagen_data = str(imagen_data)
+    if imagen_data.startswith("data:"):
+        header, _, imagen_data = imagen_data.partition(",")
+        mimetype = header[5:].split(";")[0] or mimetype
+
+    try:
+        return base64.b64decode(imagen_data), mimetype
+    except (binascii.Error, ValueError):
+        return None, None
+
+
+def image_version(imagen_data):
+    """Hash corto del contenido: cambia la URL cuando cambia la imagen"""
+    return hashlib.md5(str(imagen_data).encode("utf-8")).hexdigest()[:12]
+
+
+def resize_image(data, mimetype, size):
+    """Miniatura cuadrada de `size` px. Sin Pillow devuelve la original"""
+    if Image is None or not size:
+        return data, mimetype
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Recorte centrado al cuadrado y reducción
+            side = min(image.size)
+            left = (image.width - side) // 2
+            top = (image.height - side) // 2
+            thumb = image.crop((left, top, left + side, top + side))
+            thumb.thumbnail((size, size))
+
+            output = io.BytesIO()
+            if thumb.mode in ("RGBA", "LA", "P"):
+                thumb.save(output, format="PNG", optimize=True)
+                return output.getvalue(), "image/png"
+            thumb.convert("RGB").save(output, format="JPEG", quality=85)
+            return output.getvalue(), "image/jpeg"
+    except Exception as e:
+        logger.error(f"Error redimensionando avatar: {e}")
+        return data, mimetype
+
+
+def avatar_url(user, size=None):
+    """
+    URL del avatar de un documento de usuario (con `imagen_hash`).
+    El hash va en la URL, así que el navegador puede cachearla indefinidamente.
+    """
+    if not user or not user.get("imagen_hash"):
+        return DEFAULT_AVATAR_URL
+    url = f"/avatars/{user['_id']}?v={user['imagen_hash']}"
+    if size:
+        url += f"&s={size}"
+    return url
+
+
+def backfill_image_hashes():
+    """Calcular imagen_hash de los usuarios que aún no lo tienen"""
+    updated = 0
+    for user in mongo.db.users.find(
+        {"imagen": {"$nin": [None, ""]}, "imagen_hash": {"$exists": False}},
+        {"imagen": 1},
+    ):
+        mongo.db.users.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"imagen_hash": image_version(user["imagen"])}},
+        )
+        updated += 1
+    if updated:
+        logger.info(f"🖼️ imagen_hash calculado para {updated} usuarios")
+    return updated
+
+
+class AvatarCache:
+    """
+    Caché de avatares de usuario:
+    - nombre -> URL del avatar (/avatars/<user_id>?v=<hash>), para el chat
+    - user_id -> versión (hash) de la imagen
+    - (user_id, versión, tamaño) -> imagen, en memoria y en disco,
+      para servir /avatars sin decodificar el base64 de Mongo en cada petición
+    Las tres en memoria son LRU acotadas: los nombres llegan del cliente.
+    Se invalida desde change_user_image / delete_user.
+    """
+
+    def __init__(self, max_images=100, max_users=200):
+        self.max_images = max_images
+        self.max_users = max_users
+        self.urls = OrderedDict()
+        self.versions = OrderedDict()
+        self.images = OrderedDict()
+        self.directory = None
+        self.lock = threading.RLock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def init_app(self, app):
+        """Usar <instance>/avatars como almacén de miniaturas en disco"""
+        directory = os.path.join(app.instance_path, "avatars")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self.directory = directory
+        except OSError as e:
+            logger.warning(f"⚠️ Sin caché de avatares en disco: {e}")
+
+    def get_url(self, nombre):
+        """URL del avatar de un usuario por nombre (o el avatar por defecto)"""
+        if not nombre:
+            return DEFAULT_AVATAR_URL
+
+        with self.lock:
+            if nombre in self.urls:
+                self.urls.move_to_end(nombre)
+                self.stats["hits"] += 1
+                return self.urls[nombre]["url"]
+            self.stats["misses"] += 1
+
+        try:
+            user = mongo.db.users.find_one({"nombre": nombre}, {"imagen_hash": 1})
+        except Exception as e:
+            logger.error(f"Error obteniendo avatar de {nombre}: {e}")
+            return DEFAULT_AVATAR_URL
+
+        user_id = str(user["_id"]) if user else None
+        # Miniatura: en el chat el avatar se muestra pequeño
+        url = avatar_url(user, 96)
+        with self.lock:
+            self._remember(self.urls, nombre, {"user_id": user_id, "url": url})
+        return url
+
+    def get_version(self, user_id):
+        """Hash actual de la imagen de un usuario (None si no tiene)"""
+        with self.lock:
+            if user_id in self.versions:
+                self.versions.move_to_end(user_id)
+                return self.versions[user_id]
+
+        try:
+            user = mongo.db.users.find_one(
+                {"_id": ObjectId(user_id)}, {"imagen_hash": 1}
+            )
+        except Exception as e:
+            logger.error(f"Error obteniendo versión de avatar {user_id}: {e}")
+            return None
+
+        version = user.get("imagen_hash") if user else None
+        with self.lock:
+            self._remember(self.versions, user_id, version)
+        return version
+
+    def _remember(self, entries, key, value):
+        """Guardar en una LRU de usuarios descartando las más antiguas"""
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_users:
+            entries.popitem(last=False)
+
+    def _disk_path(self, user_id, version, size, mimetype):
+        extension = MIMETYPE_EXTENSIONS.get(mimetype, "img")
+        return os.path.join(
+            self.directory, f"{user_id}-{version}-{size or 'orig'}.{extension}"
+        )
+
+    def _read_disk(self, user_id, version, size):
+        if not self.directory:
+            return None
+        pattern = os.path.join(
+            self.directory, f"{user_id}-{version}-{size or 'orig'}.*"
+        )
+        for path in glob.glob(pattern):
+            if path.endswith(".tmp"):
+                continue
+            extension = path.rsplit(".", 1)[-1]
+            mimetype = next(
+                (m for m, ext in MIMETYPE_EXTENSIONS.items() if ext == extension),
+                "application/octet-stream",
+            )
+            with open(path, "rb") as f:
+                return f.read(), mimetype
+        return None
+
+    def _write_disk(self, user_id, version, size, data, mimetype):
+        if not self.directory:
+            return
+        path = self._disk_path(user_id, version, size, mimetype)
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"⚠️ No se pudo guardar avatar en disco: {e}")
+
+    def _render(self, user_id, size):
+        """Decodificar (y redimensionar) la imagen guardada en Mongo"""
+        user = mongo.db.users.find_one(
+            {"_id": ObjectId(user_id)}, {"imagen": 1, "imagen_hash": 1}
+        )
+        if not user or not user.get("imagen"):
+            return None
+
+        data, mimetype = decode_image(user["imagen"])
+        if data is None:
+            return None
+        return resize_image(data, mimetype, size)
+
+    def get_image(self, user_id, size=None):
+        """
+        Imagen de un usuario por id: (bytes, mimetype, versión)
+        o None si el usuario no tiene imagen
+        """
+        version = self.get_version(user_id)
+        if not version:
+            return None
+
+        key = (user_id, version, size)
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.images[key]
+
+        cached = self._read_disk(user_id, version, size)
+        if cached:
+            self.stats["disk_hits"] += 1
+            data, mimetype = cached
+        else:
+            self.stats["misses"] += 1
+            try:
+                rendered = self._render(user_id, size)
+            except Exception as e:
+                logger.error(f"Error obteniendo imagen de {user_id}: {e}")
+                return None
+            if not rendered:
+                return None
+            data, mimetype = rendered
+            self._write_disk(user_id, version, size, data, mimetype)
+
+        entry = (data, mimetype, version)
+        with self.lock:
+            self.images[key] = entry
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return entry
+
+    def _remove_disk(self, user_id):
+        if not self.directory:
+            return
+        for path in glob.glob(os.path.join(self.directory, f"{user_id}-*")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def invalidate(self, user_id=None):
+        """Invalidar el avatar de un usuario (o toda la caché)"""
+        with self.lock:
+            if user_id is None:
+                self.urls.clear()
+                self.versions.clear()
+                self.images.clear()
+                return
+
+            user_id = str(user_id)
+            self.versions.pop(user_id, None)
+            self.images = OrderedDict(
+                (key, entry) for key, entry in self.images.items() if key[0] != user_id
+            )
+            # Las entradas "sin usuario" se descartan también: puede ser uno nuevo
+            self.urls = OrderedDict(
+                (nombre, entry)
+                for nombre, entry in self.urls.items()
+                if entry["user_id"] not in (user_id, None)
+            )
+        self._remove_disk(user_id)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "users": len(self.urls),
+                "images": len(self.images),
+                "bytes": sum(len(entry[0]) for entry in self.images.values()),
+                "disk": bool(self.directory),
+                "thumbnails": Image is not None,
+                **self.stats,
+            }
+
+
+# Instancia global de la caché de avatares
+avatar_cache = AvatarCache(max_images=100, max_users=200)
@@ -0,0 +1,2 @@
+from app.data.users import (USER_PROJECTIONS, count_tasks, find_user,
+                            find_user_by_id, find_users)
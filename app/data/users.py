@@ -0,0 +1,72 @@
+from bson import ObjectId
+
+from app import mongo
+
+# Proyecciones con nombre: cada pantalla pide solo los campos que usa.
+# Ninguna incluye `imagen` (los avatares se sirven desde /avatars).
+USER_PROJECTIONS = {
+    # Desplegables y validaciones: solo el nombre
+    "user_names": {"nombre": 1},
+    # Tarjetas, login, configuración: datos de presentación
+    "user_summary": {
+        "nombre": 1,
+        "encasa": 1,
+        "imagen_hash": 1,
+        "last_status_change": 1,
+    },
+    # Tareas, calendario y asistente: resumen + tareas
+    "user_with_tasks": {
+        "nombre": 1,
+        "encasa": 1,
+        "imagen_hash": 1,
+        "last_status_change": 1,
+        "tareas": 1,
+    },
+}
+
+
+def _projection(name):
+    try:
+        return USER_PROJECTIONS[name]
+    except KeyError:
+        raise ValueError(f"Proyección de usuario desconocida: {name}")
+
+
+def find_users(projection="user_summary", query=None, stringify_ids=False):
+    """Lista de usuarios con la proyección indicada"""
+    fields = _projection(projection)
+    users = list(mongo.db.users.find(query or {}, fields))
+    if stringify_ids:
+        for user in users:
+            user["_id"] = str(user["_id"])
+    return users
+
+
+def find_user(query, projection="user_summary"):
+    """Un usuario (o None) con la proyección indicada"""
+    fields = _projection(projection)
+    return mongo.db.users.find_one(query, fields)
+
+
+def find_user_by_id(user_id, projection="user_summary"):
+    """Un usuario por id (str u ObjectId) con la proyección indicada"""
+    if not isinstance(user_id, ObjectId):
+        user_id = ObjectId(user_id)
+    return find_user({"_id": user_id}, projection)
+
+
+def count_tasks():
+    """Número total de tareas activas, contado en Mongo sin traer los arrays"""
+    result = list(
+        mongo.db.users.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": None,
+                        "total": {"$sum": {"$size": {"$ifNull": ["$tareas", []]}}},
+                    }
+                }
+            ]
+        )
+    )
+    return result[0]["total"] if result else 0
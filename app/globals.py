@@ -1 +1,4 @@
+# usuario (minúsculas) -> conjunto de sids conectados (uno por pestaña)
 user_sockets = {}
+# sid -> {"user": usuario, "rooms": salas a las que se ha unido}
+socket_presence = {}
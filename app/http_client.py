@@ -0,0 +1,372 @@
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Límites (ms) de los tramos del histograma de latencias
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Respuestas transitorias que se reintentan
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Respuestas que cuentan como fallo del host para el circuit breaker (por
+# defecto las transitorias; configure_host permite añadir otras)
+FAILURE_STATUSES = RETRY_STATUSES
+
+# Métodos que se pueden repetir sin efectos secundarios
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """El circuito del host está abierto: la petición no se llega a hacer"""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"Circuito abierto para {host} (reintento en {retry_in:.0f}s)")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de un host: tras `failure_threshold` fallos seguidos se
+    abre y rechaza las peticiones durante `reset_seconds`. Después deja pasar
+    una única petición de prueba (semiabierto) y se cierra si sale bien.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def allow(self, now=None):
+        """¿Se puede hacer una petición ahora?"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and now - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("✅ Circuito cerrado de nuevo")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self.opened_at = now
+                self.stats["opened"] += 1
+
+    def is_open(self, now=None):
+        """Abierto y todavía sin permitir la petición de prueba"""
+        return self.retry_in(now) > 0
+
+    def retry_in(self, now=None):
+        """Segundos hasta la próxima petición de prueba (0 si no está abierto)"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.reset_seconds - (now - self.opened_at))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "reset_seconds": self.reset_seconds,
+                **self.stats,
+            }
+
+
+class LatencyHistogram:
+    """Histograma de latencias en tramos fijos (ms) con percentiles aproximados"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        # Un contador por tramo y uno más para lo que supera el último
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms):
+        self.counts[bisect_left(self.buckets, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, fraction):
+        """Límite superior del tramo que contiene el percentil"""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                break
+        if index < len(self.buckets):
+            return min(self.buckets[index], round(self.max_ms, 1))
+        return round(self.max_ms, 1)
+
+    def get_stats(self):
+        labels = [f"<={limit}" for limit in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "max_ms": round(self.max_ms, 1),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class HostStats:
+    """Circuit breaker, latencias y contadores de un host"""
+
+    def __init__(self, breaker, failure_statuses):
+        self.breaker = breaker
+        self.failure_statuses = failure_statuses
+        self.latency = LatencyHistogram()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "retries": 0, "statuses": {}}
+
+    def record(self, elapsed_seconds, status=None, error=False):
+        """Anotar un intento; devuelve True si cuenta como fallo del host"""
+        failed = error or status in self.failure_statuses
+        with self.lock:
+            self.stats["requests"] += 1
+            self.latency.observe(elapsed_seconds * 1000)
+            if error:
+                self.stats["errors"] += 1
+            else:
+                statuses = self.stats["statuses"]
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return failed
+
+    def count_retry(self):
+        with self.lock:
+            self.stats["retries"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                "statuses": dict(self.stats["statuses"]),
+                "latency": self.latency.get_stats(),
+                "circuit": self.breaker.get_stats(),
+            }
+
+
+class ClientSession:
+    """
+    Vista del cliente con cabeceras propias: se usa como un requests.Session
+    (get/post/request) pero todo pasa por el HttpClient compartido
+    """
+
+    def __init__(self, client, headers=None):
+        self.client = client
+        self.headers = dict(headers or {})
+
+    def request(self, method, url, **kwargs):
+        headers = dict(self.headers, **(kwargs.pop("headers", None) or {}))
+        return self.client.request(method, url, headers=headers, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class HttpClient:
+    """
+    Cliente HTTP saliente de toda la aplicación: una sesión con pool de
+    conexiones keep-alive por host, reintentos con backoff exponencial y
+    jitter, circuit breaker por host e histograma de latencias por host.
+    """
+
+    def __init__(
+        self,
+        pool_connections=10,
+        pool_maxsize=16,
+        retries=2,
+        backoff_seconds=0.3,
+        max_backoff_seconds=5,
+        timeout=10,
+        failure_threshold=5,
+        reset_seconds=30,
+    ):
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        # Los reintentos los hace el cliente: el adaptador no reintenta
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # host -> HostStats, y ajustes propios de algunos hosts
+        self.hosts = {}
+        self.host_settings = {}
+        self.lock = threading.Lock()
+
+    def configure_host(self, host, failure_statuses=None, **breaker_settings):
+        """
+        Ajustes de un host: respuestas que cuentan como fallo y parámetros
+        del circuit breaker (failure_threshold, reset_seconds)
+        """
+        with self.lock:
+            settings = self.host_settings.setdefault(host, {})
+            if failure_statuses is not None:
+                settings["failure_statuses"] = frozenset(failure_statuses)
+            settings.update(breaker_settings)
+            # Los ajustes se aplican al crear las estadísticas del host
+            self.hosts.pop(host, None)
+
+    def host(self, host):
+        """HostStats de un host (se crea la primera vez)"""
+        with self.lock:
+            stats = self.hosts.get(host)
+            if stats is None:
+                settings = self.host_settings.get(host, {})
+                breaker = CircuitBreaker(
+                    failure_threshold=settings.get(
+                        "failure_threshold", self.failure_threshold
+                    ),
+                    reset_seconds=settings.get("reset_seconds", self.reset_seconds),
+                )
+                stats = HostStats(
+                    breaker, settings.get("failure_statuses", FAILURE_STATUSES)
+                )
+                self.hosts[host] = stats
+            return stats
+
+    def breaker(self, host):
+        return self.host(host).breaker
+
+    def _backoff(self, attempt):
+        """Espera antes del reintento `attempt` (full jitter)"""
+        limit = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempt - 1))
+        return random.uniform(0, limit)
+
+    def request(self, method, url, retries=None, **kwargs):
+        """
+        Petición con reintentos (por defecto solo en métodos idempotentes) y
+        circuit breaker. Lanza CircuitOpenError sin conectar si el circuito
+        del host está abierto.
+        """
+        method = method.upper()
+        host = urlparse(url).netloc
+        stats = self.host(host)
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        kwargs.setdefault("timeout", self.timeout)
+
+        attempt = 0
+        while True:
+            if not stats.breaker.allow():
+                raise CircuitOpenError(host, stats.breaker.retry_in())
+
+            start_time = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                stats.record(time.monotonic() - start_time, error=True)
+                if attempt >= retries:
+                    raise
+            else:
+                stats.record(time.monotonic() - start_time, status=response.status_code)
+                if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                    return response
+                response.close()
+
+            attempt += 1
+            stats.count_retry()
+            time.sleep(self._backoff(attempt))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def session_with(self, headers=None):
+        """ClientSession con cabeceras fijas (p. ej. las de Mercadona)"""
+        return ClientSession(self, headers)
+
+    def call(self, host, fn):
+        """
+        Ejecutar fn() con el circuit breaker y las métricas de `host`, para
+        integraciones con su propio cliente HTTP (p. ej. DDGS)
+        """
+        stats = self.host(host)
+        if not stats.breaker.allow():
+            raise CircuitOpenError(host, stats.breaker.retry_in())
+        start_time = time.monotonic()
+        try:
+            result = fn()
+        except Exception:
+            stats.record(time.monotonic() - start_time, error=True)
+            raise
+        stats.record(time.monotonic() - start_time, status=200)
+        return result
+
+    def get_stats(self):
+        with self.lock:
+            hosts = dict(self.hosts)
+        return {
+            "retries": self.retries,
+            "timeout_seconds": self.timeout,
+            "hosts": {host: stats.get_stats() for host, stats in hosts.items()},
+        }
+
+
+# Instancia global: todas las llamadas salientes comparten conexiones y métricas
+http_client = HttpClient()
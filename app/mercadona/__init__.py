@@ -0,0 +1,21 @@
+from app.mercadona.backends import (MemoryBackend, RedisBackend, SQLiteBackend,
+                                    create_backend)
+from app.mercadona.cache import (MercadonaCache, SearchCache,
+                                 configure_backend, deep_sizeof,
+                                 mercadona_cache, search_cache)
+from app.mercadona.catalog import CatalogIndex, ProductCatalog, product_catalog
+from app.mercadona.fetcher import (FetchReport, SubcategoryFetcher,
+                                   catalog_fetcher, subcategory_fetcher)
+from app.mercadona.normalize import (NormalizedProduct, NormalizedQuery, fold,
+                                     normalize_product, parse_query,
+                                     product_matches, tokenize)
+from app.mercadona.prices import (PriceHistory, downsample, price_history,
+                                  price_point)
+from app.mercadona.ranking import Bm25, edit_distance, prefix_expansions
+from app.mercadona.singleflight import (SingleFlight, search_flight,
+                                        subcategory_flight)
+from app.mercadona.source import (MERCADONA_BASE_URL, MERCADONA_HEADERS,
+                                  MERCADONA_HOST, extract_products,
+                                  fetch_categories, mercadona_available,
+                                  mercadona_retry_in)
+from app.mercadona.suggest import SuggestIndex
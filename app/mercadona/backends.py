@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+try:
+    import redis
+except ImportError:  # Redis es opcional: solo hace falta con redis://
+    redis = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class MemoryBackend:
+    """
+    Almacén en memoria del proceso (LRU por número de entradas).
+    Cada worker tiene su propia copia y se pierde al reiniciar.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        # (espacio, clave) -> (valor, guardado_en, caduca_en)
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, namespace, key, now=None):
+        """(valor, guardado_en) o None si no existe o ya caducó"""
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is None:
+                return None
+            value, stored_at, expires_at = entry
+            if expires_at <= now:
+                del self.entries[(namespace, key)]
+                return None
+            self.entries.move_to_end((namespace, key))
+            return value, stored_at
+
+    def set(self, namespace, key, value, ttl_seconds, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+            self.entries[(namespace, key)] = (value, now, now + ttl_seconds)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, namespace, key):
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+
+    def clear(self, namespace):
+        with self.lock:
+            for entry_key in [k for k in self.entries if k[0] == namespace]:
+                del self.entries[entry_key]
+
+    def count(self, namespace):
+        with self.lock:
+            return sum(1 for k in self.entries if k[0] == namespace)
+
+
+class SQLiteBackend:
+    """
+    Almacén compartido en disco (SQLite en modo WAL con mmap): todos los
+    workers de la máquina leen la misma caché y sobrevive a reinicios.
+    Los valores se guardan como JSON.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path, max_entries=20000, mmap_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.mmap_bytes = mmap_bytes
+        # Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)
+        self.local = threading.local()
+        self.writes = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " stored_at REAL NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires_at)"
+            )
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_bytes)}")
+            self.local.conn = conn
+        return conn
+
+    def get(self, namespace, key, now=None):
+        now = time.time() if now is None else now
+        row = (
+            self._connect()
+            .execute(
+                "SELECT value, stored_at FROM cache"
+                " WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (namespace, key, now),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, namespace, key, value, ttl_seconds, now=None):
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)",
+                (namespace, key, _dumps(value), now, now + ttl_seconds),
+            )
+        self.writes += 1
+        # Purga periódica de caducados y del exceso de entradas
+        if self.writes % 100 == 0:
+            self.cleanup(now)
+
+    def cleanup(self, now=None):
+        now = time.time() if now is None else now
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM cache WHERE rowid IN ("
+                " SELECT rowid FROM cache ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, namespace, key):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+
+    def clear(self, namespace):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+
+    def count(self, namespace):
+        return (
+            self._connect()
+            .execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires_at > ?",
+                (namespace, time.time()),
+            )
+            .fetchone()[0]
+        )
+
+
+class RedisBackend:
+    """
+    Almacén compartido en Redis (o cualquier servidor con su protocolo):
+    sirve para varios contenedores. La caducidad la aplica Redis (EX).
+    `client` es un redis.Redis o un objeto con la misma interfaz.
+    """
+
+    name = "redis"
+
+    def __init__(self, client, prefix="casa:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise RuntimeError("El paquete redis no está instalado")
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}{namespace}:{key}"
+
+    def get(self, namespace, key, now=None):
+        raw = self.client.get(self._key(namespace, key))
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode("utf-8")
+        entry = json.loads(raw)
+        return entry["value"], entry["stored_at"]
+
+    def set(self, namespace, key, value, ttl_seconds, now=None):
+        now = time.time() if now is None else now
+        self.client.set(
+            self._key(namespace, key),
+            _dumps({"value": value, "stored_at": now}),
+            ex=max(1, int(ttl_seconds)),
+        )
+
+    def delete(self, namespace, key):
+        self.client.delete(self._key(namespace, key))
+
+    def _scan(self, namespace):
+        return list(self.client.scan_iter(match=f"{self._key(namespace, '')}*"))
+
+    def clear(self, namespace):
+        keys = self._scan(namespace)
+        if keys:
+            self.client.delete(*keys)
+
+    def count(self, namespace):
+        return len(self._scan(namespace))
+
+
+def create_backend(url):
+    """
+    Backend a partir de una URL:
+    memory:// | sqlite:///ruta/relativa.sqlite3 | sqlite:////ruta/absoluta.sqlite3
+    | redis://host:puerto/db
+    """
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryBackend()
+    if scheme == "sqlite":
+        return SQLiteBackend(url[len("sqlite:///") :])
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisBackend.from_url(url)
+    raise ValueError(f"Backend de caché desconocido: {url}")
@@ -0,0 +1,342 @@
+import hashlib
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from app.mercadona.backends import MemoryBackend
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def deep_sizeof(value, seen=None):
+    """
+    Memoria real aproximada de un valor JSON (dict/list/str/números):
+    sys.getsizeof del contenedor más el de todo lo que contiene
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(item, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += deep_sizeof(item, seen)
+    return size
+
+
+class MercadonaCache:
+    """
+    Caché LRU con TTL y presupuesto de memoria para las respuestas de
+    Mercadona. Las claves son (tipo, id) y solo se admiten los tipos de KINDS:
+    - ("categories", None): árbol de categorías (/categories/)
+    - ("category", id): respuesta de /mercadona/category/<id>
+    - ("subcategory", id): productos en bruto de /categories/<id>
+    - ("product", id): detalle formateado de /products/<id> con su ETag
+    Las entradas caducadas se conservan hasta que el LRU las expulsa, para
+    poder servirlas (allow_stale) si Mercadona falla.
+    Con un `backend` compartido (SQLite/Redis) actúa como primer nivel: lo
+    que no está fresco en memoria se busca allí antes de ir a Mercadona.
+    """
+
+    NAMESPACE = "mercadona"
+
+    KINDS = ("categories", "category", "subcategory", "product")
+
+    def __init__(
+        self,
+        max_bytes=32 * 1024 * 1024,
+        ttl_seconds=120,
+        stale_ttl_seconds=24 * 3600,
+        backend=None,
+        kind_ttl_seconds=None,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # TTL propio de algunos tipos (el resto usa ttl_seconds)
+        self.kind_ttl_seconds = dict(kind_ttl_seconds or {})
+        # Tiempo que el backend compartido conserva una entrada caducada
+        self.stale_ttl_seconds = stale_ttl_seconds
+        self.backend = backend
+        # (tipo, id) -> (valor, bytes, guardado_en)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "rejected": 0,
+            "shared_hits": 0,
+            "backend_errors": 0,
+        }
+
+    def _key(self, kind, ident):
+        if kind not in self.KINDS:
+            raise ValueError(f"Tipo de caché desconocido: {kind}")
+        return (kind, ident)
+
+    def _ttl(self, kind):
+        return self.kind_ttl_seconds.get(kind, self.ttl_seconds)
+
+    def _backend_key(self, key):
+        kind, ident = key
+        return f"{kind}:{ident}"
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _from_backend(self, key, entry, now):
+        """
+        Entrada del backend compartido si es más reciente que la local.
+        Se llama sin el lock: la E/S con SQLite/Redis no bloquea al resto
+        """
+        try:
+            shared = self.backend.get(self.NAMESPACE, self._backend_key(key), now=now)
+        except Exception as e:
+            self._count("backend_errors")
+            logger.warning(f"⚠️ Error leyendo caché compartida: {e}")
+            return entry
+
+        if shared is None or (entry is not None and shared[1] <= entry[2]):
+            return entry
+        value, stored_at = shared
+        self._count("shared_hits")
+        self._store_local(key, value, stored_at, only_if_newer=True)
+        return (value, None, stored_at)
+
+    def get(self, kind, ident=None, allow_stale=False, now=None):
+        """Valor guardado (None si no hay o ha caducado y no se admite stale)"""
+        key = self._key(kind, ident)
+        ttl_seconds = self._ttl(kind)
+        now = time.time() if now is None else now
+        # El lock solo protege el LRU en memoria, nunca la E/S del backend
+        with self.lock:
+            entry = self.entries.get(key)
+        if self.backend and (entry is None or now - entry[2] >= ttl_seconds):
+            entry = self._from_backend(key, entry, now)
+
+        with self.lock:
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+
+            value, _size, stored_at = entry
+            if now - stored_at < ttl_seconds:
+                self.stats["hits"] += 1
+            elif allow_stale:
+                self.stats["stale_hits"] += 1
+            else:
+                self.stats["misses"] += 1
+                return None
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, kind, ident, value, now=None):
+        """Guardar un valor (también en el backend compartido si lo hay)"""
+        key = self._key(kind, ident)
+        now = time.time() if now is None else now
+        if self.backend:
+            try:
+                self.backend.set(
+                    self.NAMESPACE,
+                    self._backend_key(key),
+                    value,
+                    self.stale_ttl_seconds,
+                    now=now,
+                )
+            except Exception as e:
+                self._count("backend_errors")
+                logger.warning(f"⚠️ Error guardando en caché compartida: {e}")
+        return self._store_local(key, value, now)
+
+    def _store_local(self, key, value, stored_at, only_if_newer=False):
+        """
+        Guardar en memoria y expulsar las entradas menos usadas si no cabe.
+        Con `only_if_newer` no pisa una entrada guardada mientras tanto
+        """
+        size = deep_sizeof(value)
+        if size > self.max_bytes:
+            self._count("rejected")
+            logger.warning(f"⚠️ {key} no cabe en la caché ({size} bytes)")
+            return False
+
+        with self.lock:
+            current = self.entries.get(key)
+            if only_if_newer and current is not None and current[2] >= stored_at:
+                return False
+            self._remove(key)
+            self.entries[key] = (value, size, stored_at)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+        return True
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def delete(self, kind, ident=None):
+        key = self._key(kind, ident)
+        with self.lock:
+            self._remove(key)
+        if self.backend:
+            try:
+                self.backend.delete(self.NAMESPACE, self._backend_key(key))
+            except Exception as e:
+                self._count("backend_errors")
+                logger.warning(f"⚠️ Error borrando de caché compartida: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+        # Fuera del lock: en Redis recorre las claves con SCAN
+        if self.backend:
+            try:
+                self.backend.clear(self.NAMESPACE)
+            except Exception as e:
+                self._count("backend_errors")
+                logger.warning(f"⚠️ Error limpiando caché compartida: {e}")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_stats(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            kinds = {kind: {"entries": 0, "bytes": 0} for kind in self.KINDS}
+            expired = 0
+            for (kind, _ident), (_value, size, stored_at) in self.entries.items():
+                kinds[kind]["entries"] += 1
+                kinds[kind]["bytes"] += size
+                if now - stored_at >= self._ttl(kind):
+                    expired += 1
+
+            return {
+                "entries": len(self.entries),
+                "expired_entries": expired,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "usage_percent": round(self.total_bytes / self.max_bytes * 100, 1),
+                "ttl_seconds": self.ttl_seconds,
+                "kind_ttl_seconds": self.kind_ttl_seconds,
+                "backend": self.backend.name if self.backend else None,
+                "kinds": kinds,
+                **self.stats,
+            }
+
+
+class SearchCache:
+    """
+    Caché de resultados de búsqueda con TTL sobre un backend intercambiable:
+    en memoria (por proceso), SQLite compartido en disco o Redis. Con un
+    backend compartido todos los workers aprovechan la misma búsqueda y los
+    aciertos sobreviven a reinicios.
+    """
+
+    NAMESPACE = "search"
+
+    def __init__(self, max_size=500, ttl_minutes=30, backend=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_minutes * 60
+        self.backend = backend or MemoryBackend(max_entries=max_size)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "saves": 0, "backend_errors": 0}
+
+    def key(self, query, filters=None):
+        """
+        Clave única de la búsqueda: la de la caché y la que usa el
+        single-flight para agrupar búsquedas iguales en curso
+        """
+        key_data = f"{query.lower().strip()}"
+        if filters:
+            key_data += f"_filters_{str(sorted(filters.items()))}"
+        return hashlib.md5(key_data.encode()).hexdigest()
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def get(self, query, filters=None):
+        """Obtener resultado de caché si existe y no ha expirado"""
+        key = self.key(query, filters)
+        try:
+            entry = self.backend.get(self.NAMESPACE, key)
+        except Exception as e:
+            self._count("backend_errors")
+            logger.warning(f"⚠️ Error leyendo caché de búsquedas: {e}")
+            entry = None
+
+        if entry is None:
+            self._count("misses")
+            logger.info(f"💥 Cache MISS para búsqueda: '{query}'")
+            return None
+
+        self._count("hits")
+        logger.info(f"🎯 Cache HIT para búsqueda: '{query}'")
+        return entry[0]
+
+    def set(self, query, data, filters=None):
+        """Guardar resultado en caché"""
+        key = self.key(query, filters)
+        try:
+            self.backend.set(self.NAMESPACE, key, data, self.ttl_seconds)
+        except Exception as e:
+            self._count("backend_errors")
+            logger.warning(f"⚠️ Error guardando en caché de búsquedas: {e}")
+            return
+        self._count("saves")
+        logger.info(
+            f"💾 Cache SAVE para búsqueda: '{query}' "
+            f"({len(data.get('products', []))} productos)"
+        )
+
+    def clear(self):
+        """Limpiar toda la caché"""
+        self.backend.clear(self.NAMESPACE)
+        logger.info("🧹 Cache completamente limpiada")
+
+    def get_stats(self):
+        """Obtener estadísticas de la caché"""
+        try:
+            total_entries = self.backend.count(self.NAMESPACE)
+        except Exception:
+            total_entries = None
+        with self.lock:
+            return {
+                "total_entries": total_entries,
+                "max_size": self.max_size,
+                "ttl_minutes": self.ttl_seconds // 60,
+                "backend": self.backend.name,
+                **self.stats,
+            }
+
+
+# Instancias globales: respuestas de Mercadona y resultados de búsqueda.
+# El detalle de un producto cambia poco y se revalida con su ETag
+mercadona_cache = MercadonaCache(
+    max_bytes=32 * 1024 * 1024, ttl_seconds=120, kind_ttl_seconds={"product": 3600}
+)
+search_cache = SearchCache(max_size=500, ttl_minutes=30)
+
+
+def configure_backend(backend):
+    """Compartir `backend` entre la caché de búsquedas y la de Mercadona"""
+    search_cache.backend = backend
+    mercadona_cache.backend = None if backend.name == "memory" else backend
+    logger.info(f"🗄️ Caché de Mercadona con backend {backend.name}")
@@ -0,0 +1,648 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+
+from app import mongo
+from app.mercadona.fetcher import catalog_fetcher
+from app.mercadona.normalize import (MIN_PREFIX_LENGTH, normalize_product,
+                                     tokenize, trigrams)
+from app.mercadona.prices import price_history, price_point
+from app.mercadona.ranking import (Bm25, edit_distance, fuzzy_weight,
+                                   max_edits, prefix_expansions)
+from app.mercadona.source import (extract_products, fetch_categories,
+                                  fetch_subcategory, iter_subcategories)
+from app.mercadona.suggest import SuggestIndex
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def response_hash(data):
+    """Huella estable de una respuesta de /categories/<id>"""
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def _merge_postings(postings, added, removed):
+    """
+    Copia de `postings` con los cambios aplicados. Los conjuntos afectados
+    se sustituyen por otros nuevos (nunca se modifican en sitio), así que
+    un lector con la versión anterior no ve cambios a mitad de búsqueda.
+    """
+    postings = dict(postings)
+    for key in set(added) | set(removed):
+        ids = (postings.get(key, frozenset()) - removed.get(key, set())) | added.get(
+            key, set()
+        )
+        if ids:
+            postings[key] = frozenset(ids)
+        else:
+            postings.pop(key, None)
+    return postings
+
+
+class CatalogIndex:
+    """
+    Índice invertido del catálogo en memoria:
+    - tokens: palabra completa -> ids de producto
+    - prefixes: prefijo (>= MIN_PREFIX_LENGTH) -> ids de producto
+    - vocabulary_prefixes / vocabulary_trigrams: prefijo o trigrama ->
+      palabras del vocabulario (expansión de la query y búsqueda aproximada)
+    Se actualiza por subcategorías con copia en escritura: las búsquedas
+    nunca esperan a una actualización y siempre ven datos completos.
+    """
+
+    def __init__(self):
+        # id -> (producto en bruto, categoría, subcategoría, id subcategoría,
+        #        NormalizedProduct)
+        self.products = {}
+        # id subcategoría -> ids de producto que contiene, y a la inversa
+        self.by_subcategory = {}
+        self.memberships = {}
+        # id subcategoría -> (categoría, subcategoría)
+        self.subcategory_names = {}
+        self.tokens = {}
+        self.prefixes = {}
+        self.vocabulary_prefixes = {}
+        self.vocabulary_trigrams = {}
+        # Suma de longitudes (ponderadas) de los productos, para BM25
+        self.total_length = 0.0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.products)
+
+    def replace(self, changes):
+        """
+        Sustituir el contenido de las subcategorías de `changes`
+        ({id subcategoría: [(producto, categoría, subcategoría), ...]}).
+        Una lista vacía elimina la subcategoría del índice.
+        Un producto puede estar en varias subcategorías: se indexa una vez y
+        solo sale del índice cuando ya no lo lista ninguna.
+        Devuelve (ids con algún cambio que siguen en el índice, ids eliminados).
+        """
+        with self.lock:
+            products = dict(self.products)
+            by_subcategory = dict(self.by_subcategory)
+            memberships = dict(self.memberships)
+            subcategory_names = dict(self.subcategory_names)
+            total_length = self.total_length
+            added = {}
+            removed = {}
+
+            def unindex(product_id):
+                nonlocal total_length
+                entry = products.pop(product_id)
+                total_length -= entry[4].length
+                for token in entry[4].tokens:
+                    removed.setdefault(token, set()).add(product_id)
+
+            # Primero se retiran todas las subcategorías que cambian y después
+            # se añaden: un producto puede pasar de una a otra en el mismo lote
+            touched = set()
+            for subcat_id in changes:
+                subcategory_names.pop(subcat_id, None)
+                for product_id in by_subcategory.pop(subcat_id, ()):
+                    memberships[product_id] = memberships[product_id] - {subcat_id}
+                    touched.add(product_id)
+
+            listed = {}
+            for subcat_id, entries in changes.items():
+                subcat_ids = set()
+                for product, category_name, subcat_name in entries:
+                    product_id = str(product.get("id") or "")
+                    if not product_id:
+                        continue
+                    subcat_ids.add(product_id)
+                    subcategory_names[subcat_id] = (category_name, subcat_name)
+                    # Si aparece en varias, se indexa con el primer listado
+                    listed.setdefault(
+                        product_id, (product, category_name, subcat_name, subcat_id)
+                    )
+                for product_id in subcat_ids:
+                    memberships[product_id] = memberships.get(
+                        product_id, frozenset()
+                    ) | {subcat_id}
+                if subcat_ids:
+                    by_subcategory[subcat_id] = frozenset(subcat_ids)
+            touched.update(listed)
+
+            gone = set()
+            for product_id in touched:
+                entry = products.get(product_id)
+                if not memberships.get(product_id):
+                    memberships.pop(product_id, None)
+                    if entry:
+                        unindex(product_id)
+                        gone.add(product_id)
+                elif product_id in listed:
+                    if entry:
+                        unindex(product_id)
+                    product, category_name, subcat_name, subcat_id = listed[product_id]
+                    normalized = normalize_product(product)
+                    products[product_id] = (
+                        product,
+                        category_name,
+                        subcat_name,
+                        subcat_id,
+                        normalized,
+                    )
+                    total_length += normalized.length
+                    for token in normalized.tokens:
+                        added.setdefault(token, set()).add(product_id)
+                elif entry and entry[3] not in memberships[product_id]:
+                    # Lo retira su subcategoría pero sigue en otra sin cambios
+                    subcat_id = min(memberships[product_id], key=str)
+                    category_name, subcat_name = subcategory_names.get(
+                        subcat_id, entry[1:3]
+                    )
+                    products[product_id] = (
+                        entry[0],
+                        category_name,
+                        subcat_name,
+                        subcat_id,
+                        entry[4],
+                    )
+
+            prefixes_added = self._expand_prefixes(added)
+            prefixes_removed = self._expand_prefixes(removed)
+
+            tokens = _merge_postings(self.tokens, added, removed)
+            self._update_vocabulary(
+                [token for token in added if token not in self.tokens],
+                [token for token in removed if token not in tokens],
+            )
+
+            self.tokens = tokens
+            self.prefixes = _merge_postings(
+                self.prefixes, prefixes_added, prefixes_removed
+            )
+            self.by_subcategory = by_subcategory
+            self.memberships = memberships
+            self.subcategory_names = subcategory_names
+            self.total_length = total_length
+            self.products = products
+            return touched - gone, gone
+
+    def _update_vocabulary(self, new_terms, gone_terms):
+        """Altas y bajas de palabras en los índices del vocabulario"""
+
+        def postings(terms):
+            by_prefix = {}
+            by_trigram = {}
+            for term in terms:
+                for end in range(MIN_PREFIX_LENGTH, len(term) + 1):
+                    by_prefix.setdefault(term[:end], set()).add(term)
+                for trigram in trigrams(term):
+                    by_trigram.setdefault(trigram, set()).add(term)
+            return by_prefix, by_trigram
+
+        prefixes_added, trigrams_added = postings(new_terms)
+        prefixes_removed, trigrams_removed = postings(gone_terms)
+        self.vocabulary_prefixes = _merge_postings(
+            self.vocabulary_prefixes, prefixes_added, prefixes_removed
+        )
+        self.vocabulary_trigrams = _merge_postings(
+            self.vocabulary_trigrams, trigrams_added, trigrams_removed
+        )
+
+    @staticmethod
+    def _expand_prefixes(token_ids):
+        prefixes = {}
+        for token, ids in token_ids.items():
+            for end in range(MIN_PREFIX_LENGTH, len(token) + 1):
+                prefixes.setdefault(token[:end], set()).update(ids)
+        return prefixes
+
+    def fuzzy_terms(self, word):
+        """
+        {palabra: peso} del vocabulario a `max_edits` errores de `word`.
+        Los candidatos salen del índice de trigramas: cada error cambia como
+        mucho 4 trigramas (3, o 4 si es una transposición), así que se
+        descartan los que comparten menos.
+        """
+        limit = max_edits(word)
+        if not limit:
+            return {}
+
+        word_trigrams = trigrams(word)
+        shared = Counter()
+        for trigram in word_trigrams:
+            shared.update(self.vocabulary_trigrams.get(trigram, ()))
+
+        needed = len(word_trigrams) - 4 * limit
+        terms = {}
+        for term, count in shared.items():
+            if count < needed or term == word:
+                continue
+            distance = edit_distance(word, term, limit)
+            if distance <= limit:
+                terms[term] = fuzzy_weight(word, distance)
+        return terms
+
+    def search(self, query, fuzzy=True):
+        """
+        Productos cuyas palabras empiezan por las de la query (o, con
+        `fuzzy`, se parecen a ellas si la palabra exacta no existe).
+        Mismos criterios que is_product_match: coincide al menos el 70% de
+        las palabras o alguna de 3+ letras; BM25 pone delante los que
+        coinciden con todas.
+        Devuelve [(producto, categoría, subcategoría, puntuación BM25)]
+        ordenada por puntuación.
+        """
+        words = [word for word in tokenize(query) if len(word) >= MIN_PREFIX_LENGTH]
+        if not words:
+            return []
+
+        tokens = self.tokens
+        prefixes = self.prefixes
+        products = self.products
+
+        matches = []
+        expansions = []
+        for word in words:
+            weights = prefix_expansions(word, self.vocabulary_prefixes.get(word, ()))
+            ids = prefixes.get(word, frozenset())
+            if fuzzy and word not in tokens:
+                similar = self.fuzzy_terms(word)
+                for term, weight in similar.items():
+                    weights[term] = max(weights.get(term, 0.0), weight)
+                    ids = ids | tokens.get(term, frozenset())
+            matches.append(ids)
+            expansions.append(weights)
+
+        if len(matches) == 1:
+            ids = matches[0]
+        else:
+            counts = Counter()
+            for match in matches:
+                counts.update(match)
+            ids = {
+                product_id
+                for product_id, count in counts.items()
+                if count >= len(words) * 0.7
+            }
+            # Basta con una palabra de 3+ letras (p. ej. "aceite" en "aceite oliva")
+            for word, match in zip(words, matches):
+                if len(word) >= 3:
+                    ids.update(match)
+
+        bm25 = Bm25(
+            lambda term: len(tokens.get(term, ())), len(products), self.total_length
+        )
+        results = []
+        for product_id in ids:
+            entry = products.get(product_id)
+            if entry:
+                score = bm25.score(entry[4], expansions)
+                results.append((entry[0], entry[1], entry[2], score))
+
+        # Mayor puntuación primero; a igualdad, nombres más cortos
+        results.sort(
+            key=lambda result: (-result[3], len(result[0].get("display_name") or ""))
+        )
+        return results
+
+    def get_stats(self):
+        return {
+            "products": len(self.products),
+            "subcategories": len(self.by_subcategory),
+            "tokens": len(self.tokens),
+            "prefixes": len(self.prefixes),
+            "vocabulary_trigrams": len(self.vocabulary_trigrams),
+        }
+
+
+class ProductCatalog:
+    """
+    Copia local del catálogo de Mercadona:
+    - al arrancar se carga desde `mercadona_products` (o se descarga entero)
+    - después se refresca de forma escalonada: cada `tick_seconds` se vuelven
+      a pedir `batch_size` subcategorías y solo las que cambian (hash de la
+      respuesta distinto) se reescriben en Mongo y en el índice
+    Las búsquedas leen siempre el índice actual aunque haya un refresco en
+    curso (stale-while-revalidate); mercadona_search no hace llamadas salientes.
+    """
+
+    def __init__(
+        self, tick_seconds=60, batch_size=10, deadline_seconds=600, timeout=10
+    ):
+        self.tick_seconds = tick_seconds
+        self.batch_size = batch_size
+        self.deadline_seconds = deadline_seconds
+        self.timeout = timeout
+        self.index = CatalogIndex()
+        # Autocompletado de nombres (se rehace con cada versión del índice)
+        self.suggestions = SuggestIndex()
+        # id subcategoría -> hash de la última respuesta aplicada
+        self.hashes = {}
+        # Subcategorías pendientes de comprobar en esta vuelta
+        self.queue = deque()
+        # Se incrementa cada vez que cambia el contenido del índice
+        self.version = 0
+        self.app = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.refresh_lock = threading.Lock()
+        # Copia sin sincronizar para cuando Mercadona no responde
+        self.snapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.last_sync = None
+        self.last_refresh = None
+        self.stats = {"checked": 0, "changed": 0, "unchanged": 0, "errors": 0}
+
+    def start(self, app):
+        if self.thread and self.thread.is_alive():
+            return
+        self.app = app
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self._run, name="mercadona-catalog", daemon=True
+        )
+        self.thread.start()
+        logger.info("🛒 Sincronización del catálogo de Mercadona iniciada")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        # Arranque: índice desde la copia guardada y, si no hay, descarga
+        try:
+            with self.app.app_context():
+                if not self.load():
+                    self.sync()
+        except Exception as e:
+            logger.error(f"❌ Error cargando el catálogo: {e}")
+
+        while not self.stop_event.wait(self.tick_seconds):
+            try:
+                with self.app.app_context():
+                    self.refresh_next()
+            except Exception as e:
+                logger.error(f"❌ Error refrescando el catálogo: {e}")
+
+    def is_ready(self):
+        return len(self.index) > 0
+
+    def search(self, query, fuzzy=True):
+        return self.index.search(query, fuzzy)
+
+    def get_snapshot(self):
+        """
+        Índice de la última copia guardada en Mongo, para responder mientras
+        Mercadona no está disponible y el catálogo no se sincroniza. Es
+        aparte del índice principal (no cuenta para is_ready) y nunca se
+        refresca: drop_snapshot lo descarta cuando Mercadona vuelve.
+        None si no hay copia o si otro hilo la está cargando
+        """
+        snapshot = self.snapshot
+        if snapshot is None and self.snapshot_lock.acquire(blocking=False):
+            try:
+                snapshot = self.snapshot
+                if snapshot is None:
+                    snapshot, _hashes = self._read_store()
+                    self.snapshot = snapshot
+                    logger.info(f"📦 Copia del catálogo: {len(snapshot)} productos")
+            finally:
+                self.snapshot_lock.release()
+        return snapshot if snapshot else None
+
+    def drop_snapshot(self):
+        if self.snapshot is not None:
+            self.snapshot = None
+            logger.info("📦 Copia del catálogo descartada")
+
+    def get_product(self, product_id):
+        """Producto en bruto de la última sincronización (None si no está)"""
+        entry = self.index.products.get(str(product_id))
+        return entry[0] if entry else None
+
+    def suggest(self, prefix, limit=10):
+        return self.suggestions.suggest(prefix, limit)
+
+    def _index_changed(self):
+        """Nueva versión del índice: se rehace también el autocompletado"""
+        self.suggestions = SuggestIndex.from_catalog(self.index)
+        self.version += 1
+
+    def load(self):
+        """Reconstruir el índice desde mercadona_products. Devuelve nº de productos"""
+        self.index, self.hashes = self._read_store()
+        self._index_changed()
+        logger.info(f"📚 Catálogo cargado: {len(self.index)} productos")
+        return len(self.index)
+
+    def _read_store(self):
+        """(CatalogIndex, hashes por subcategoría) de la copia guardada en Mongo"""
+        categories = {
+            doc["_id"]: doc
+            for doc in mongo.db.mercadona_categories.find(
+                {}, {"hash": 1, "category": 1, "name": 1}
+            )
+        }
+        hashes = {subcat_id: doc.get("hash") for subcat_id, doc in categories.items()}
+
+        changes = {}
+        for doc in mongo.db.mercadona_products.find(
+            {},
+            {
+                "product": 1,
+                "category": 1,
+                "subcategory": 1,
+                "subcategory_id": 1,
+                "subcategory_ids": 1,
+            },
+        ):
+            if not doc.get("product"):
+                continue
+            # Los documentos anteriores solo guardan su subcategoría principal
+            for subcat_id in doc.get("subcategory_ids") or [doc.get("subcategory_id")]:
+                names = (doc.get("category", ""), doc.get("subcategory", ""))
+                if subcat_id != doc.get("subcategory_id") and subcat_id in categories:
+                    category = categories[subcat_id]
+                    names = (category.get("category", ""), category.get("name", ""))
+                changes.setdefault(subcat_id, []).append((doc["product"], *names))
+
+        index = CatalogIndex()
+        index.replace(changes)
+        return index, hashes
+
+    def _fetch_subcategory(self, session, task):
+        _category_name, subcat_id, _subcat_name = task
+        return fetch_subcategory(session, subcat_id, timeout=self.timeout)
+
+    def _fetch_tree(self):
+        """Subcategorías actuales; olvida las que ya no existen"""
+        categories_data = fetch_categories(catalog_fetcher.session)
+        if not categories_data:
+            return None
+
+        tasks = list(iter_subcategories(categories_data))
+        current = {subcat_id for _category, subcat_id, _name in tasks}
+        missing = [subcat_id for subcat_id in self.hashes if subcat_id not in current]
+        if missing:
+            self._store(*self.index.replace({subcat_id: [] for subcat_id in missing}))
+            mongo.db.mercadona_categories.delete_many({"_id": {"$in": missing}})
+            for subcat_id in missing:
+                self.hashes.pop(subcat_id, None)
+            self._index_changed()
+            logger.info(f"🗑️ {len(missing)} subcategorías retiradas del catálogo")
+        return tasks
+
+    def sync(self):
+        """Comprobar ahora todas las subcategorías (descarga completa)"""
+        with self.refresh_lock:
+            tasks = self._fetch_tree()
+            if tasks is None:
+                return {"success": False, "error": "Sin categorías"}
+            self.queue.clear()
+            report = self._refresh(tasks)
+            self.last_sync = datetime.now()
+            return report
+
+    def refresh_next(self):
+        """
+        Comprobar el siguiente lote de subcategorías. Al terminar la vuelta
+        se vuelve a pedir el árbol para detectar altas y bajas.
+        """
+        with self.refresh_lock:
+            if not self.queue:
+                tasks = self._fetch_tree()
+                if tasks is None:
+                    return {"success": False, "error": "Sin categorías"}
+                self.queue.extend(tasks)
+
+            batch = [
+                self.queue.popleft()
+                for _ in range(min(self.batch_size, len(self.queue)))
+            ]
+            return self._refresh(batch)
+
+    def _refresh(self, tasks):
+        """Descargar `tasks` y aplicar solo las subcategorías que han cambiado"""
+        start_time = time.monotonic()
+        now = datetime.now()
+        fetch_report = catalog_fetcher.fetch_all(
+            tasks, self._fetch_subcategory, deadline_seconds=self.deadline_seconds
+        )
+
+        changes = {}
+        hash_operations = []
+        for (category_name, subcat_id, subcat_name), data in fetch_report.results:
+            digest = response_hash(data)
+            update = {"checked_at": now}
+            if self.hashes.get(subcat_id) != digest:
+                changes[subcat_id] = [
+                    (product, category_name, subcat_name)
+                    for product in extract_products(data)
+                ]
+                self.hashes[subcat_id] = digest
+                update.update(
+                    {
+                        "hash": digest,
+                        "changed_at": now,
+                        "category": category_name,
+                        "name": subcat_name,
+                    }
+                )
+            hash_operations.append(
+                UpdateOne({"_id": subcat_id}, {"$set": update}, upsert=True)
+            )
+
+        if changes:
+            price_points = list(self._price_changes(changes))
+            self._store(*self.index.replace(changes), now=now)
+            price_history.record(price_points, now)
+            self._index_changed()
+        if hash_operations:
+            mongo.db.mercadona_categories.bulk_write(hash_operations, ordered=False)
+
+        checked = len(fetch_report.results)
+        errors = fetch_report.errors + fetch_report.timed_out
+        self.stats["checked"] += checked
+        self.stats["changed"] += len(changes)
+        self.stats["unchanged"] += checked - len(changes)
+        self.stats["errors"] += errors
+        self.last_refresh = now
+
+        report = {
+            "success": True,
+            "checked": checked,
+            "changed": len(changes),
+            "errors": errors,
+            "products": len(self.index),
+            "duration_seconds": round(time.monotonic() - start_time, 2),
+        }
+        if changes:
+            logger.info(f"🔄 Catálogo actualizado: {report}")
+        return report
+
+    def _price_changes(self, changes):
+        """(id, price_point) de los productos nuevos o con otro precio"""
+        for entries in changes.values():
+            for product, _category_name, _subcat_name in entries:
+                product_id = str(product.get("id") or "")
+                point = price_point(product)
+                if not product_id or point is None:
+                    continue
+                old = self.index.products.get(product_id)
+                if old is None or price_point(old[0]) != point:
+                    yield product_id, point
+
+    def _store(self, updated, removed, now=None):
+        """
+        Guardar en Mongo el estado del índice de los productos `updated` y
+        borrar los `removed` (los que ya no lista ninguna subcategoría)
+        """
+        now = now or datetime.now()
+        products = self.index.products
+        memberships = self.index.memberships
+        operations = []
+        for product_id in sorted(updated):
+            product, category_name, subcat_name, subcat_id, _normalized = products[
+                product_id
+            ]
+            operations.append(
+                ReplaceOne(
+                    {"_id": product_id},
+                    {
+                        "product": product,
+                        "category": category_name,
+                        "subcategory": subcat_name,
+                        "subcategory_id": subcat_id,
+                        "subcategory_ids": sorted(memberships[product_id], key=str),
+                        "synced_at": now,
+                    },
+                    upsert=True,
+                )
+            )
+        if removed:
+            operations.append(DeleteMany({"_id": {"$in": sorted(removed)}}))
+        if operations:
+            mongo.db.mercadona_products.bulk_write(operations, ordered=True)
+
+    def get_stats(self):
+        return {
+            "ready": self.is_ready(),
+            "version": self.version,
+            "last_sync": self.last_sync.isoformat() if self.last_sync else None,
+            "last_refresh": (
+                self.last_refresh.isoformat() if self.last_refresh else None
+            ),
+            "pending_subcategories": len(self.queue),
+            "tracked_subcategories": len(self.hashes),
+            "suggest_names": len(self.suggestions),
+            "snapshot_products": len(self.snapshot) if self.snapshot else 0,
+            **self.stats,
+            **self.index.get_stats(),
+        }
+
+
+# Instancia global del catálogo local
+product_catalog = ProductCatalog(tick_seconds=60, batch_size=10)
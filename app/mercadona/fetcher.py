@@ -0,0 +1,100 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask import current_app
+
+from app.http_client import http_client
+from app.mercadona.source import MERCADONA_HEADERS
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class FetchReport:
+    """
+    Resultado de una descarga concurrente de subcategorías
+    """
+
+    def __init__(self):
+        # Lista de (tarea, productos) en orden de finalización
+        self.results = []
+        self.errors = 0
+        self.timed_out = 0
+        self.duration_seconds = 0.0
+
+    @property
+    def partial(self):
+        return self.timed_out > 0
+
+
+class SubcategoryFetcher:
+    """
+    Descarga concurrente de subcategorías de Mercadona:
+    pool de hilos acotado, las conexiones del cliente HTTP compartido
+    y un deadline global; si se alcanza se devuelven resultados parciales
+    """
+
+    def __init__(self, headers, max_workers=8, deadline_seconds=12, name="mercadona"):
+        self.max_workers = max_workers
+        self.deadline_seconds = deadline_seconds
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+        self.session = http_client.session_with(headers)
+
+    def _run(self, app, fetch, task):
+        with app.app_context():
+            return fetch(self.session, task)
+
+    def fetch_all(self, tasks, fetch, deadline_seconds=None):
+        """
+        Ejecutar fetch(session, tarea) para cada tarea de forma concurrente.
+        Las tareas que no terminan antes del deadline se cancelan (las que ya
+        están en curso terminan en segundo plano y dejan su caché caliente).
+        """
+        report = FetchReport()
+        start_time = time.monotonic()
+        deadline = start_time + (deadline_seconds or self.deadline_seconds)
+        app = current_app._get_current_object()
+
+        pending = {
+            self.executor.submit(self._run, app, fetch, task): task for task in tasks
+        }
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    report.results.append((task, future.result()))
+                except Exception as e:
+                    report.errors += 1
+                    logger.warning(f"Error descargando subcategoría {task}: {e}")
+
+        if pending:
+            report.timed_out = len(pending)
+            for future in pending:
+                future.cancel()
+            logger.warning(
+                f"⏱️ Deadline alcanzado: {report.timed_out} subcategorías sin respuesta"
+            )
+
+        report.duration_seconds = time.monotonic() - start_time
+        return report
+
+
+# Instancia global: descarga concurrente para las peticiones de usuarios
+# (búsquedas en frío, lote de productos)
+subcategory_fetcher = SubcategoryFetcher(
+    MERCADONA_HEADERS, max_workers=8, deadline_seconds=12
+)
+
+# Pool propio para la sincronización del catálogo: sus cientos de tareas no
+# deben hacer esperar a las búsquedas (las conexiones sí se comparten)
+catalog_fetcher = SubcategoryFetcher(
+    MERCADONA_HEADERS, max_workers=4, deadline_seconds=600, name="mercadona-sync"
+)
@@ -0,0 +1,143 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+# Longitud mínima de prefijo indexado (igual que las palabras de la query)
+MIN_PREFIX_LENGTH = 2
+
+TOKEN_RE = re.compile(r"\w+")
+
+# Peso de cada campo en la frecuencia de una palabra (BM25F)
+FIELD_WEIGHTS = {"name": 2.0, "brand": 1.0, "packaging": 0.5}
+
+
+def fold(text):
+    """Minúsculas y sin tildes: "Plátano Ñora" -> "platano nora" """
+    text = unicodedata.normalize("NFKD", str(text or "").lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    """Palabras normalizadas (fold) de un texto"""
+    return TOKEN_RE.findall(fold(text))
+
+
+def token_prefixes(tokens):
+    """Prefijos (>= MIN_PREFIX_LENGTH) de un conjunto de palabras"""
+    return frozenset(
+        token[:end]
+        for token in tokens
+        for end in range(MIN_PREFIX_LENGTH, len(token) + 1)
+    )
+
+
+def trigrams(token):
+    """Trigramas de una palabra con marcas de inicio y fin ("$le", ...)"""
+    padded = f"${token}$"
+    return frozenset(padded[i : i + 3] for i in range(len(padded) - 2))
+
+
+class NormalizedProduct:
+    """
+    Campos de búsqueda de un producto calculados una única vez al ingerirlo:
+    textos normalizados, conjuntos de palabras, prefijos, trigramas y
+    frecuencias ponderadas por campo (para BM25).
+    Con ellos la coincidencia y la puntuación son operaciones de conjuntos.
+    """
+
+    __slots__ = (
+        "name",
+        "text",
+        "tokens",
+        "prefixes",
+        "trigrams",
+        "name_prefixes",
+        "brand_prefixes",
+        "term_freqs",
+        "length",
+    )
+
+    def __init__(self, name, brand, packaging):
+        self.name = " ".join(tokenize(name))
+        self.text = " ".join(tokenize(f"{name or ''} {brand or ''} {packaging or ''}"))
+        self.tokens = frozenset(self.text.split())
+        self.prefixes = token_prefixes(self.tokens)
+        self.trigrams = frozenset().union(*(trigrams(t) for t in self.tokens))
+        self.name_prefixes = token_prefixes(self.name.split())
+        self.brand_prefixes = token_prefixes(tokenize(brand))
+
+        term_freqs = {}
+        for field, text in (("name", name), ("brand", brand), ("packaging", packaging)):
+            for token in tokenize(text):
+                term_freqs[token] = term_freqs.get(token, 0) + FIELD_WEIGHTS[field]
+        self.term_freqs = term_freqs
+        self.length = sum(term_freqs.values())
+
+
+@lru_cache(maxsize=20000)
+def _normalize(name, brand, packaging):
+    return NormalizedProduct(name, brand, packaging)
+
+
+def normalize_product(product):
+    """NormalizedProduct de un producto en bruto (memorizado por contenido)"""
+    return _normalize(
+        product.get("display_name") or "",
+        product.get("brand") or "",
+        product.get("packaging") or "",
+    )
+
+
+class NormalizedQuery:
+    """Query normalizada una vez: frase, palabras y sus trigramas interiores"""
+
+    def __init__(self, query):
+        self.words = tokenize(query)
+        self.phrase = " ".join(self.words)
+        self.word_set = frozenset(
+            word for word in self.words if len(word) >= MIN_PREFIX_LENGTH
+        )
+        # Trigramas sin marcas: la palabra puede estar en mitad de otra
+        self.infix_candidates = [
+            (word, frozenset(word[i : i + 3] for i in range(len(word) - 2)))
+            for word in self.word_set
+            if len(word) >= 3
+        ]
+
+
+@lru_cache(maxsize=1000)
+def parse_query(query):
+    return NormalizedQuery(query)
+
+
+def product_matches(product, query):
+    """
+    Mismos criterios que la búsqueda original, sobre campos precalculados:
+    1. la frase completa aparece en el producto
+    2. (varias palabras) aparece al menos el 70% de ellas
+    3. alguna palabra de 3+ letras coincide con una palabra del producto
+    """
+    if not product.text or not query.words:
+        return False
+
+    if query.phrase in product.text:
+        return True
+
+    # Con una sola palabra la frase ya cubre los criterios 2 y 3
+    if len(query.words) == 1:
+        return False
+
+    found = query.word_set & product.prefixes
+    for word, word_trigrams in query.infix_candidates:
+        # Los trigramas son de todas las palabras juntas: solo sirven para
+        # descartar; la palabra tiene que estar dentro de una de ellas
+        if (
+            word not in found
+            and word_trigrams <= product.trigrams
+            and any(word in token for token in product.tokens)
+        ):
+            found = found | {word}
+
+    if len(found) >= len(query.words) * 0.7:
+        return True
+    return any(len(word) >= 3 for word in found)
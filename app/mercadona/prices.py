@@ -0,0 +1,134 @@
+import logging
+import math
+from datetime import date, datetime, time, timedelta
+
+from pymongo import UpdateOne
+
+from app import mongo
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def price_point(product):
+    """(precio, precio anterior, rebajado) de un producto en bruto o None"""
+    info = (product or {}).get("price_instructions") or {}
+    try:
+        price = float(info.get("unit_price"))
+    except (TypeError, ValueError):
+        return None
+    try:
+        previous_price = float(info.get("previous_unit_price"))
+    except (TypeError, ValueError):
+        previous_price = None
+    return price, previous_price, bool(info.get("price_decreased", False))
+
+
+def downsample(rows, start, end, max_points):
+    """
+    Serie diaria escalonada entre `start` y `end` (cada día vale la última
+    fila anterior) agrupada en como mucho `max_points` tramos de días:
+    [{date, min, max, avg, last, discounted}]
+    """
+    days = (end - start).days + 1
+    if days <= 0 or max_points <= 0:
+        return []
+    bucket_days = math.ceil(days / max_points)
+
+    points = []
+    bucket = []
+    current = None
+    position = 0
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        while position < len(rows) and rows[position]["day"] <= day:
+            current = rows[position]
+            position += 1
+        if current is not None:
+            bucket.append(current)
+
+        if (offset + 1) % bucket_days and offset != days - 1:
+            continue
+        if bucket:
+            prices = [row["price"] for row in bucket]
+            points.append(
+                {
+                    "date": (day - timedelta(days=offset % bucket_days)).isoformat(),
+                    "min": min(prices),
+                    "max": max(prices),
+                    "avg": round(sum(prices) / len(prices), 2),
+                    "last": prices[-1],
+                    "discounted": any(row["is_discounted"] for row in bucket),
+                }
+            )
+        bucket = []
+    return points
+
+
+class PriceHistory:
+    """
+    Histórico de precios de Mercadona en la colección mercadona_price_history:
+    una fila por (producto, día), y solo los días en que el precio cambia.
+    Entre dos filas el precio es el de la anterior, así que la serie ocupa
+    lo mismo que el número de cambios de precio.
+    """
+
+    def record(self, points, now=None):
+        """Guardar [(id producto, price_point)] como precio del día de `now`"""
+        day = datetime.combine((now or datetime.now()).date(), time())
+        operations = []
+        for product_id, (price, previous_price, is_discounted) in points:
+            operations.append(
+                UpdateOne(
+                    {"_id": f"{product_id}:{day:%Y-%m-%d}"},
+                    {
+                        "$set": {
+                            "product_id": product_id,
+                            "day": day,
+                            "price": price,
+                            "previous_price": previous_price,
+                            "is_discounted": is_discounted,
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+        if operations:
+            mongo.db.mercadona_price_history.bulk_write(operations, ordered=False)
+            logger.info(f"💶 {len(operations)} cambios de precio registrados")
+        return len(operations)
+
+    def rows(self, product_id):
+        """Filas de un producto ordenadas por día (con `day` como date)"""
+        rows = [
+            dict(row, day=row["day"].date())
+            for row in mongo.db.mercadona_price_history.find(
+                {"product_id": str(product_id)},
+                {"_id": 0, "day": 1, "price": 1, "is_discounted": 1},
+            )
+        ]
+        rows.sort(key=lambda row: row["day"])
+        return rows
+
+    def history(self, product_id, days=90, max_points=60, current=None, today=None):
+        """
+        Serie reducida de los últimos `days` días. `current` (price_point del
+        catálogo) sirve de punto de partida si aún no hay filas guardadas
+        """
+        today = today or date.today()
+        rows = self.rows(product_id)
+        if not rows and current is not None:
+            rows = [{"day": today, "price": current[0], "is_discounted": current[2]}]
+
+        start = today - timedelta(days=days - 1)
+        return {
+            "product_id": str(product_id),
+            "from": start.isoformat(),
+            "to": today.isoformat(),
+            "changes": len(rows),
+            "points": downsample(rows, start, today, max_points),
+        }
+
+
+# Instancia global del histórico de precios
+price_history = PriceHistory()
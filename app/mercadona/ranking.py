@@ -0,0 +1,116 @@
+import math
+from collections import Counter
+
+# Peso de una palabra del producto que solo empieza por la de la query
+PREFIX_WEIGHT = 0.8
+
+# Peso máximo de una coincidencia aproximada (se reduce con cada error)
+FUZZY_WEIGHT = 0.7
+
+
+def max_edits(word):
+    """Errores tolerados según la longitud de la palabra"""
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 6:
+        return 1
+    return 2
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Distancia de Damerau-Levenshtein (transposiciones adyacentes) acotada:
+    devuelve max_distance + 1 en cuanto se sabe que la supera
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(
+                previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost
+            )
+            if (
+                previous_previous is not None
+                and i > 1
+                and j > 1
+                and a[i - 1] == b[j - 2]
+                and a[i - 2] == b[j - 1]
+            ):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def fuzzy_weight(word, distance):
+    """Peso de una palabra encontrada con `distance` errores"""
+    return FUZZY_WEIGHT * (1 - distance / (len(word) + 1))
+
+
+def prefix_expansions(word, terms):
+    """{palabra: peso} de las palabras de `terms` que empiezan por `word`"""
+    return {
+        term: 1.0 if term == word else PREFIX_WEIGHT
+        for term in terms
+        if term.startswith(word)
+    }
+
+
+class Bm25:
+    """
+    Puntuación BM25 sobre los campos normalizados de los productos.
+    `doc_freq(palabra)` da el nº de productos que la contienen; las
+    frecuencias de cada producto ya vienen ponderadas por campo (BM25F).
+    Cada palabra de la query aporta la mejor de sus expansiones
+    (exacta, prefijo o aproximada), multiplicada por su peso.
+    """
+
+    def __init__(self, doc_freq, n_docs, total_length, vocabulary=(), k1=1.2, b=0.75):
+        self.doc_freq = doc_freq
+        # Palabras conocidas, para expandir prefijos de la query
+        self.vocabulary = vocabulary
+        self.n_docs = max(n_docs, 1)
+        self.avg_length = (total_length / n_docs) if n_docs else 1.0
+        self.k1 = k1
+        self.b = b
+        self.idf_cache = {}
+
+    @classmethod
+    def from_products(cls, products):
+        """Estadísticas calculadas sobre una lista de NormalizedProduct"""
+        doc_freq = Counter()
+        total_length = 0
+        n_docs = 0
+        for product in products:
+            doc_freq.update(product.term_freqs.keys())
+            total_length += product.length
+            n_docs += 1
+        return cls(lambda term: doc_freq.get(term, 0), n_docs, total_length, doc_freq)
+
+    def idf(self, term):
+        idf = self.idf_cache.get(term)
+        if idf is None:
+            df = self.doc_freq(term)
+            idf = math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+            self.idf_cache[term] = idf
+        return idf
+
+    def score(self, product, expansions):
+        """expansions: una lista {palabra: peso} por cada palabra de la query"""
+        norm = self.k1 * (1 - self.b + self.b * product.length / self.avg_length)
+        total = 0.0
+        for weights in expansions:
+            best = 0.0
+            for term, tf in product.term_freqs.items():
+                weight = weights.get(term)
+                if weight:
+                    value = weight * self.idf(term) * tf * (self.k1 + 1) / (tf + norm)
+                    best = max(best, value)
+            total += best
+        return total
@@ -0,0 +1,67 @@
+import threading
+
+
+class _Call:
+    """Cálculo en curso para una clave"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Deduplicación de cálculos concurrentes: mientras hay uno en curso para
+    una clave, el resto de llamadas con esa clave esperan y reciben el mismo
+    resultado (o la misma excepción) en lugar de repetirlo.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.stats = {"executed": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key, fn):
+        """
+        Ejecutar fn() para `key` salvo que ya esté en curso.
+        Devuelve (resultado, compartido): compartido=True si se reutilizó
+        el cálculo de otra llamada.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            with self.lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.event.set()
+        return call.result, False
+
+    def get_stats(self):
+        with self.lock:
+            return {"in_flight": len(self.calls), **self.stats}
+
+
+# Instancias globales: búsquedas completas y descargas de subcategorías
+search_flight = SingleFlight()
+subcategory_flight = SingleFlight()
@@ -0,0 +1,101 @@
+import logging
+from urllib.parse import urlparse
+
+from app.http_client import FAILURE_STATUSES, http_client
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+MERCADONA_BASE_URL = "https://tienda.mercadona.es/api"
+MERCADONA_HOST = urlparse(MERCADONA_BASE_URL).netloc
+MERCADONA_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Language": "es-ES,es;q=0.8,en-US;q=0.5,en;q=0.3",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1",
+    "Sec-Fetch-Dest": "document",
+    "Sec-Fetch-Mode": "navigate",
+    "Sec-Fetch-Site": "none",
+    "Sec-Fetch-User": "?1",
+    "Cache-Control": "max-age=0",
+}
+
+
+# Mercadona responde 403 cuando nos bloquea: también abre el circuito.
+# El umbral supera los hilos del fetcher para que algún 403 suelto de una
+# subcategoría no lo abra
+http_client.configure_host(
+    MERCADONA_HOST,
+    failure_statuses=FAILURE_STATUSES | {403},
+    failure_threshold=10,
+    reset_seconds=60,
+)
+
+
+def mercadona_available():
+    """False mientras el circuito de Mercadona está abierto"""
+    return not http_client.breaker(MERCADONA_HOST).is_open()
+
+
+def mercadona_retry_in():
+    """Segundos hasta que se vuelva a probar Mercadona (0 si está cerrado)"""
+    return http_client.breaker(MERCADONA_HOST).retry_in()
+
+
+def extract_products(subcat_data):
+    """
+    Productos de la respuesta de /categories/<id>: los directos y los de
+    sus sub-subcategorías, descartando entradas vacías
+    """
+    products = []
+    for product in subcat_data.get("products", []):
+        if product and isinstance(product, dict):
+            products.append(product)
+
+    for sub_subcat in subcat_data.get("categories", []):
+        if sub_subcat and isinstance(sub_subcat, dict):
+            for product in sub_subcat.get("products", []):
+                if product and isinstance(product, dict):
+                    products.append(product)
+    return products
+
+
+def fetch_categories(session, timeout=15):
+    """Árbol de categorías de Mercadona (None si falla)"""
+    url = f"{MERCADONA_BASE_URL}/categories/?lang=es&wh=mad1"
+    try:
+        response = session.get(url, timeout=timeout)
+        if response.status_code != 200:
+            logger.error(f"❌ Error HTTP {response.status_code} obteniendo categorías")
+            return None
+        categories_data = response.json()
+    except Exception as e:
+        logger.error(f"❌ Error obteniendo categorías: {e}")
+        return None
+
+    if not categories_data.get("results"):
+        logger.error("❌ Respuesta de categorías sin 'results'")
+        return None
+    return categories_data
+
+
+def iter_subcategories(categories_data):
+    """(categoría, id, nombre) de cada subcategoría única del árbol"""
+    seen = set()
+    for category in categories_data.get("results", []):
+        for subcat in category.get("categories", []):
+            subcat_id = subcat.get("id")
+            if not subcat_id or subcat_id in seen:
+                continue
+            seen.add(subcat_id)
+            yield (category.get("name", ""), subcat_id, subcat.get("name", ""))
+
+
+def fetch_subcategory(session, subcat_id, timeout=10):
+    """Respuesta JSON de /categories/<id> (lanza excepción si falla)"""
+    url = f"{MERCADONA_BASE_URL}/categories/{subcat_id}/?lang=es&wh=mad1"
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
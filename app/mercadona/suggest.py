@@ -0,0 +1,98 @@
+import heapq
+from bisect import bisect_left
+
+from app.mercadona.normalize import tokenize
+
+# Máximo de sugerencias por petición
+SUGGEST_MAX = 20
+
+# Los prefijos de hasta estas letras tienen su resultado ya calculado
+SHORT_PREFIX = 2
+
+
+class SuggestIndex:
+    """
+    Índice de autocompletado sobre los nombres del catálogo: un array
+    ordenado con el nombre normalizado a partir de cada una de sus palabras
+    ("leche entera", "entera"), de modo que un prefijo es un rango que se
+    encuentra con bisect. Los prefijos cortos, cuyo rango es enorme, guardan
+    sus mejores resultados al construir el índice.
+    Es inmutable: el catálogo crea uno nuevo cada vez que cambia.
+    """
+
+    def __init__(self, names=()):
+        """names: pares (nombre del producto, id del producto)"""
+        self.names = []
+        self.ids = []
+        entries = []
+        seen = set()
+        for display_name, product_id in names:
+            if not display_name or display_name in seen:
+                continue
+            seen.add(display_name)
+            position = len(self.names)
+            self.names.append(display_name)
+            self.ids.append(product_id)
+
+            words = tokenize(display_name)
+            for start in range(len(words)):
+                # Antes los que empiezan por la palabra y los nombres cortos
+                rank = (start, len(display_name), display_name)
+                entries.append((" ".join(words[start:]), rank, position))
+        entries.sort()
+
+        self.keys = [key for key, _rank, _position in entries]
+        self.ranks = [rank for _key, rank, _position in entries]
+        self.positions = [position for _key, _rank, position in entries]
+
+        heads = {}
+        for key, rank, position in entries:
+            for end in range(1, min(SHORT_PREFIX, len(key)) + 1):
+                heads.setdefault(key[:end], []).append((rank, position))
+        self.heads = {
+            prefix: self._top(candidates, SUGGEST_MAX)
+            for prefix, candidates in heads.items()
+        }
+
+    @classmethod
+    def from_catalog(cls, index):
+        """Índice con los nombres de un CatalogIndex"""
+        return cls(
+            (entry[0].get("display_name"), entry[0].get("id"))
+            for entry in index.products.values()
+        )
+
+    @staticmethod
+    def _top(candidates, limit):
+        """Posiciones de los `limit` mejores nombres (una vez cada uno)"""
+        best = {}
+        for rank, position in candidates:
+            if position not in best or rank < best[position]:
+                best[position] = rank
+        top = heapq.nsmallest(
+            limit, ((rank, position) for position, rank in best.items())
+        )
+        return [position for _rank, position in top]
+
+    def suggest(self, prefix, limit=10):
+        """[{name, id}] de los mejores nombres que empiezan por `prefix`"""
+        prefix = " ".join(tokenize(prefix))
+        if not prefix:
+            return []
+        limit = max(1, min(limit, SUGGEST_MAX))
+
+        if len(prefix) <= SHORT_PREFIX:
+            positions = self.heads.get(prefix, [])[:limit]
+        else:
+            start = bisect_left(self.keys, prefix)
+            end = bisect_left(self.keys, prefix + "\uffff", start)
+            positions = self._top(
+                zip(self.ranks[start:end], self.positions[start:end]), limit
+            )
+        return [
+            {"name": self.names[position], "id": self.ids[position]}
+            for position in positions
+        ]
+
+    def __len__(self):
+        return len(self.names)
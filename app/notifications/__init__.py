@@ -0,0 +1,14 @@
+from app.notifications.dispatcher import (PushDispatcher, PushReport,
+                                          push_dispatcher)
+from app.notifications.metrics import PushMetrics, push_metrics
+from app.notifications.outbox import (COALESCE_TOPICS, OutboxWorker,
+                                      outbox_worker, queue_push_to_all,
+                                      queue_push_to_user)
+from app.notifications.pruning import (find_invalid_subscriptions,
+                                       prune_subscriptions,
+                                       remove_invalid_subscriptions)
+from app.notifications.ratelimit import DeviceRateLimiter, device_rate_limiter
+from app.notifications.service import send_push_to_all, send_push_to_user
+from app.notifications.subscriptions import (SubscriptionCache,
+                                             subscription_cache)
+from app.notifications.vapid import VapidSigner, get_vapid_signer
@@ -0,0 +1,160 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import requests
+from pywebpush import WebPushException, webpush
+from requests.adapters import HTTPAdapter
+
+from app.notifications.metrics import push_metrics
+from app.notifications.vapid import get_vapid_signer
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1024)
+def get_endpoint_origin(endpoint_url):
+    """Origen (scheme://host) de un endpoint push, cacheado por endpoint"""
+    parsed = urlparse(endpoint_url)
+    if not parsed.scheme or not parsed.netloc:
+        return None
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+class PushReport:
+    """
+    Resultado agregado de un envío masivo de notificaciones push
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        # Envíos descartados por el token bucket del dispositivo
+        self.throttled = 0
+        # Lista de (usuario, suscripción) que devolvieron 404/410
+        self.expired = []
+        self.duration_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "throttled": self.throttled,
+            "expired": len(self.expired),
+            "duration_seconds": round(self.duration_seconds, 3),
+        }
+
+
+class PushDispatcher:
+    """
+    Envío concurrente de notificaciones push con un pool de hilos acotado
+    y una sesión HTTP reutilizable por origen del endpoint (FCM, Mozilla...)
+    """
+
+    def __init__(self, max_workers=8, timeout=10):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="push"
+        )
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _get_session(self, origin):
+        """Obtener (o crear) la sesión HTTP asociada a un origen"""
+        with self.lock:
+            session = self.sessions.get(origin)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount("https://", adapter)
+                self.sessions[origin] = session
+            return session
+
+    def _send_one(self, user_name, sub, data, signer):
+        """Enviar una notificación a una suscripción concreta"""
+        origin = get_endpoint_origin(sub.get("endpoint"))
+        if not origin:
+            return "skipped"
+
+        start_time = time.monotonic()
+        try:
+            webpush(
+                subscription_info=sub,
+                data=data,
+                headers=signer.get_headers(origin),
+                timeout=self.timeout,
+                requests_session=self._get_session(origin),
+            )
+            logger.info(f"📲 Push enviado a {user_name}")
+            status = "sent"
+        except WebPushException as ex:
+            logger.error(f"❌ Error push a {user_name}: {repr(ex)}")
+            # Ojo: Response es "falsy" para códigos >= 400
+            if ex.response is not None and ex.response.status_code in [410, 404]:
+                status = "expired"
+            else:
+                status = "failed"
+        except Exception as e:
+            logger.error(f"❌ Error inesperado enviando push: {e}")
+            status = "failed"
+
+        push_metrics.record(origin, status, time.monotonic() - start_time)
+        return status
+
+    def dispatch(self, targets, payload, vapid_private_key, rate_limiter=None):
+        """
+        Enviar el mismo payload a todas las suscripciones de forma concurrente.
+        targets: iterable de tuplas (usuario, suscripción).
+        rate_limiter: DeviceRateLimiter opcional; los dispositivos sin tokens
+        no reciben este envío y se cuentan como `throttled`.
+        Devuelve un PushReport con el resultado agregado.
+        """
+        report = PushReport()
+        start_time = time.monotonic()
+        data = json.dumps(payload)
+        signer = get_vapid_signer(vapid_private_key)
+
+        futures = []
+        for user_name, sub in targets:
+            if not sub or not sub.get("endpoint"):
+                report.skipped += 1
+                continue
+            if rate_limiter and not rate_limiter.allow(sub["endpoint"]):
+                report.throttled += 1
+                continue
+            future = self.executor.submit(self._send_one, user_name, sub, data, signer)
+            futures.append((user_name, sub, future))
+
+        for user_name, sub, future in futures:
+            try:
+                status = future.result()
+            except Exception as e:
+                logger.error(f"❌ Error en worker de push: {e}")
+                status = "failed"
+
+            if status == "sent":
+                report.sent += 1
+            elif status == "expired":
+                report.failed += 1
+                report.expired.append((user_name, sub))
+            elif status == "skipped":
+                report.skipped += 1
+            else:
+                report.failed += 1
+
+        if report.throttled:
+            push_metrics.record_throttled(report.throttled)
+        report.duration_seconds = time.monotonic() - start_time
+        return report
+
+
+# Instancia global del dispatcher
+push_dispatcher = PushDispatcher(max_workers=8, timeout=10)
@@ -0,0 +1,111 @@
+import threading
+from collections import deque
+from datetime import datetime
+
+
+class PushMetrics:
+    """
+    Métricas en memoria del envío de notificaciones push:
+    contadores globales y latencia por origen del endpoint
+    """
+
+    def __init__(self, window_size=200):
+        self.window_size = window_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.sent = 0
+            self.failed = 0
+            self.expired = 0
+            self.pruned = 0
+            self.throttled = 0
+            self.coalesced = 0
+            self.online_skipped = 0
+            self.endpoints = {}
+            self.started_at = datetime.now()
+
+    def record(self, origin, status, elapsed_seconds):
+        """Registrar el resultado y la latencia de un envío individual"""
+        with self.lock:
+            if status == "sent":
+                self.sent += 1
+            elif status == "expired":
+                self.failed += 1
+                self.expired += 1
+            elif status == "failed":
+                self.failed += 1
+
+            stats = self.endpoints.get(origin)
+            if stats is None:
+                stats = {
+                    "count": 0,
+                    "errors": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "samples": deque(maxlen=self.window_size),
+                }
+                self.endpoints[origin] = stats
+
+            elapsed_ms = elapsed_seconds * 1000
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["samples"].append(elapsed_ms)
+            if status != "sent":
+                stats["errors"] += 1
+
+    def record_pruned(self, count):
+        with self.lock:
+            self.pruned += count
+
+    def record_throttled(self, count):
+        with self.lock:
+            self.throttled += count
+
+    def record_coalesced(self, count=1):
+        with self.lock:
+            self.coalesced += count
+
+    def record_online_skipped(self, count):
+        with self.lock:
+            self.online_skipped += count
+
+    @staticmethod
+    def _percentile(sorted_samples, percentile):
+        if not sorted_samples:
+            return 0.0
+        index = min(len(sorted_samples) - 1, int(len(sorted_samples) * percentile))
+        return sorted_samples[index]
+
+    def get_stats(self):
+        """Obtener un resumen serializable de las métricas"""
+        with self.lock:
+            endpoints = {}
+            for origin, stats in self.endpoints.items():
+                samples = sorted(stats["samples"])
+                endpoints[origin] = {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "avg_ms": round(stats["total_ms"] / max(stats["count"], 1), 2),
+                    "p50_ms": round(self._percentile(samples, 0.5), 2),
+                    "p95_ms": round(self._percentile(samples, 0.95), 2),
+                    "max_ms": round(stats["max_ms"], 2),
+                }
+
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "expired": self.expired,
+                "pruned": self.pruned,
+                "throttled": self.throttled,
+                "coalesced": self.coalesced,
+                "online_skipped": self.online_skipped,
+                "since": self.started_at.isoformat(),
+                "endpoints": endpoints,
+            }
+
+
+# Instancia global de métricas
+push_metrics = PushMetrics(window_size=200)
@@ -0,0 +1,266 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+
+from app import mongo
+from app.notifications.metrics import push_metrics
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_ICON = "/static/icons/house-icon.png"
+
+
+# Temas que se agrupan: los eventos de un mismo (destino, tema) dentro de la
+# ventana se fusionan en una única notificación resumen
+COALESCE_TOPICS = {
+    "chat": {
+        "window_seconds": 30,
+        "title": "💬 Chat familiar",
+        "summary": "{count} mensajes nuevos en el chat",
+    },
+    "shopping": {
+        "window_seconds": 60,
+        "title": "🛒 Lista de la compra",
+        "summary": "{count} cambios nuevos en la lista de la compra",
+    },
+}
+
+
+def _next_slot(target, user, topic, window_seconds, now):
+    """
+    Primer momento en que puede salir la siguiente notificación del tema:
+    inmediatamente si no se despachó ninguna en la ventana, o al final de ella
+    """
+    last = mongo.db.notification_outbox.find_one(
+        {
+            "target": target,
+            "user": user,
+            "topic": topic,
+            "status": {"$in": ["processing", "sent"]},
+            "dispatched_at": {"$gte": now - timedelta(seconds=window_seconds)},
+        },
+        {"dispatched_at": 1},
+        sort=[("dispatched_at", -1)],
+    )
+    if not last:
+        return now
+    return last["dispatched_at"] + timedelta(seconds=window_seconds)
+
+
+def _coalesce(target, user, topic, payload, now):
+    """Fusionar con la notificación pendiente del mismo tema, si existe"""
+    return mongo.db.notification_outbox.find_one_and_update(
+        {"status": "pending", "target": target, "user": user, "topic": topic},
+        {
+            "$inc": {"count": 1},
+            "$set": {"payload": payload, "updated_at": now},
+        },
+    )
+
+
+def _enqueue(target, user, title, body, url, icon, topic=None, skip_online=None):
+    """
+    Insertar una notificación pendiente en la colección notification_outbox.
+    skip_online: sala cuyos usuarios conectados no reciben el push; se evalúa
+    al entregar, no al encolar
+    """
+    try:
+        now = datetime.now()
+        payload = {"title": title, "body": body, "url": url, "icon": icon}
+        config = COALESCE_TOPICS.get(topic)
+
+        next_attempt_at = now
+        if config:
+            if _coalesce(target, user, topic, payload, now):
+                push_metrics.record_coalesced()
+                return True
+            next_attempt_at = _next_slot(
+                target, user, topic, config["window_seconds"], now
+            )
+
+        mongo.db.notification_outbox.insert_one(
+            {
+                "target": target,
+                "user": user,
+                "topic": topic,
+                "skip_online": skip_online,
+                "count": 1,
+                "payload": payload,
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+                "next_attempt_at": next_attempt_at,
+            }
+        )
+        outbox_worker.notify()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error encolando notificación: {e}")
+        return False
+
+
+def build_delivery_payload(entry):
+    """Payload a entregar: el último evento o un resumen si se agruparon varios"""
+    payload = dict(entry.get("payload", {}))
+    count = entry.get("count", 1)
+    config = COALESCE_TOPICS.get(entry.get("topic"))
+    if config and count > 1:
+        payload["title"] = config["title"]
+        payload["body"] = config["summary"].format(count=count)
+    return payload
+
+
+def queue_push_to_all(
+    title, body, url="/", icon=DEFAULT_ICON, topic=None, skip_online=None
+):
+    """Encolar una notificación push para todos los usuarios suscritos"""
+    return _enqueue("all", None, title, body, url, icon, topic, skip_online)
+
+
+def queue_push_to_user(
+    user_name, title, body, url="/", icon=DEFAULT_ICON, topic=None, skip_online=None
+):
+    """Encolar una notificación push para un usuario concreto"""
+    return _enqueue("user", user_name, title, body, url, icon, topic, skip_online)
+
+
+class OutboxWorker:
+    """
+    Worker en segundo plano que entrega las notificaciones de notification_outbox.
+    Cada entrada se reclama de forma atómica con un lease, de modo que si el
+    proceso muere a mitad de envío la notificación se reintenta al expirar.
+    """
+
+    def __init__(self, poll_interval=5, lease_seconds=60, max_attempts=5):
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.app = None
+        self.thread = None
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+
+    def start(self, app):
+        """Arrancar el hilo de entrega (una sola vez por proceso)"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.app = app
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self._run, name="notification-outbox", daemon=True
+        )
+        self.thread.start()
+        logger.info("📬 Worker de notificaciones iniciado")
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def notify(self):
+        """Despertar al worker tras encolar una notificación"""
+        self.wake_event.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            processed = 0
+            try:
+                with self.app.app_context():
+                    processed = self.process_pending()
+            except Exception as e:
+                logger.error(f"❌ Error en worker de notificaciones: {e}")
+
+            if not processed:
+                self.wake_event.wait(self.poll_interval)
+                self.wake_event.clear()
+
+    def _claim(self):
+        """Reclamar la siguiente notificación pendiente (o con lease caducado)"""
+        now = datetime.now()
+        return mongo.db.notification_outbox.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    {"status": "processing", "locked_until": {"$lte": now}},
+                ]
+            },
+            {
+                "$set": {
+                    "status": "processing",
+                    "locked_until": now + timedelta(seconds=self.lease_seconds),
+                    "dispatched_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _deliver(self, entry):
+        """
+        Entregar una notificación. Lanza excepción (y se reintenta) si no
+        llegó a ningún dispositivo por fallos que no sean suscripciones
+        caducadas o porque el token bucket los limitó todos
+        """
+        from app.notifications.service import deliver_push
+
+        user_name = entry.get("user") if entry.get("target") == "user" else None
+        report = deliver_push(
+            user_name,
+            build_delivery_payload(entry),
+            entry.get("skip_online"),
+            entry.get("topic"),
+        )
+        failed = report.failed - len(report.expired)
+        if (failed or report.throttled) and not report.sent:
+            raise RuntimeError(
+                f"Ningún envío entregado ({failed} fallidos, "
+                f"{report.throttled} limitados)"
+            )
+        return report
+
+    def process_pending(self, limit=50):
+        """Entregar hasta `limit` notificaciones pendientes. Devuelve cuántas procesó"""
+        processed = 0
+        while processed < limit:
+            entry = self._claim()
+            if not entry:
+                break
+            processed += 1
+
+            try:
+                self._deliver(entry)
+                mongo.db.notification_outbox.update_one(
+                    {"_id": entry["_id"]},
+                    {
+                        "$set": {"status": "sent", "sent_at": datetime.now()},
+                        "$unset": {"locked_until": ""},
+                    },
+                )
+            except Exception as e:
+                attempts = entry.get("attempts", 1)
+                failed = attempts >= self.max_attempts
+                logger.error(
+                    f"❌ Error entregando notificación {entry['_id']} "
+                    f"(intento {attempts}): {e}"
+                )
+                mongo.db.notification_outbox.update_one(
+                    {"_id": entry["_id"]},
+                    {
+                        "$set": {
+                            "status": "failed" if failed else "pending",
+                            "last_error": str(e),
+                            "next_attempt_at": datetime.now()
+                            + timedelta(seconds=2**attempts),
+                        },
+                        "$unset": {"locked_until": ""},
+                    },
+                )
+
+        return processed
+
+
+# Instancia global del worker
+outbox_worker = OutboxWorker(poll_interval=5, lease_seconds=60, max_attempts=5)
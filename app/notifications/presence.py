@@ -0,0 +1,76 @@
+import threading
+
+from app.globals import socket_presence, user_sockets
+
+# Sala del chat familiar: quien la tiene abierta ya recibe los mensajes por socket
+CHAT_ROOM = "chat"
+
+presence_lock = threading.Lock()
+
+
+def register_socket(user, sid):
+    """Registrar un socket conectado de un usuario"""
+    user = user.lower()
+    with presence_lock:
+        user_sockets.setdefault(user, set()).add(sid)
+        socket_presence[sid] = {"user": user, "rooms": set()}
+
+
+def join_room_presence(sid, room):
+    """Marcar que un socket se ha unido a una sala"""
+    with presence_lock:
+        presence = socket_presence.get(sid)
+        if presence:
+            presence["rooms"].add(room)
+
+
+def unregister_socket(sid):
+    """Olvidar un socket desconectado. Devuelve el usuario al que pertenecía"""
+    with presence_lock:
+        presence = socket_presence.pop(sid, None)
+        if not presence:
+            return None
+        user = presence["user"]
+        sids = user_sockets.get(user)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del user_sockets[user]
+        return user
+
+
+def unregister_user(user):
+    """Olvidar todos los sockets de un usuario (logout). Devuelve sus sids"""
+    user = (user or "").lower()
+    with presence_lock:
+        sids = user_sockets.pop(user, set())
+        for sid in sids:
+            socket_presence.pop(sid, None)
+        return list(sids)
+
+
+def get_user_sids(user):
+    with presence_lock:
+        return list(user_sockets.get((user or "").lower(), ()))
+
+
+def is_online(user, room=None):
+    """
+    True si el usuario tiene algún socket vivo (en `room`, si se indica).
+    Con room=None basta con cualquier socket conectado.
+    """
+    with presence_lock:
+        sids = user_sockets.get((user or "").lower())
+        if not sids:
+            return False
+        if room is None:
+            return True
+        return any(
+            room in socket_presence.get(sid, {}).get("rooms", ()) for sid in sids
+        )
+
+
+def online_users(room=None):
+    with presence_lock:
+        users = list(user_sockets.keys())
+    return [user for user in users if is_online(user, room)]
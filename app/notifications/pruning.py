@@ -0,0 +1,82 @@
+import logging
+
+from pymongo import UpdateOne
+
+from app import mongo
+from app.notifications.dispatcher import get_endpoint_origin
+from app.notifications.metrics import push_metrics
+from app.notifications.subscriptions import subscription_cache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def prune_subscriptions(expired):
+    """
+    Eliminar en un único bulk_write las suscripciones caducadas.
+    expired: iterable de tuplas (usuario, suscripción) o (usuario, endpoint).
+    Devuelve el número de documentos modificados.
+    """
+    endpoints_by_user = {}
+    for user_name, sub in expired:
+        endpoint = sub.get("endpoint") if isinstance(sub, dict) else sub
+        if endpoint:
+            endpoints_by_user.setdefault(user_name, set()).add(endpoint)
+
+    if not endpoints_by_user:
+        return 0
+
+    operations = [
+        UpdateOne(
+            {"user": user_name},
+            {"$pull": {"subscriptions": {"endpoint": {"$in": sorted(endpoints)}}}},
+        )
+        for user_name, endpoints in endpoints_by_user.items()
+    ]
+
+    try:
+        result = mongo.db.subscriptions.bulk_write(operations, ordered=False)
+        total = sum(len(endpoints) for endpoints in endpoints_by_user.values())
+        push_metrics.record_pruned(total)
+        subscription_cache.invalidate()
+        logger.info(f"🧹 {total} suscripciones expiradas eliminadas")
+        return result.modified_count
+    except Exception as e:
+        logger.error(f"❌ Error eliminando suscripciones expiradas: {e}")
+        return 0
+
+
+def find_invalid_subscriptions():
+    """Suscripciones sin endpoint o con un endpoint no válido (sin red)"""
+    invalid = []
+    for sub_doc in mongo.db.subscriptions.find({}, {"user": 1, "subscriptions": 1}):
+        user_name = sub_doc.get("user")
+        for sub in sub_doc.get("subscriptions", []):
+            endpoint = sub.get("endpoint") if isinstance(sub, dict) else None
+            if not endpoint or not get_endpoint_origin(endpoint):
+                invalid.append((user_name, sub))
+    return invalid
+
+
+def remove_invalid_subscriptions(invalid):
+    """Eliminar suscripciones sin endpoint válido con un único bulk_write"""
+    endpoints_by_user = {}
+    for user_name, sub in invalid:
+        endpoint = sub.get("endpoint") if isinstance(sub, dict) else None
+        # None en $in también casa con suscripciones sin endpoint
+        endpoints_by_user.setdefault(user_name, set()).add(endpoint or None)
+
+    operations = [
+        UpdateOne(
+            {"user": user_name},
+            {"$pull": {"subscriptions": {"endpoint": {"$in": list(endpoints)}}}},
+        )
+        for user_name, endpoints in endpoints_by_user.items()
+    ]
+    if not operations:
+        return 0
+
+    mongo.db.subscriptions.bulk_write(operations, ordered=False)
+    push_metrics.record_pruned(len(invalid))
+    subscription_cache.invalidate()
+    return len(invalid)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class DeviceRateLimiter:
+    """
+    Token bucket por dispositivo (endpoint push): cada endpoint dispone de
+    `burst` envíos inmediatos y recupera `rate_per_minute` tokens por minuto.
+    Evita que una ráfaga de eventos acabe en throttling del servicio push.
+    """
+
+    def __init__(self, rate_per_minute=6, burst=3, idle_seconds=3600):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.idle_seconds = idle_seconds
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.last_cleanup = time.monotonic()
+
+    def allow(self, endpoint, now=None):
+        """Consumir un token del endpoint. Devuelve False si está limitado"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated_at = self.buckets.get(endpoint, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate_per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[endpoint] = (tokens, now)
+
+            if now - self.last_cleanup > self.idle_seconds:
+                self._cleanup(now)
+            return allowed
+
+    def _cleanup(self, now):
+        """Olvidar los buckets de endpoints inactivos (ya estarían llenos)"""
+        self.buckets = {
+            endpoint: bucket
+            for endpoint, bucket in self.buckets.items()
+            if now - bucket[1] < self.idle_seconds
+        }
+        self.last_cleanup = now
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "devices": len(self.buckets),
+                "rate_per_minute": round(self.rate_per_second * 60, 2),
+                "burst": self.burst,
+            }
+
+
+# Instancia global del limitador por dispositivo
+device_rate_limiter = DeviceRateLimiter(rate_per_minute=6, burst=3)
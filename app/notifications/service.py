@@ -0,0 +1,116 @@
+import logging
+
+from flask import current_app
+
+from app.notifications.dispatcher import PushReport, push_dispatcher
+from app.notifications.metrics import push_metrics
+from app.notifications.outbox import COALESCE_TOPICS
+from app.notifications.presence import is_online
+from app.notifications.pruning import prune_subscriptions
+from app.notifications.ratelimit import device_rate_limiter
+from app.notifications.subscriptions import subscription_cache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_ICON = "/static/icons/house-icon.png"
+
+
+def build_payload(title, body, url="/", icon=DEFAULT_ICON):
+    """Payload común para todas las notificaciones push"""
+    return {"title": title, "body": body, "icon": icon, "badge": icon, "url": url}
+
+
+def _filter_online(targets, skip_online):
+    """
+    Quitar los destinatarios con un socket vivo en la sala `skip_online`
+    ("any" = cualquier socket): ya recibieron el evento por Socket.IO
+    """
+    if not skip_online:
+        return targets
+    room = None if skip_online == "any" else skip_online
+    offline = [
+        (user_name, sub) for user_name, sub in targets if not is_online(user_name, room)
+    ]
+    skipped = len(targets) - len(offline)
+    if skipped:
+        push_metrics.record_online_skipped(skipped)
+        logger.info(f"🟢 {skipped} envíos omitidos (usuarios conectados por socket)")
+    return offline
+
+
+def _send(targets, payload, topic=None):
+    """
+    Enviar y limpiar las suscripciones caducadas. Solo los temas que se
+    agrupan (chat, compra) pasan por el token bucket de cada dispositivo
+    """
+    vapid_private_key = current_app.config.get("VAPID_PRIVATE_KEY")
+    if not vapid_private_key:
+        raise RuntimeError("VAPID_PRIVATE_KEY no configurada")
+
+    rate_limiter = device_rate_limiter if topic in COALESCE_TOPICS else None
+    report = push_dispatcher.dispatch(
+        targets, payload, vapid_private_key, rate_limiter=rate_limiter
+    )
+
+    # Limpiar suscripciones inválidas en un único bulk_write
+    prune_subscriptions(report.expired)
+    return report
+
+
+def deliver_push(user_name, payload, skip_online=None, topic=None):
+    """
+    Envío para el worker del outbox (user_name=None: a todos). A diferencia
+    de send_push_to_*, no captura errores y, si no hay a quién enviar,
+    devuelve un PushReport vacío en lugar de None
+    """
+    if user_name is None:
+        targets = subscription_cache.all_targets()
+    else:
+        targets = subscription_cache.get_user(user_name)
+    targets = _filter_online(targets, skip_online)
+    if not targets:
+        return PushReport()
+    return _send(targets, build_payload(**payload), topic)
+
+
+def send_push_to_all(title, body, url="/", icon=DEFAULT_ICON, skip_online=None):
+    """
+    Enviar notificación push a todos los usuarios suscritos.
+    skip_online: sala ("chat", "any"...) cuyos usuarios conectados no reciben push
+    """
+    try:
+        targets = _filter_online(subscription_cache.all_targets(), skip_online)
+        report = _send(targets, build_payload(title, body, url, icon))
+        if report:
+            logger.info(
+                f"📊 Total notificaciones enviadas: {report.sent} "
+                f"({report.failed} fallidas, {report.duration_seconds:.2f}s)"
+            )
+        return report
+    except Exception as e:
+        logger.error(f"❌ Error en send_push_to_all: {e}")
+        return None
+
+
+def send_push_to_user(
+    user_name, title, body, url="/", icon=DEFAULT_ICON, skip_online=None
+):
+    """Enviar notificación push a un usuario específico"""
+    try:
+        targets = subscription_cache.get_user(user_name)
+        if not targets:
+            logger.warning(f"No hay suscripciones para {user_name}")
+            return None
+
+        targets = _filter_online(targets, skip_online)
+        if not targets:
+            return None
+
+        report = _send(targets, build_payload(title, body, url, icon))
+        if report and report.sent:
+            logger.info(f"✅ Notificación enviada a {user_name}")
+        return report
+    except Exception as e:
+        logger.error(f"❌ Error en send_push_to_user: {e}")
+        return None
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+from app import mongo
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionCache:
+    """
+    Caché en memoria de la colección subscriptions (usuario -> suscripciones).
+    Se invalida explícitamente al guardar/eliminar suscripciones o usuarios;
+    el TTL solo cubre cambios hechos por otros procesos.
+    """
+
+    def __init__(self, ttl_seconds=300):
+        self.ttl_seconds = ttl_seconds
+        self.by_user = None
+        self.loaded_at = 0.0
+        self.lock = threading.RLock()
+
+    def _load(self):
+        by_user = {}
+        for sub_doc in mongo.db.subscriptions.find({}, {"user": 1, "subscriptions": 1}):
+            user_name = sub_doc.get("user", "Unknown")
+            by_user.setdefault(user_name, []).extend(sub_doc.get("subscriptions", []))
+        self.by_user = by_user
+        self.loaded_at = time.monotonic()
+        logger.info(f"🔄 Caché de suscripciones cargada ({len(by_user)} usuarios)")
+
+    def _ensure_loaded(self):
+        if self.by_user is None or time.monotonic() - self.loaded_at > self.ttl_seconds:
+            self._load()
+
+    def get_user(self, user_name):
+        """Suscripciones de un usuario como lista de (usuario, suscripción)"""
+        with self.lock:
+            self._ensure_loaded()
+            return [(user_name, sub) for sub in self.by_user.get(user_name, [])]
+
+    def all_targets(self):
+        """Todas las suscripciones como lista de (usuario, suscripción)"""
+        with self.lock:
+            self._ensure_loaded()
+            return [
+                (user_name, sub)
+                for user_name, subs in self.by_user.items()
+                for sub in subs
+            ]
+
+    def invalidate(self):
+        with self.lock:
+            self.by_user = None
+
+    def get_stats(self):
+        with self.lock:
+            if self.by_user is None:
+                return {"loaded": False, "users": 0, "subscriptions": 0}
+            return {
+                "loaded": True,
+                "users": len(self.by_user),
+                "subscriptions": sum(len(s) for s in self.by_user.values()),
+                "age_seconds": round(time.monotonic() - self.loaded_at, 1),
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+
+# Instancia global de la caché de suscripciones
+subscription_cache = SubscriptionCache(ttl_seconds=300)
@@ -0,0 +1,64 @@
+import logging
+import os
+import threading
+import time
+
+from py_vapid import Vapid
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+VAPID_SUB = "mailto:joso.jmf@gmail.com"
+
+# Los push services aceptan un 'exp' de hasta 24h; firmamos para 12h
+# y renovamos la cabecera con margen antes de que caduque
+VAPID_TOKEN_TTL = 12 * 60 * 60
+VAPID_REFRESH_MARGIN = 60 * 60
+
+
+class VapidSigner:
+    """
+    Firmador VAPID que carga la clave privada una sola vez y cachea la
+    cabecera Authorization ya firmada por cada 'aud' (origen del push service)
+    """
+
+    def __init__(self, private_key, sub=VAPID_SUB):
+        if os.path.isfile(private_key):
+            self.vapid = Vapid.from_file(private_key_file=private_key)
+        else:
+            self.vapid = Vapid.from_string(private_key=private_key)
+        self.sub = sub
+        self.headers_cache = {}
+        self.lock = threading.Lock()
+
+    def get_headers(self, aud):
+        """Obtener las cabeceras VAPID firmadas para un origen"""
+        now = int(time.time())
+        with self.lock:
+            cached = self.headers_cache.get(aud)
+            if cached and cached[1] - VAPID_REFRESH_MARGIN > now:
+                return dict(cached[0])
+
+            exp = now + VAPID_TOKEN_TTL
+            headers = self.vapid.sign({"aud": aud, "sub": self.sub, "exp": exp})
+            self.headers_cache[aud] = (headers, exp)
+            logger.debug(f"🔏 Cabecera VAPID firmada para {aud}")
+            return dict(headers)
+
+    def clear(self):
+        with self.lock:
+            self.headers_cache.clear()
+
+
+_signers = {}
+_signers_lock = threading.Lock()
+
+
+def get_vapid_signer(private_key):
+    """Obtener el firmador asociado a una clave privada (se crea una sola vez)"""
+    with _signers_lock:
+        signer = _signers.get(private_key)
+        if signer is None:
+            signer = VapidSigner(private_key)
+            _signers[private_key] = signer
+        return signer
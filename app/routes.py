@@ -1,24 +1,32 @@
+import base64
 import hashlib
 import json
 import logging
 import os
 import re
-import threading
 import traceback
-from collections import OrderedDict
 from datetime import datetime, timedelta
 from functools import wraps
 
 import requests
 from bson import ObjectId
 from ddgs import DDGS
-from flask import (Blueprint, current_app, flash, jsonify, redirect,
-                   render_template, request, session, url_for)
-# Retry
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+from flask import (Blueprint, Response, current_app, flash, jsonify, redirect,
+                   render_template, request, session, stream_with_context,
+                   url_for)
 
 from app import mongo
+from app.avatars import AVATAR_SIZES, avatar_cache, avatar_url
+from app.data import count_tasks, find_user, find_user_by_id, find_users
+from app.http_client import http_client
+from app.mercadona import (MERCADONA_BASE_URL, MERCADONA_HEADERS, Bm25,
+                           extract_products, fetch_categories,
+                           mercadona_available, mercadona_cache,
+                           mercadona_retry_in, normalize_product, parse_query,
+                           prefix_expansions, price_history, price_point,
+                           product_catalog, product_matches, search_cache,
+                           search_flight, subcategory_fetcher,
+                           subcategory_flight, tokenize)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -26,12 +34,6 @@ logger = logging.getLogger(__name__)
 
 main = Blueprint("main", __name__)
 
-# Configuración de retry para requests
-retry_strategy = Retry(
-    total=3, backoff_factor=1, status_forcelist=[408, 429, 500, 502, 503, 504]
-)
-adapter = HTTPAdapter(max_retries=retry_strategy)
-
 
 # ==========================================
 # Decorador para autenticación
@@ -53,7 +55,7 @@ def get_comprehensive_family_data():
     """Obtener todos los datos familiares de la base de datos"""
     try:
         # 1. Usuarios y su estado
-        users = list(mongo.db.users.find())
+        users = find_users("user_with_tasks")
         users_info = []
         total_tasks = 0
 
@@ -271,9 +273,10 @@ def get_food_image(food_name):
     """
     Obtener imagen de comida usando DuckDuckGo
     """
-    try:
+
+    def search_images():
         with DDGS() as ddgs:
-            results = list(
+            return list(
                 ddgs.images(
                     keywords=f"{food_name} food recipe",
                     region="es-es",
@@ -282,8 +285,12 @@ def get_food_image(food_name):
                     max_results=1,
                 )
             )
-            if results:
-                return results[0].get("image", "/static/img/default_food.jpg")
+
+    try:
+        # DDGS usa su propio cliente: se comparten el breaker y las métricas
+        results = http_client.call("duckduckgo.com", search_images)
+        if results:
+            return results[0].get("image", "/static/img/default_food.jpg")
     except Exception as e:
         logger.error(f"Error get_food_image: {e}")
 
@@ -306,126 +313,6 @@ def get_fecha_real_desde_dia_semana(dia_nombre):
         return datetime.now().strftime("%Y-%m-%d")
 
 
-# ==========================================
-# Cache de categorías de Mercadona
-# ==========================================
-class SearchCache:
-    """
-    Sistema de caché inteligente para búsquedas de productos
-    con TTL, LRU y limpieza automática
-    """
-
-    def __init__(self, max_size=500, ttl_minutes=30):
-        self.max_size = max_size
-        self.ttl_seconds = ttl_minutes * 60
-        self.cache = OrderedDict()
-        self.access_times = {}
-        self.lock = threading.RLock()
-
-    def _generate_key(self, query, filters=None):
-        """Generar clave única para la búsqueda"""
-        key_data = f"{query.lower().strip()}"
-        if filters:
-            key_data += f"_filters_{str(sorted(filters.items()))}"
-        return hashlib.md5(key_data.encode()).hexdigest()
-
-    def _is_expired(self, timestamp):
-        """Verificar si una entrada ha expirado"""
-        return (datetime.now() - timestamp).total_seconds() > self.ttl_seconds
-
-    def _cleanup_expired(self):
-        """Limpiar entradas expiradas"""
-        current_time = datetime.now()
-        expired_keys = []
-
-        for key, (_, timestamp) in self.cache.items():
-            if self._is_expired(timestamp):
-                expired_keys.append(key)
-
-        for key in expired_keys:
-            self.cache.pop(key, None)
-            self.access_times.pop(key, None)
-
-    def get(self, query, filters=None):
-        """Obtener resultado de caché si existe y no ha expirado"""
-        with self.lock:
-            key = self._generate_key(query, filters)
-
-            if key in self.cache:
-                data, timestamp = self.cache[key]
-
-                if not self._is_expired(timestamp):
-                    # Mover al final (LRU)
-                    self.cache.move_to_end(key)
-                    self.access_times[key] = datetime.now()
-
-                    logger.info(f"🎯 Cache HIT para búsqueda: '{query}'")
-                    return data
-                else:
-                    # Eliminar entrada expirada
-                    del self.cache[key]
-                    self.access_times.pop(key, None)
-                    logger.info(f"⏰ Cache EXPIRED para búsqueda: '{query}'")
-
-            logger.info(f"💥 Cache MISS para búsqueda: '{query}'")
-            return None
-
-    def set(self, query, data, filters=None):
-        """Guardar resultado en caché"""
-        with self.lock:
-            key = self._generate_key(query, filters)
-            current_time = datetime.now()
-
-            # Limpiar expirados antes de añadir
-            self._cleanup_expired()
-
-            # Si la caché está llena, eliminar el menos usado (LRU)
-            if len(self.cache) >= self.max_size:
-                oldest_key = next(iter(self.cache))
-                del self.cache[oldest_key]
-                self.access_times.pop(oldest_key, None)
-                logger.info(f"🗑️ Cache LRU eliminación: {oldest_key}")
-
-            self.cache[key] = (data, current_time)
-            self.access_times[key] = current_time
-
-            logger.info(
-                f"💾 Cache SAVE para búsqueda: '{query}' ({len(data.get('products', []))} productos)"
-            )
-
-    def clear(self):
-        """Limpiar toda la caché"""
-        with self.lock:
-            self.cache.clear()
-            self.access_times.clear()
-            logger.info("🧹 Cache completamente limpiada")
-
-    def get_stats(self):
-        """Obtener estadísticas de la caché"""
-        with self.lock:
-            self._cleanup_expired()
-
-            total_entries = len(self.cache)
-            memory_usage = sum(len(str(data)) for data, _ in self.cache.values())
-
-            return {
-                "total_entries": total_entries,
-                "max_size": self.max_size,
-                "memory_usage_bytes": memory_usage,
-                "ttl_minutes": self.ttl_seconds // 60,
-                "oldest_entry": (
-                    min(self.access_times.values()) if self.access_times else None
-                ),
-                "newest_entry": (
-                    max(self.access_times.values()) if self.access_times else None
-                ),
-            }
-
-
-# Instancia global de caché
-search_cache = SearchCache(max_size=500, ttl_minutes=30)
-
-
 # ==========================================
 # Rutas principales
 # ==========================================
@@ -455,14 +342,14 @@ def service_worker():
 def index():
     """Página principal con usuarios"""
     try:
-        users = list(mongo.db.users.find())
+        users = find_users("user_summary")
         vapid_public_key = current_app.config.get("VAPID_PUBLIC_KEY", "")
 
         # Estadísticas básicas
         stats = {
             "total_users": len(users),
             "users_at_home": len([u for u in users if u.get("encasa", False)]),
-            "total_tasks": sum(len(u.get("tareas", [])) for u in users),
+            "total_tasks": count_tasks(),
         }
 
         return render_template(
@@ -473,19 +360,12 @@ def index():
         return "Error interno del servidor", 500
 
 
-# ==========================================
-# Caché de 2 mins
-# ==========================================
-_mercadona_categories_cache = {"data": None, "timestamp": None}
-_CATEGORIES_CACHE_TTL = 120  # segundos
-
-
 @main.route("/users_cards")
 @login_required
 def users_cards():
     """Fragmento HTMX para las tarjetas de usuarios"""
     try:
-        users = list(mongo.db.users.find())
+        users = find_users("user_summary")
         return render_template("components/cards_fragment.html", users=users)
     except Exception as e:
         logger.error(f"Error users_cards: {e}")
@@ -497,7 +377,7 @@ def users_cards():
 def user_card(user_id):
     """Tarjeta individual de usuario"""
     try:
-        user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
+        user = find_user_by_id(user_id)
         if not user:
             return "Usuario no encontrado", 404
         return render_template("components/user_card.html", user=user)
@@ -511,7 +391,7 @@ def user_card(user_id):
 def tareas():
     """Página de gestión de tareas"""
     try:
-        users = list(mongo.db.users.find())
+        users = find_users("user_with_tasks")
         for user in users:
             user["_id"] = str(user["_id"])
             # Ordenar tareas por fecha de vencimiento
@@ -589,7 +469,7 @@ def add_task():
             return jsonify({"error": "Faltan campos obligatorios para la tarea"}), 400
 
         # Buscar usuario por nombre
-        user = mongo.db.users.find_one({"nombre": asignee})
+        user = find_user({"nombre": asignee}, "user_names")
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
 
@@ -625,7 +505,7 @@ def add_task():
 @login_required
 def calendario():
     try:
-        users = list(mongo.db.users.find())
+        users = find_users("user_with_tasks")
         for user in users:
             user["_id"] = str(user["_id"])
 
@@ -723,7 +603,7 @@ def mostrar_menus():
                     "asignado": asignado,
                 }
 
-        users = list(mongo.db.users.find({}, {"nombre": 1}))
+        users = find_users("user_names")
 
         # Estadísticas de menús
         total_menus = sum(
@@ -830,7 +710,7 @@ def asignar_comida():
             return jsonify({"error": "Faltan campos obligatorios"}), 400
 
         # Verificar que el usuario existe
-        user = mongo.db.users.find_one({"nombre": miembro})
+        user = find_user({"nombre": miembro}, "user_names")
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
 
@@ -923,7 +803,7 @@ def configuracion():
     """Página de configuración"""
     try:
         # Obtener todos los usuarios
-        users = list(mongo.db.users.find())
+        users = find_users("user_summary")
         for user in users:
             user["_id"] = str(user["_id"])
 
@@ -1016,12 +896,15 @@ def configuracion():
 def chat():
     """Página de chat familiar"""
     try:
-        # Recuperar últimos mensajes
-        messages = list(mongo.db.messages.find().sort("timestamp", -1).limit(50))
+        # Recuperar últimos mensajes (sin la foto: se resuelve por caché)
+        messages = list(
+            mongo.db.messages.find({}, {"photo": 0}).sort("timestamp", -1).limit(50)
+        )
         messages.reverse()
 
         for m in messages:
             m["_id"] = str(m["_id"])
+            m["photo"] = avatar_cache.get_url(m.get("user"))
             if m.get("timestamp"):
                 m["timestamp"] = m["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
 
@@ -1055,12 +938,18 @@ def get_chat_messages():
 
         # Obtener últimos mensajes
         limit = int(request.args.get("limit", 50))
-        messages = list(mongo.db.messages.find().sort("timestamp", -1).limit(limit))
+        # Los mensajes antiguos guardan la imagen en base64: no traerla
+        messages = list(
+            mongo.db.messages.find({}, {"photo": 0})
+            .sort("timestamp", -1)
+            .limit(limit)
+        )
         messages.reverse()
 
         # Formatear para JSON
         for m in messages:
             m["_id"] = str(m["_id"])
+            m["photo"] = avatar_cache.get_url(m.get("user"))
             if m.get("timestamp"):
                 m["timestamp"] = m["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
 
@@ -1070,6 +959,40 @@ def get_chat_messages():
         return jsonify({"error": "Error al obtener mensajes"}), 500
 
 
+@main.route("/avatars/<user_id>")
+def user_avatar(user_id):
+    """
+    Imagen de perfil de un usuario servida desde la caché de avatares.
+    ?s=<px> devuelve una miniatura; ?v=<hash> hace la URL inmutable.
+    Sin login_required: la página de login muestra los avatares
+    """
+    size = request.args.get("s", type=int)
+    if size not in AVATAR_SIZES:
+        size = None
+
+    image = None
+    if ObjectId.is_valid(user_id):
+        image = avatar_cache.get_image(user_id, size)
+    if not image:
+        return redirect(url_for("static", filename="images/default.jpg"))
+
+    data, mimetype, version = image
+    etag = f"{version}-{size or 'orig'}"
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+
+    # Con el hash en la URL el contenido no cambia nunca: caché indefinida
+    if request.args.get("v") == version:
+        response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 @main.route("/asistente-familiar")
 @login_required
 def asistente_familiar_page():
@@ -1102,70 +1025,33 @@ def test_push(username):
         if session.get("user") != "Joso":
             return jsonify({"error": "Permisos insuficientes"}), 403
 
-        import json
-        from urllib.parse import urlparse
+        from app.notifications import send_push_to_user
 
-        from pywebpush import WebPushException, webpush
+        if not current_app.config.get("VAPID_PRIVATE_KEY"):
+            return jsonify({"error": "VAPID no configurado"}), 500
 
-        subscripcion = mongo.db.subscriptions.find_one({"user": username})
-        if not subscripcion:
+        report = send_push_to_user(
+            username,
+            f"🔔 Test push a {username}",
+            f"Hola {username}, esta es una notificación de prueba desde House App.",
+        )
+        if report is None:
             return (
                 jsonify({"error": f"No se encontró suscripción para {username}"}),
                 404,
             )
+        if not report.sent:
+            return (
+                jsonify({"error": "Fallo al enviar push", "details": report.to_dict()}),
+                500,
+            )
 
-        vapid_private_key = current_app.config.get("VAPID_PRIVATE_KEY")
-        if not vapid_private_key:
-            return jsonify({"error": "VAPID no configurado"}), 500
-
-        def get_vapid_claims(endpoint_url):
-            try:
-                parsed = urlparse(endpoint_url)
-                return {
-                    "aud": f"{parsed.scheme}://{parsed.netloc}",
-                    "sub": "mailto:joso.jmf@gmail.com",
-                }
-            except Exception:
-                return None
-
-        success_count = 0
-        for sub in subscripcion.get("subscriptions", []):
-            try:
-                endpoint = sub.get("endpoint")
-                if not endpoint:
-                    continue
-
-                claims = get_vapid_claims(endpoint)
-                if not claims:
-                    continue
-
-                webpush(
-                    subscription_info=sub,
-                    data=json.dumps(
-                        {
-                            "title": f"🔔 Test push a {username}",
-                            "body": f"Hola {username}, esta es una notificación de prueba desde House App.",
-                            "icon": "/static/icons/house-icon.png",
-                            "url": "/",
-                        }
-                    ),
-                    vapid_private_key=vapid_private_key,
-                    vapid_claims=claims,
-                )
-                success_count += 1
-                logger.info(f"📲 Test push enviada a {username}")
-            except WebPushException as ex:
-                logger.error(f"❌ Error al enviar push: {repr(ex)}")
-                return (
-                    jsonify({"error": "Fallo al enviar push", "details": str(ex)}),
-                    500,
-                )
-
+        logger.info(f"📲 Test push enviada a {username}")
         return jsonify(
             {
                 "status": "ok",
                 "message": f"Push enviada a {username}",
-                "sent_count": success_count,
+                "sent_count": report.sent,
             }
         )
     except Exception as e:
@@ -1460,15 +1346,15 @@ def add_shopping_items_bulk():
             if len(added_products) > 5:
                 products_text += f" y {len(added_products) - 5} más"
 
-            # Notificación push (si existe la función)
+            # Notificación push (se entrega en segundo plano)
             try:
-                # Importar función de notificaciones si existe
-                from app.api import send_push_to_all
+                from app.notifications import queue_push_to_all
 
-                send_push_to_all(
+                queue_push_to_all(
                     title="🛒 Productos añadidos por Casa AI",
                     body=f"Se añadieron {added_count} productos: {products_text}",
                     url="/lista_compra",
+                    topic="shopping",
                 )
             except ImportError:
                 pass  # Si no existe la función de push, continuar sin error
@@ -1667,7 +1553,7 @@ Responde de manera práctica y específica."""
             "stream": False,
         }
 
-        resp = requests.post(
+        resp = http_client.post(
             "https://api.groq.com/openai/v1/chat/completions",
             json=payload,
             headers=headers,
@@ -1769,24 +1655,6 @@ Responde de manera práctica y específica."""
         return jsonify({"error": "Error interno del servidor"}), 500
 
 
-# ==========================================
-# Rutas de mercadona
-# ==========================================
-MERCADONA_BASE_URL = "https://tienda.mercadona.es/api"
-MERCADONA_HEADERS = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-    "Accept-Language": "es-ES,es;q=0.8,en-US;q=0.5,en;q=0.3",
-    "Accept-Encoding": "gzip, deflate, br",
-    "Connection": "keep-alive",
-    "Upgrade-Insecure-Requests": "1",
-    "Sec-Fetch-Dest": "document",
-    "Sec-Fetch-Mode": "navigate",
-    "Sec-Fetch-Site": "none",
-    "Sec-Fetch-User": "?1",
-    "Cache-Control": "max-age=0",
-}
-
 # ==========================================
 # RUTAS DE MERCADONA
 # ==========================================
@@ -1817,74 +1685,24 @@ def mercadona_store():
 @main.route("/mercadona/categories")
 @login_required
 def mercadona_categories():
-    global _mercadona_categories_cache
-
-    # Si hay cache y no ha caducado
-    if (
-        _mercadona_categories_cache["data"]
-        and _mercadona_categories_cache["timestamp"]
-        and (datetime.now() - _mercadona_categories_cache["timestamp"]).total_seconds()
-        < _CATEGORIES_CACHE_TTL
-    ):
-        return jsonify(_mercadona_categories_cache["data"])
-
-    try:
-        url = f"{MERCADONA_BASE_URL}/categories/?lang=es&wh=mad1"
-        response = requests.get(url, headers=MERCADONA_HEADERS, timeout=10)
-
-        if response.status_code != 200:
-            # Si falla la API y tenemos cache, devolverlo
-            if _mercadona_categories_cache["data"]:
-                return jsonify(_mercadona_categories_cache["data"])
-            return (
-                jsonify({"success": False, "error": "Error al conectar con Mercadona"}),
-                500,
-            )
-
-        try:
-            categories_data = response.json()
-        except ValueError:
-            if _mercadona_categories_cache["data"]:
-                return jsonify(_mercadona_categories_cache["data"])
-            return (
-                jsonify({"success": False, "error": "Respuesta inválida de Mercadona"}),
-                500,
-            )
-
-        results = categories_data.get("results")
-        if not isinstance(results, list):
-            if _mercadona_categories_cache["data"]:
-                return jsonify(_mercadona_categories_cache["data"])
-            return (
-                jsonify({"success": False, "error": "Formato de datos inválido"}),
-                500,
-            )
-
-        categories = []
-        for category in results:
-            subcategories_count = len(category.get("categories", []))
-            categories.append(
-                {
-                    "id": category.get("id"),
-                    "name": category.get("name", "Sin nombre"),
-                    "subcategories_count": subcategories_count,
-                }
-            )
-
-        data = {"success": True, "categories": categories}
-
-        # Guardar en cache
-        _mercadona_categories_cache["data"] = data
-        _mercadona_categories_cache["timestamp"] = datetime.now()
-
-        return jsonify(data)
+    # Árbol de categorías compartido con la búsqueda (caché con TTL y,
+    # si Mercadona falla, la última copia aunque haya caducado)
+    categories_data = get_mercadona_categories_cached(subcategory_fetcher.session)
+    if not categories_data:
+        return (
+            jsonify({"success": False, "error": "Error al conectar con Mercadona"}),
+            500,
+        )
 
-    except Exception as e:
-        logger.error(f"Error mercadona_categories: {e}")
-        # Si falla y tenemos cache, devolverlo
-        if _mercadona_categories_cache["data"]:
-            return jsonify(_mercadona_categories_cache["data"])
-        return jsonify({"success": False, "error": "Error interno del servidor"}), 500
+    categories = [
+        {
+            "id": category.get("id"),
+            "name": category.get("name", "Sin nombre"),
+            "subcategories_count": len(category.get("categories", [])),
+        }
+        for category in categories_data.get("results", [])
+    ]
+    return jsonify({"success": True, "categories": categories})
 
 
 @main.route("/mercadona/category/<int:category_id>")
@@ -1895,21 +1713,12 @@ def mercadona_category_products(category_id):
     """Obtener productos de una categoría específica"""
     try:
         # Verificar primero si tenemos datos en caché
-        cache_key = f"category_{category_id}"
-        cached_data = _mercadona_categories_cache.get(cache_key)
-
-        if (
-            cached_data
-            and (datetime.now() - cached_data["timestamp"]).total_seconds()
-            < _CATEGORIES_CACHE_TTL
-        ):
-            return jsonify(cached_data["data"])
+        cached_data = mercadona_cache.get("category", category_id)
+        if cached_data:
+            return jsonify(cached_data)
 
-        # Configuración de la solicitud con timeout
-        session = requests.Session()
-        session.headers.update(MERCADONA_HEADERS)
-        adapter = requests.adapters.HTTPAdapter(max_retries=3)
-        session.mount("https://", adapter)
+        # Sesión compartida (pool de conexiones, reintentos y circuit breaker)
+        session = subcategory_fetcher.session
 
         # 1. Obtener categorías principales con manejo de timeout
         try:
@@ -1919,8 +1728,9 @@ def mercadona_category_products(category_id):
             categories_data = response.json()
         except (requests.exceptions.RequestException, ValueError) as e:
             logger.error(f"Error obteniendo categorías principales: {str(e)}")
-            if cached_data:
-                return jsonify(cached_data["data"])
+            stale_data = mercadona_cache.get("category", category_id, allow_stale=True)
+            if stale_data:
+                return jsonify(stale_data)
             return (
                 jsonify(
                     {
@@ -1964,10 +1774,7 @@ def mercadona_category_products(category_id):
             "total_products": len(all_products),
         }
 
-        _mercadona_categories_cache[cache_key] = {
-            "data": response_data,
-            "timestamp": datetime.now(),
-        }
+        mercadona_cache.set("category", category_id, response_data)
 
         return jsonify(response_data)
 
@@ -2026,47 +1833,30 @@ def get_products_from_subcategory(session, subcategory_id):
 @main.route("/mercadona/product/<product_id>")
 @login_required
 def mercadona_product_detail(product_id):
-    """Obtener detalles completos de un producto"""
+    """
+    Obtener detalles completos de un producto. El detalle se guarda en la
+    caché con un ETag: si el navegador ya lo tiene se responde 304
+    """
     try:
-        url = f"{MERCADONA_BASE_URL}/products/{product_id}/?lang=es&wh=mad1"
-
-        response = requests.get(url, headers=MERCADONA_HEADERS, timeout=10)
-
-        if response.status_code == 200:
-            product_data = response.json()
-
-            formatted_product = {
-                "id": product_data.get("id"),
-                "name": product_data.get("display_name"),
-                "brand": product_data.get("brand"),
-                "price": product_data.get("price_instructions", {}).get(
-                    "unit_price", "0"
-                ),
-                "reference_price": product_data.get("price_instructions", {}).get(
-                    "reference_price", "0"
-                ),
-                "size": product_data.get("price_instructions", {}).get("unit_size", 1),
-                "size_format": product_data.get("price_instructions", {}).get(
-                    "size_format", ""
-                ),
-                "packaging": product_data.get("packaging"),
-                "thumbnail": product_data.get("thumbnail"),
-                "photos": product_data.get("photos", []),
-                "origin": product_data.get("origin"),
-                "description": product_data.get("details", {}).get("description", ""),
-                "ingredients": product_data.get("nutrition_information", {}).get(
-                    "ingredients", ""
-                ),
-                "storage": product_data.get("details", {}).get(
-                    "storage_instructions", ""
-                ),
-                "ean": product_data.get("ean"),
-                "slug": product_data.get("slug"),
-            }
+        entry = get_product_detail_cached(product_id)
+        if entry is None:
+            return jsonify({"success": False, "error": "Producto no encontrado"}), 404
 
-            return jsonify({"success": True, "product": formatted_product})
+        if request.if_none_match.contains(entry["etag"]):
+            response = Response(status=304)
         else:
-            return jsonify({"success": False, "error": "Producto no encontrado"}), 404
+            response = jsonify(
+                {
+                    "success": True,
+                    "product": entry["product"],
+                    "partial": entry.get("partial", False),
+                    "stale": entry.get("stale", False),
+                }
+            )
+        response.set_etag(entry["etag"])
+        # El navegador revalida siempre; la revalidación no sale del servidor
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
 
     except Exception as e:
         logger.error(f"Error mercadona_product_detail: {e}")
@@ -2078,6 +1868,98 @@ def mercadona_product_detail(product_id):
         )
 
 
+def format_mercadona_product_detail(product_data):
+    """Detalle de /products/<id> (o producto del catálogo) para el cliente"""
+    price_instructions = product_data.get("price_instructions") or {}
+    details = product_data.get("details") or {}
+    return {
+        "id": product_data.get("id"),
+        "name": product_data.get("display_name"),
+        "brand": product_data.get("brand"),
+        "price": price_instructions.get("unit_price", "0"),
+        "reference_price": price_instructions.get("reference_price", "0"),
+        "size": price_instructions.get("unit_size", 1),
+        "size_format": price_instructions.get("size_format", ""),
+        "packaging": product_data.get("packaging"),
+        "thumbnail": product_data.get("thumbnail"),
+        "photos": product_data.get("photos", []),
+        "origin": product_data.get("origin"),
+        "description": details.get("description", ""),
+        "ingredients": (product_data.get("nutrition_information") or {}).get(
+            "ingredients", ""
+        ),
+        "storage": details.get("storage_instructions", ""),
+        "ean": product_data.get("ean"),
+        "slug": product_data.get("slug"),
+    }
+
+
+def product_detail_entry(product_data, partial=False):
+    """
+    Entrada de caché de un detalle: producto formateado, su ETag y el
+    resumen con el formato de los listados (para las consultas en lote)
+    """
+    product = format_mercadona_product_detail(product_data)
+    content = json.dumps(product, sort_keys=True, default=str)
+    try:
+        summary = format_mercadona_product(product_data)
+    except ValueError:
+        summary = None
+    return {
+        "product": product,
+        "summary": summary,
+        "etag": hashlib.md5(content.encode()).hexdigest(),
+        "partial": partial,
+    }
+
+
+def get_product_detail_cached(product_id):
+    """
+    Detalle de un producto: caché, API de detalle de Mercadona y, si no
+    responde, la última copia aunque haya caducado o el producto de la
+    sincronización del catálogo (sin descripción ni ingredientes).
+    None solo si Mercadona dice que no existe (404/410)
+    """
+    product_id = str(product_id)
+    cached = mercadona_cache.get("product", product_id)
+    if cached:
+        return cached
+
+    url = f"{MERCADONA_BASE_URL}/products/{product_id}/?lang=es&wh=mad1"
+    try:
+        response = subcategory_fetcher.session.get(url, timeout=10)
+    except requests.RequestException as e:
+        logger.warning(f"⚠️ Detalle de {product_id} no disponible: {e}")
+        response = None
+
+    if response is not None and response.status_code == 200:
+        try:
+            product_data = response.json()
+            if not isinstance(product_data, dict):
+                raise ValueError(type(product_data).__name__)
+        except ValueError as e:
+            # Un 200 con HTML (bloqueo, mantenimiento) se trata como un fallo
+            logger.warning(f"⚠️ Detalle de {product_id}: respuesta no válida ({e})")
+        else:
+            entry = product_detail_entry(product_data)
+            mercadona_cache.set("product", product_id, entry)
+            return entry
+    if response is not None and response.status_code in (404, 410):
+        return None
+    if response is not None:
+        # Bloqueos (403), throttling (429) o errores: no significa que no exista
+        logger.warning(f"⚠️ Detalle de {product_id}: HTTP {response.status_code}")
+
+    stale = mercadona_cache.get("product", product_id, allow_stale=True)
+    if stale:
+        return dict(stale, stale=True)
+
+    snapshot = product_catalog.get_product(product_id)
+    if snapshot:
+        return product_detail_entry(snapshot, partial=True)
+    raise RuntimeError(f"Mercadona no responde ({url})")
+
+
 # ==========================================
 # FUNCIÓN AUXILIAR
 # ==========================================
@@ -2115,6 +1997,7 @@ def format_mercadona_product(product_data):
     return {
         "id": str(product_id),
         "name": safe_string(product_data.get("display_name"), "Sin nombre"),
+        "brand": safe_string(product_data.get("brand")),
         "slug": safe_string(product_data.get("slug")),
         "thumbnail": safe_string(
             product_data.get("thumbnail"), "/static/img/default_food.jpg"
@@ -2141,6 +2024,43 @@ def format_mercadona_product(product_data):
 # REEMPLAZAR la función mercadona_search en routes.py con esta versión mejorada:
 
 
+@main.route("/mercadona/suggest")
+@login_required
+def mercadona_suggest():
+    """
+    Autocompletado de nombres de producto con el índice del catálogo local
+    (nunca pasa por la búsqueda en vivo). La respuesta solo cambia con la
+    versión del catálogo, así que el navegador la puede reutilizar
+    """
+    prefix = request.args.get("q", "").strip()
+    limit = request.args.get("limit", 8, type=int)
+
+    if not product_catalog.is_ready():
+        response = jsonify(
+            {"success": True, "query": prefix, "suggestions": [], "ready": False}
+        )
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    version = product_catalog.version
+    etag = f"suggest-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(
+            {
+                "success": True,
+                "query": prefix,
+                "suggestions": product_catalog.suggest(prefix, limit),
+                "ready": True,
+                "catalog_version": version,
+            }
+        )
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=60"
+    return response
+
+
 @main.route("/mercadona/search")
 @login_required
 def mercadona_search():
@@ -2160,270 +2080,521 @@ def mercadona_search():
             "max_price": request.args.get("max_price"),
             "category": request.args.get("category"),
             "discount_only": request.args.get("discount_only") == "true",
+            # fuzzy=false: sin tolerancia a errores de escritura
+            "exact": request.args.get("fuzzy") == "false",
         }
         # Eliminar filtros vacíos y falsos
         filters = {k: v for k, v in filters.items() if v is not None and v is not False}
 
+        # Paginación (limit/cursor) y modo streaming NDJSON (stream=1)
+        try:
+            limit, cursor = parse_search_page(request.args)
+        except ValueError as e:
+            return jsonify(success=False, error=str(e)), 400
+        stream = request.args.get("stream") in ("1", "true", "ndjson")
+
         # Logging más conciso
         logger.info(f"🔍 Búsqueda: '{query}'" + (f" +filtros" if filters else ""))
 
         # Intentar obtener de caché primero
         cached_result = search_cache.get(query, filters if filters else None)
+        # Un resultado del catálogo local caduca cuando el catálogo cambia
+        if cached_result and cached_result.get("catalog_version") not in (
+            None,
+            product_catalog.version,
+        ):
+            cached_result = None
         if cached_result:
             cached_result["from_cache"] = True
             cached_result["cache_timestamp"] = datetime.now().isoformat()
             logger.info(
                 f"🎯 Cache HIT: '{query}' ({cached_result.get('total_found', 0)} productos)"
             )
-            return jsonify(cached_result)
+            return search_response(cached_result, limit, cursor, stream)
+
+        # Normalizar query para búsqueda más flexible
+        query_normalized = query.lower().strip()
+        query_words = query_normalized.split()
+
+        # Con el catálogo local sincronizado se responde desde el índice
+        if product_catalog.is_ready():
+            if stream:
+                return stream_local_catalog(query, query_words, filters, limit, cursor)
+            result = search_local_catalog(query, query_words, filters)
+            search_cache.set(query, result, filters if filters else None)
+            logger.info(
+                f"📚 '{query}': {result['total_found']} productos (catálogo local)"
+            )
+            return search_response(result, limit, cursor, stream)
+
+        # Mercadona caído (circuito abierto): la última copia guardada del
+        # catálogo al momento, en lugar de peticiones condenadas a fallar
+        if not mercadona_available():
+            snapshot = product_catalog.get_snapshot()
+            if snapshot:
+                logger.warning(f"⚠️ '{query}': Mercadona caído, copia del catálogo")
+                result = search_local_catalog(query, query_words, filters, snapshot)
+                return search_response(result, limit, cursor, stream)
+            return (
+                jsonify(
+                    success=False,
+                    error="Mercadona no está disponible ahora mismo",
+                    retry_in_seconds=round(mercadona_retry_in()),
+                ),
+                503,
+            )
+        # Mercadona responde: la copia sin sincronizar ya no hace falta
+        product_catalog.drop_snapshot()
 
         # Si no está en caché, realizar búsqueda
         logger.info(f"💥 Cache MISS: '{query}' - iniciando búsqueda")
 
-        # Configurar sesión con retry y timeout
-        session_search = requests.Session()
-        session_search.headers.update(MERCADONA_HEADERS)
-        adapter = requests.adapters.HTTPAdapter(max_retries=2)
-        session_search.mount("https://", adapter)
-
-        # Obtener todas las categorías
-        categories_data = get_mercadona_categories_cached(session_search)
-        if not categories_data:
+        # Las búsquedas idénticas simultáneas esperan a la que ya está en
+        # curso en lugar de repetir la descarga de todas las subcategorías
+        result, coalesced = search_flight.do(
+            search_cache.key(query, filters if filters else None),
+            lambda: run_live_search(query, query_normalized, query_words, filters),
+        )
+        # Mercadona ha caído durante la búsqueda: mejor la copia del catálogo
+        if (result is None or result["partial"]) and not mercadona_available():
+            snapshot = product_catalog.get_snapshot()
+            if snapshot:
+                result = search_local_catalog(query, query_words, filters, snapshot)
+                return search_response(result, limit, cursor, stream)
+        if result is None:
             error_msg = "No se pudo obtener categorías de Mercadona"
-            logger.error(f"❌ {error_msg}")
             return jsonify(success=False, error=error_msg), 500
+        if coalesced:
+            logger.info(f"🔗 '{query}': resultado compartido con búsqueda en curso")
+            result = dict(result, coalesced=True)
 
-        all_products = []
-        processed_subcategories = set()
-        search_start_time = datetime.now()
-
-        # Normalizar query para búsqueda más flexible
-        query_normalized = query.lower().strip()
-        query_words = query_normalized.split()
+        return search_response(result, limit, cursor, stream)
 
-        # Contadores para estadísticas
-        total_subcategories = sum(
-            len(cat.get("categories", [])) for cat in categories_data.get("results", [])
+    except Exception as e:
+        logger.error(f"❌ Error crítico en búsqueda '{query}': {str(e)}")
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": "Error interno en la búsqueda",
+                    "details": (
+                        str(e) if current_app.debug else "Error interno del servidor"
+                    ),
+                }
+            ),
+            500,
         )
-        processed_count = 0
-        error_count = 0
-        success_count = 0
 
-        # Buscar en cada categoría y subcategoría
-        for category in categories_data.get("results", []):
-            category_name = category.get("name", "")
 
-            for subcat in category.get("categories", []):
-                subcat_id = subcat.get("id")
-                subcat_name = subcat.get("name", "")
-                processed_count += 1
+def run_live_search(query, query_normalized, query_words, filters):
+    """
+    Búsqueda en vivo: descarga las subcategorías y filtra sus productos.
+    Devuelve el resultado (None si no se pudieron obtener las categorías)
+    """
+    # Obtener todas las categorías (con la sesión compartida del fetcher)
+    categories_data = get_mercadona_categories_cached(subcategory_fetcher.session)
+    if not categories_data:
+        logger.error("❌ No se pudo obtener categorías de Mercadona")
+        return None
+
+    all_products = []
+    processed_subcategories = set()
+    search_start_time = datetime.now()
+
+    # Subcategorías únicas a descargar: (categoría, id, nombre)
+    subcategory_tasks = []
+    processed_count = 0
+    for category in categories_data.get("results", []):
+        for subcat in category.get("categories", []):
+            subcat_id = subcat.get("id")
+            processed_count += 1
+            if not subcat_id or subcat_id in processed_subcategories:
+                continue
+            processed_subcategories.add(subcat_id)
+            subcategory_tasks.append(
+                (category.get("name", ""), subcat_id, subcat.get("name", ""))
+            )
 
-                # Evitar procesar la misma subcategoría múltiples veces
-                if subcat_id in processed_subcategories:
-                    continue
-                processed_subcategories.add(subcat_id)
+    # Descarga concurrente con deadline global (resultados parciales si se agota)
+    fetch_report = subcategory_fetcher.fetch_all(
+        subcategory_tasks, _fetch_subcategory_task
+    )
+    error_count = fetch_report.errors
+    success_count = 0
 
-                if subcat_id:
-                    try:
-                        # Usar caché también para subcategorías individuales
-                        subcat_products = get_subcategory_products_cached(
-                            session_search, subcat_id, subcat_name
-                        )
+    for task, subcat_products in fetch_report.results:
+        if not subcat_products:
+            continue
+        category_name, _subcat_id, subcat_name = task
+        success_count += 1
 
-                        if subcat_products:  # Solo procesar si hay productos
-                            success_count += 1
-                            products_found_in_subcat = 0
-
-                            for product in subcat_products:
-                                if is_product_match(
-                                    product, query_normalized, query_words
-                                ):
-                                    try:
-                                        formatted_product = format_mercadona_product(
-                                            product
-                                        )
-                                        formatted_product["category"] = category_name
-                                        formatted_product["subcategory"] = subcat_name
-
-                                        # Aplicar filtros si existen
-                                        if apply_filters(formatted_product, filters):
-                                            all_products.append(formatted_product)
-                                            products_found_in_subcat += 1
-
-                                    except Exception as e:
-                                        # Solo log en debug para errores de formateo
-                                        if current_app.debug:
-                                            logger.debug(
-                                                f"Error formateando producto {product.get('id', 'unknown')}: {str(e)}"
-                                            )
-                                        continue
-
-                    except Exception as e:
-                        error_count += 1
-                        # Solo log de errores críticos, no warnings
-                        if "403" not in str(e) and "NoneType" not in str(e):
-                            logger.warning(
-                                f"Error procesando subcategoría {subcat_id}: {str(e)}"
-                            )
-                        continue
-
-        # Eliminar duplicados basándose en el ID del producto
-        unique_products = []
-        seen_ids = set()
-        for product in all_products:
-            if product["id"] not in seen_ids:
-                seen_ids.add(product["id"])
-                unique_products.append(product)
-
-        # Ordenar resultados por relevancia
-        sorted_products = sort_products_by_relevance(
-            unique_products, query_normalized, query_words
-        )
+        for product in subcat_products:
+            if not is_product_match(product, query_normalized, query_words):
+                continue
+            try:
+                formatted_product = format_mercadona_product(product)
+                formatted_product["category"] = category_name
+                formatted_product["subcategory"] = subcat_name
+
+                # Aplicar filtros si existen
+                if apply_filters(formatted_product, filters):
+                    all_products.append(formatted_product)
+
+            except Exception as e:
+                # Solo log en debug para errores de formateo
+                if current_app.debug:
+                    logger.debug(
+                        f"Error formateando producto {product.get('id', 'unknown')}: {str(e)}"
+                    )
+                continue
 
-        search_duration = (datetime.now() - search_start_time).total_seconds()
+    # Eliminar duplicados basándose en el ID del producto
+    unique_products = []
+    seen_ids = set()
+    for product in all_products:
+        if product["id"] not in seen_ids:
+            seen_ids.add(product["id"])
+            unique_products.append(product)
+
+    # Ordenar resultados por relevancia
+    sorted_products = sort_products_by_relevance(
+        unique_products, query_normalized, query_words
+    )
+
+    search_duration = (datetime.now() - search_start_time).total_seconds()
+
+    # Si el circuito se abrió a mitad, las subcategorías que quedaban se
+    # descartaron sin llamar a Mercadona: el resultado está incompleto
+    partial = fetch_report.partial or not mercadona_available()
+
+    # Preparar resultado
+    result = {
+        "success": True,
+        "products": sorted_products,
+        "query": query,
+        "total_found": len(sorted_products),
+        "search_terms": query_words,
+        "search_duration_seconds": round(search_duration, 3),
+        "from_cache": False,
+        "source": "live",
+        "applied_filters": filters,
+        "searched_subcategories": len(processed_subcategories),
+        "partial": partial,
+        "stats": {
+            "total_subcategories_processed": processed_count,
+            "successful_subcategories": success_count,
+            "error_subcategories": error_count,
+            "timed_out_subcategories": fetch_report.timed_out,
+        },
+    }
+
+    # Guardar en caché solo resultados completos: tras un deadline las
+    # subcategorías que faltaban siguen descargándose y la próxima
+    # búsqueda ya las encuentra en caché
+    if not partial:
+        search_cache.set(query, result, filters if filters else None)
 
-        # Preparar resultado
-        result = {
+    # Log final conciso
+    logger.info(
+        f"✅ '{query}': {len(sorted_products)} productos, {search_duration:.2f}s, {success_count}/{processed_count} subcategorías OK"
+    )
+
+    return result
+
+
+def iter_local_catalog(query, filters, snapshot=None):
+    """
+    Productos formateados del índice local (o de `snapshot`, la copia sin
+    sincronizar), en orden de relevancia (BM25).
+    Es un generador: cada producto se formatea cuando se consume
+    """
+    index = snapshot or product_catalog.index
+    fuzzy = not filters.get("exact")
+    for product, category_name, subcat_name, score in index.search(query, fuzzy):
+        try:
+            formatted_product = format_mercadona_product(product)
+        except Exception:
+            continue
+        formatted_product["category"] = category_name
+        formatted_product["subcategory"] = subcat_name
+        formatted_product["relevance"] = round(score, 3)
+        if apply_filters(formatted_product, filters):
+            yield formatted_product
+
+
+def local_catalog_result(
+    query, query_words, filters, products, search_start_time, snapshot=None
+):
+    search_duration = (datetime.now() - search_start_time).total_seconds()
+    if snapshot:
+        # Copia guardada sin sincronizar: siempre puede estar desactualizada
+        return {
             "success": True,
-            "products": sorted_products,
+            "products": products,
             "query": query,
-            "total_found": len(sorted_products),
+            "total_found": len(products),
             "search_terms": query_words,
             "search_duration_seconds": round(search_duration, 3),
             "from_cache": False,
+            "source": "snapshot",
+            "fuzzy": not filters.get("exact"),
             "applied_filters": filters,
-            "searched_subcategories": len(processed_subcategories),
-            "stats": {
-                "total_subcategories_processed": processed_count,
-                "successful_subcategories": success_count,
-                "error_subcategories": error_count,
-            },
+            "partial": False,
+            "stale": True,
+            "catalog_version": None,
         }
+    return {
+        "success": True,
+        "products": products,
+        "query": query,
+        "total_found": len(products),
+        "search_terms": query_words,
+        "search_duration_seconds": round(search_duration, 3),
+        "from_cache": False,
+        "source": "catalog",
+        "fuzzy": not filters.get("exact"),
+        "applied_filters": filters,
+        "partial": False,
+        # Sin conexión con Mercadona el catálogo puede estar desactualizado
+        "stale": not mercadona_available(),
+        "catalog_version": product_catalog.version,
+        "catalog_refreshed_at": (
+            product_catalog.last_refresh.isoformat()
+            if product_catalog.last_refresh
+            else None
+        ),
+    }
+
+
+def search_local_catalog(query, query_words, filters, snapshot=None):
+    """Buscar en el índice del catálogo local (sin llamadas a Mercadona)"""
+    search_start_time = datetime.now()
+    products = list(iter_local_catalog(query, filters, snapshot))
+    return local_catalog_result(
+        query, query_words, filters, products, search_start_time, snapshot
+    )
+
+
+def stream_local_catalog(query, query_words, filters, limit, cursor):
+    """
+    Búsqueda en el catálogo local en NDJSON: los productos de la página se
+    envían según se formatean y, al terminar, el resultado completo se
+    guarda en la caché de búsquedas para las páginas siguientes
+    """
+    version = product_catalog.version
+    try:
+        offset = decode_search_cursor(cursor, version)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    search_start_time = datetime.now()
+    meta = local_catalog_result(query, query_words, filters, [], search_start_time)
 
-        # Guardar en caché siempre
+    def finish(products):
+        result = local_catalog_result(
+            query, query_words, filters, products, search_start_time
+        )
         search_cache.set(query, result, filters if filters else None)
+        logger.info(f"📚 '{query}': {len(products)} productos (catálogo local)")
 
-        # Log final conciso
-        logger.info(
-            f"✅ '{query}': {len(sorted_products)} productos, {search_duration:.2f}s, {success_count}/{processed_count} subcategorías OK"
+    return ndjson_response(
+        ndjson_search_stream(
+            meta, iter_local_catalog(query, filters), limit, offset, version, finish
         )
+    )
 
-        return jsonify(result)
 
-    except Exception as e:
-        logger.error(f"❌ Error crítico en búsqueda '{query}': {str(e)}")
-        return (
-            jsonify(
-                {
-                    "success": False,
-                    "error": "Error interno en la búsqueda",
-                    "details": (
-                        str(e) if current_app.debug else "Error interno del servidor"
-                    ),
-                }
-            ),
-            500,
-        )
+# ==========================================
+# PAGINACIÓN Y STREAMING DE BÚSQUEDAS
+# ==========================================
 
+# Máximo de productos por página
+SEARCH_PAGE_MAX = 200
 
-def get_mercadona_categories_cached(session):
-    """Obtener categorías con caché (usando la caché global existente)"""
-    global _mercadona_categories_cache
-
-    # Si hay cache y no ha caducado
-    if (
-        _mercadona_categories_cache.get("data")
-        and _mercadona_categories_cache.get("timestamp")
-        and (datetime.now() - _mercadona_categories_cache["timestamp"]).total_seconds()
-        < _CATEGORIES_CACHE_TTL
-    ):
 
-        cached_data = _mercadona_categories_cache["data"]
-        if isinstance(cached_data, dict) and cached_data.get("categories_data"):
-            return cached_data["categories_data"]
+def encode_search_cursor(offset, version):
+    """Cursor opaco: posición en el resultado y versión del catálogo"""
+    raw = f"{offset}:{'' if version is None else version}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
+
+def decode_search_cursor(cursor, version):
+    """
+    Posición de un cursor (0 sin cursor). Falla si el cursor no es válido o
+    se generó con otra versión del catálogo: el orden ya no sería el mismo
+    """
+    if not cursor:
+        return 0
     try:
-        logger.info("🔄 Obteniendo categorías...")
-        url = f"{MERCADONA_BASE_URL}/categories/?lang=es&wh=mad1"
-        response = session.get(url, timeout=15)
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        offset, cursor_version = raw.split(":", 1)
+        offset = int(offset)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Cursor no válido")
+    if offset < 0:
+        raise ValueError("Cursor no válido")
+    if cursor_version != ("" if version is None else str(version)):
+        raise ValueError("El catálogo ha cambiado, repite la búsqueda")
+    return offset
+
+
+def parse_search_page(args):
+    """(limit, cursor) de la petición; sin limit se devuelve todo"""
+    limit = args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("limit debe ser un número")
+        if limit < 1:
+            raise ValueError("limit debe ser mayor que 0")
+        limit = min(limit, SEARCH_PAGE_MAX)
+    return limit, args.get("cursor")
 
-        if response.status_code == 200:
-            categories_data = response.json()
 
-            # Validar que los datos son correctos
-            if not categories_data.get("results"):
-                logger.error("❌ Respuesta de categorías sin 'results'")
-                return None
+def page_info(offset, limit, returned, total, version):
+    end = offset + returned
+    more = limit is not None and end < total
+    return {
+        "offset": offset,
+        "limit": limit,
+        "returned": returned,
+        "next_cursor": encode_search_cursor(end, version) if more else None,
+    }
 
-            # Guardar en cache con estructura mejorada
-            _mercadona_categories_cache["data"] = {
-                "success": True,
-                "categories": [
-                    {
-                        "id": cat.get("id"),
-                        "name": cat.get("name", "Sin nombre"),
-                        "subcategories_count": len(cat.get("categories", [])),
-                    }
-                    for cat in categories_data.get("results", [])
-                ],
-                "categories_data": categories_data,
-            }
-            _mercadona_categories_cache["timestamp"] = datetime.now()
 
-            logger.info(
-                f"✅ {len(categories_data.get('results', []))} categorías obtenidas"
+def paginate_search_result(result, limit, offset):
+    """Copia del resultado con solo los productos de la página pedida"""
+    products = result.get("products", [])
+    end = len(products) if limit is None else offset + limit
+    page = dict(result, products=products[offset:end])
+    page["page"] = page_info(
+        offset,
+        limit,
+        len(page["products"]),
+        len(products),
+        result.get("catalog_version"),
+    )
+    return page
+
+
+def ndjson_search_stream(meta, products, limit, offset, version, finish=None):
+    """
+    Líneas NDJSON: cabecera ("meta"), un producto por línea (solo los de la
+    página) y cierre ("end") con el total y el cursor siguiente.
+    `products` puede ser un generador: cada producto se envía en cuanto se
+    produce. `finish` recibe la lista completa al terminar
+    """
+    meta = {
+        key: value
+        for key, value in meta.items()
+        if key not in ("products", "total_found", "search_duration_seconds")
+    }
+    yield _ndjson_line({"type": "meta", **meta})
+
+    end = None if limit is None else offset + limit
+    collected = []
+    for position, product in enumerate(products):
+        collected.append(product)
+        if position >= offset and (end is None or position < end):
+            yield _ndjson_line({"type": "product", "product": product})
+
+    if finish:
+        finish(collected)
+
+    returned = max(0, min(len(collected), end or len(collected)) - offset)
+    yield _ndjson_line(
+        {
+            "type": "end",
+            "total_found": len(collected),
+            "page": page_info(offset, limit, returned, len(collected), version),
+        }
+    )
+
+
+def _ndjson_line(data):
+    return json.dumps(data, ensure_ascii=False, default=str) + "\n"
+
+
+def ndjson_response(lines):
+    return Response(
+        stream_with_context(lines),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+
+def search_response(result, limit, cursor, stream):
+    """Respuesta de una búsqueda ya resuelta: página JSON o NDJSON"""
+    version = result.get("catalog_version")
+    try:
+        offset = decode_search_cursor(cursor, version)
+    except ValueError as e:
+        return jsonify(success=False, error=str(e)), 400
+
+    # El aviso de catálogo desactualizado depende del momento, no de la caché
+    if result.get("source") == "catalog":
+        result = dict(result, stale=not mercadona_available())
+
+    if stream:
+        return ndjson_response(
+            ndjson_search_stream(
+                result, iter(result.get("products", [])), limit, offset, version
             )
-            return categories_data
-        else:
-            logger.error(f"❌ Error HTTP {response.status_code} obteniendo categorías")
+        )
+    return jsonify(paginate_search_result(result, limit, offset))
 
-    except Exception as e:
-        logger.error(f"❌ Error crítico obteniendo categorías: {str(e)}")
 
-    return None
+def _fetch_subcategory_task(session, task):
+    """Adaptador de SubcategoryFetcher: tarea = (categoría, id, nombre)"""
+    _category_name, subcat_id, subcat_name = task
+    return get_subcategory_products_cached(session, subcat_id, subcat_name)
+
+
+def get_mercadona_categories_cached(session):
+    """
+    Árbol de categorías con caché. Si Mercadona falla se devuelve la última
+    copia aunque haya caducado (None si nunca se obtuvo)
+    """
+    categories_data = mercadona_cache.get("categories")
+    if categories_data:
+        return categories_data
+
+    logger.info("🔄 Obteniendo categorías...")
+    categories_data = fetch_categories(session)
+    if not categories_data:
+        return mercadona_cache.get("categories", allow_stale=True)
+
+    mercadona_cache.set("categories", None, categories_data)
+    logger.info(f"✅ {len(categories_data.get('results', []))} categorías obtenidas")
+    return categories_data
 
 
 def get_subcategory_products_cached(session, subcat_id, subcat_name):
     """Obtener productos de subcategoría con caché y manejo robusto de errores"""
-    cache_key = f"subcat_{subcat_id}"
-
-    # Verificar si está en la caché global
-    cached_data = _mercadona_categories_cache.get(cache_key)
-    if (
-        cached_data
-        and (datetime.now() - cached_data["timestamp"]).total_seconds()
-        < _CATEGORIES_CACHE_TTL
-    ):
-        return cached_data["data"]
+    cached_data = mercadona_cache.get("subcategory", subcat_id)
+    if cached_data:
+        return cached_data
+
+    # Una sola descarga por subcategoría aunque la pidan varias búsquedas
+    products, _coalesced = subcategory_flight.do(
+        subcat_id, lambda: download_subcategory_products(session, subcat_id)
+    )
+    return products
+
 
+def download_subcategory_products(session, subcat_id):
+    """Descargar los productos de una subcategoría y guardarlos en caché"""
     try:
         subcat_url = f"{MERCADONA_BASE_URL}/categories/{subcat_id}/?lang=es&wh=mad1"
         response = session.get(subcat_url, timeout=8)
 
         if response.status_code == 200:
-            subcat_data = response.json()
-            products = []
-
-            # Procesar productos directos
-            for product in subcat_data.get("products", []):
-                if product and isinstance(
-                    product, dict
-                ):  # Validar que el producto no es None
-                    products.append(product)
-
-            # Procesar sub-subcategorías
-            for sub_subcat in subcat_data.get("categories", []):
-                if sub_subcat and isinstance(sub_subcat, dict):
-                    for product in sub_subcat.get("products", []):
-                        if product and isinstance(product, dict):
-                            products.append(product)
+            products = extract_products(response.json())
 
             # Guardar en caché solo si hay productos válidos
             if products:
-                _mercadona_categories_cache[cache_key] = {
-                    "data": products,
-                    "timestamp": datetime.now(),
-                }
+                mercadona_cache.set("subcategory", subcat_id, products)
 
             return products
 
@@ -2444,36 +2615,6 @@ def get_subcategory_products_cached(session, subcat_id, subcat_name):
             logger.debug(f"Error subcategoría {subcat_id}: {str(e)}")
         return []
 
-    try:
-        subcat_url = f"{MERCADONA_BASE_URL}/categories/{subcat_id}/?lang=es&wh=mad1"
-        response = session.get(subcat_url, timeout=8)
-
-        if response.status_code == 200:
-            subcat_data = response.json()
-            products = []
-
-            # Procesar productos directos
-            for product in subcat_data.get("products", []):
-                products.append(product)
-
-            # Procesar sub-subcategorías
-            for sub_subcat in subcat_data.get("categories", []):
-                for product in sub_subcat.get("products", []):
-                    products.append(product)
-
-            # Guardar en caché
-            _mercadona_categories_cache[cache_key] = {
-                "data": products,
-                "timestamp": datetime.now(),
-            }
-
-            return products
-
-    except Exception as e:
-        logger.error(f"Error obteniendo subcategoría {subcat_id}: {str(e)}")
-
-    return []
-
 
 def apply_filters(product, filters):
     """Aplicar filtros al producto con validación robusta"""
@@ -2518,6 +2659,103 @@ def apply_filters(product, filters):
         return True
 
 
+@main.route("/api/mercadona/price_history/<product_id>", methods=["GET"])
+@login_required
+def get_price_history(product_id):
+    """
+    Histórico de precios de un producto ya reducido en el servidor:
+    ?days=90 (máx. 730) y ?points=60 (máx. 200) tramos como mucho
+    """
+    days = min(max(request.args.get("days", 90, type=int), 1), 730)
+    points = min(max(request.args.get("points", 60, type=int), 1), 200)
+    try:
+        current = price_point(product_catalog.get_product(product_id))
+        history = price_history.history(product_id, days, points, current=current)
+    except Exception as e:
+        logger.error(f"Error get_price_history: {e}")
+        return jsonify(success=False, error="Error al obtener el histórico"), 500
+
+    response = jsonify(success=True, **history)
+    # Solo cambia cuando la sincronización del catálogo registra precios
+    response.headers["Cache-Control"] = "private, max-age=300"
+    return response
+
+
+# Máximo de ids por consulta en lote
+PRODUCTS_BATCH_MAX = 300
+
+
+@main.route("/api/mercadona/products/batch", methods=["POST"])
+@login_required
+def get_products_batch():
+    """
+    Productos actuales de muchos ids en una sola respuesta. Se resuelven
+    con el catálogo local y la caché de detalles; solo los que faltan se
+    piden a Mercadona, en paralelo. Body: {"ids": [...]}
+    """
+    data = request.get_json(silent=True) or {}
+    requested = data.get("ids")
+    if not isinstance(requested, list) or not requested:
+        return jsonify(success=False, error="ids debe ser una lista no vacía"), 400
+
+    # Sin duplicados y en el orden pedido
+    ids = list(dict.fromkeys(str(i) for i in requested if i not in (None, "")))
+    if len(ids) > PRODUCTS_BATCH_MAX:
+        error = f"Máximo {PRODUCTS_BATCH_MAX} productos por consulta"
+        return jsonify(success=False, error=error), 400
+
+    products = {}
+    misses = []
+    for product_id in ids:
+        snapshot = product_catalog.get_product(product_id)
+        if snapshot:
+            try:
+                product = format_mercadona_product(snapshot)
+                products[product_id] = dict(product, source="catalog")
+                continue
+            except ValueError:
+                pass
+        entry = mercadona_cache.get("product", product_id)
+        if entry and entry.get("summary"):
+            products[product_id] = dict(entry["summary"], source="cache")
+        else:
+            misses.append(product_id)
+
+    errors = timed_out = 0
+    not_found = set()
+    if misses:
+        fetch_report = subcategory_fetcher.fetch_all(
+            misses, lambda _session, product_id: get_product_detail_cached(product_id)
+        )
+        for product_id, entry in fetch_report.results:
+            if entry and entry.get("summary"):
+                products[product_id] = dict(entry["summary"], source="mercadona")
+            else:
+                not_found.add(product_id)
+        errors, timed_out = fetch_report.errors, fetch_report.timed_out
+
+    return jsonify(
+        success=True,
+        products=[products[i] for i in ids if i in products],
+        missing=[i for i in ids if i in not_found],
+        # Sin respuesta de Mercadona ni copia local: se pueden volver a pedir
+        unavailable=[i for i in ids if i not in products and i not in not_found],
+        stats={
+            "requested": len(ids),
+            "fetched": len(misses),
+            "errors": errors,
+            "timed_out": timed_out,
+        },
+    )
+
+
+@main.route("/api/diagnostics/http", methods=["GET"])
+@login_required
+def get_http_diagnostics():
+    """Latencias, reintentos y estado del circuit breaker de cada host externo"""
+    return jsonify({"success": True, **http_client.get_stats()})
+
+
 @main.route("/api/mercadona/cache/stats", methods=["GET"])
 @login_required
 def get_cache_stats():
@@ -2526,14 +2764,20 @@ def get_cache_stats():
         stats = search_cache.get_stats()
 
         # Añadir estadísticas de la caché de categorías
-        categories_cache_size = len(_mercadona_categories_cache)
+        categories_cache = mercadona_cache.get_stats()
 
         return jsonify(
             {
                 "success": True,
                 "search_cache": stats,
-                "categories_cache_entries": categories_cache_size,
-                "categories_cache_ttl_seconds": _CATEGORIES_CACHE_TTL,
+                "catalog": product_catalog.get_stats(),
+                "single_flight": {
+                    "search": search_flight.get_stats(),
+                    "subcategory": subcategory_flight.get_stats(),
+                },
+                "categories_cache": categories_cache,
+                "categories_cache_entries": categories_cache["entries"],
+                "categories_cache_ttl_seconds": categories_cache["ttl_seconds"],
                 "timestamp": datetime.now().isoformat(),
             }
         )
@@ -2556,8 +2800,7 @@ def clear_search_cache():
         search_cache.clear()
 
         # Limpiar caché de categorías
-        global _mercadona_categories_cache
-        _mercadona_categories_cache.clear()
+        mercadona_cache.clear()
 
         logger.info(f"🧹 Caché limpiada por: {session.get('user')}")
 
@@ -2577,108 +2820,44 @@ def clear_search_cache():
 
 def is_product_match(product, query_normalized, query_words):
     """
-    Determinar si un producto coincide con la búsqueda usando coincidencias parciales flexibles
+    Determinar si un producto coincide con la búsqueda usando coincidencias parciales flexibles.
+    Los campos de búsqueda del producto (sin tildes, palabras, prefijos y
+    trigramas) se calculan una vez por producto y la query una vez por búsqueda
     """
     # Validar que el producto no es None y tiene los campos necesarios
     if not product or not isinstance(product, dict):
         return False
 
-    # Obtener campos con validación de None
-    product_name = product.get("display_name") or ""
-    product_brand = product.get("brand") or ""
-    product_packaging = product.get("packaging") or ""
-
-    # Convertir a lowercase de forma segura
-    product_name = product_name.lower() if product_name else ""
-    product_brand = product_brand.lower() if product_brand else ""
-    product_packaging = product_packaging.lower() if product_packaging else ""
-
-    # Texto completo del producto para búsqueda
-    full_product_text = f"{product_name} {product_brand} {product_packaging}".strip()
-
-    # Si no hay texto para buscar, no es una coincidencia
-    if not full_product_text:
-        return False
-
-    # Método 1: Coincidencia directa de la query completa
-    if query_normalized in full_product_text:
-        return True
-
-    # Método 2: Todas las palabras de la query deben estar presentes
-    if len(query_words) > 1:
-        words_found = 0
-        for word in query_words:
-            if len(word) >= 2 and word in full_product_text:
-                words_found += 1
-
-        # Si encontramos al menos el 70% de las palabras, es una coincidencia
-        if words_found >= len(query_words) * 0.7:
-            return True
-
-    # Método 3: Coincidencia parcial inteligente para palabras individuales
-    for word in query_words:
-        if len(word) >= 3:
-            product_words = full_product_text.split()
-            for prod_word in product_words:
-                if prod_word.startswith(word) or word in prod_word:
-                    return True
-
-    return False
+    return product_matches(normalize_product(product), parse_query(query_normalized))
 
 
 def sort_products_by_relevance(products, query_normalized, query_words):
     """
-    Ordenar productos por relevancia de la búsqueda con validación robusta
+    Ordenar productos (ya formateados) por BM25, con las estadísticas de
+    los propios productos (la búsqueda en vivo no tiene índice del catálogo)
     """
-
-    def calculate_relevance_score(product):
-        # Validar producto
-        if not product or not isinstance(product, dict):
-            return 0
-
-        product_name = (product.get("name") or "").lower()
-        product_brand = (product.get("brand") or "").lower()
-
-        score = 0
-
-        # Coincidencia exacta en el nombre = máxima puntuación
-        if query_normalized == product_name:
-            score += 100
-
-        # Coincidencia al inicio del nombre
-        elif product_name.startswith(query_normalized):
-            score += 80
-
-        # Query completa contenida en el nombre
-        elif query_normalized in product_name:
-            score += 60
-
-        # Puntuación por palabras individuales
-        for word in query_words:
-            if len(word) >= 2:
-                if word in product_name:
-                    score += 10
-                if word in product_brand:
-                    score += 5
-
-        # Bonus por productos más populares
-        try:
-            price = float(product.get("price", "999"))
-            if price < 5:
-                score += 5
-            elif price < 10:
-                score += 2
-        except (ValueError, TypeError):
-            pass
-
-        # Bonus por productos con descuento
-        if product.get("is_discounted", False):
-            score += 3
-
-        return score
+    normalized = [
+        normalize_product(
+            {
+                "display_name": product.get("name"),
+                "brand": product.get("brand"),
+                "packaging": product.get("packaging"),
+            }
+        )
+        for product in products
+    ]
+    bm25 = Bm25.from_products(normalized)
+    expansions = [
+        prefix_expansions(word, bm25.vocabulary)
+        for word in tokenize(query_normalized)
+        if len(word) >= 2
+    ]
+
+    for product, fields in zip(products, normalized):
+        product["relevance"] = round(bm25.score(fields, expansions), 3)
 
     # Ordenar por puntuación descendente
-    return sorted(products, key=calculate_relevance_score, reverse=True)
+    return sorted(products, key=lambda product: product["relevance"], reverse=True)
 
 
 @main.route("/api/add_shopping_item", methods=["POST"])
@@ -2764,12 +2943,13 @@ def add_shopping_item():
 
             # Notificar a todos los usuarios
             try:
-                from app.api import send_push_to_all
+                from app.notifications import queue_push_to_all
 
-                send_push_to_all(
+                queue_push_to_all(
                     title="🛒 Producto desde Mercadona",
                     body=f"{session.get('user')} añadió: {name}",
                     url="/lista_compra",
+                    topic="shopping",
                 )
             except ImportError:
                 pass  # Si no existe la función de push, continuar sin error
@@ -1,147 +1,21 @@
-import json
 import logging
 from datetime import datetime
-from urllib.parse import urlparse
 
 from flask import current_app, request, session  # ✅ Añadir request
-from pywebpush import WebPushException, webpush
+from flask_socketio import join_room
 
 from app import mongo, socketio
+from app.avatars import avatar_cache
 from app.globals import user_sockets
+from app.notifications import queue_push_to_all, queue_push_to_user
+from app.notifications.presence import (CHAT_ROOM, get_user_sids,
+                                        join_room_presence, register_socket,
+                                        unregister_socket)
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
 
-# ============================================================
-#   FUNCIONES PUSH MEJORADAS
-# ============================================================
-def get_vapid_claims(endpoint_url):
-    """
-    Genera el diccionario de claims VAPID para webpush.
-    """
-    try:
-        parsed = urlparse(endpoint_url)
-        return {
-            "aud": f"{parsed.scheme}://{parsed.netloc}",
-            "sub": "mailto:joso.jmf@gmail.com",
-        }
-    except Exception as e:
-        logger.error(f"Error get_vapid_claims: {e}")
-        return None
-
-
-def send_push_to_all(title, body, url="/", icon="/static/icons/house-icon.png"):
-    """Envía notificación push a todos los usuarios con suscripción - MEJORADO."""
-    try:
-        vapid_private_key = current_app.config.get("VAPID_PRIVATE_KEY")
-        if not vapid_private_key:
-            logger.error("VAPID_PRIVATE_KEY no configurada")
-            return
-
-        subscripciones = mongo.db.subscriptions.find({})
-        total_sent = 0
-
-        for sub_doc in subscripciones:
-            user_name = sub_doc.get("user", "Unknown")
-            for sub in sub_doc.get("subscriptions", []):
-                try:
-                    endpoint = sub.get("endpoint")
-                    if not endpoint:
-                        continue
-
-                    claims = get_vapid_claims(endpoint)
-                    if not claims:
-                        continue
-
-                    webpush(
-                        subscription_info=sub,
-                        data=json.dumps(
-                            {
-                                "title": title,
-                                "body": body,
-                                "icon": icon,
-                                "badge": icon,
-                                "url": url,
-                            }
-                        ),
-                        vapid_private_key=vapid_private_key,
-                        vapid_claims=claims,
-                    )
-                    total_sent += 1
-                    logger.info(f"📲 Push enviado a {user_name}")
-
-                except WebPushException as ex:
-                    logger.error(f"❌ Error push a {user_name}: {repr(ex)}")
-                    # Limpiar suscripciones inválidas
-                    if ex.response and ex.response.status_code in [410, 404]:
-                        logger.info("🧹 Eliminando subscripción expirada...")
-                        mongo.db.subscriptions.update_one(
-                            {"user": user_name}, {"$pull": {"subscriptions": sub}}
-                        )
-                except Exception as e:
-                    logger.error(f"❌ Error inesperado enviando push: {e}")
-
-        logger.info(f"📊 Total notificaciones enviadas: {total_sent}")
-
-    except Exception as e:
-        logger.error(f"❌ Error en send_push_to_all: {e}")
-
-
-def send_push_to_user(
-    user_name, title, body, url="/", icon="/static/icons/house-icon.png"
-):
-    """Enviar notificación push a un usuario específico - MEJORADO"""
-    try:
-        vapid_private_key = current_app.config.get("VAPID_PRIVATE_KEY")
-        if not vapid_private_key:
-            logger.error("VAPID_PRIVATE_KEY no configurada")
-            return False
-
-        subscription_doc = mongo.db.subscriptions.find_one({"user": user_name})
-        if not subscription_doc:
-            logger.warning(f"No hay suscripciones para {user_name}")
-            return False
-
-        success_count = 0
-        for sub in subscription_doc.get("subscriptions", []):
-            try:
-                endpoint = sub.get("endpoint")
-                if not endpoint:
-                    continue
-
-                claims = get_vapid_claims(endpoint)
-                if not claims:
-                    continue
-
-                webpush(
-                    subscription_info=sub,
-                    data=json.dumps(
-                        {"title": title, "body": body, "icon": icon, "url": url}
-                    ),
-                    vapid_private_key=vapid_private_key,
-                    vapid_claims=claims,
-                )
-                success_count += 1
-                logger.info(f"✅ Notificación enviada a {user_name}")
-
-            except WebPushException as ex:
-                logger.error(f"❌ Error al enviar push a {user_name}: {repr(ex)}")
-                # Limpiar suscripciones inválidas
-                if ex.response and ex.response.status_code in [410, 404]:
-                    mongo.db.subscriptions.update_one(
-                        {"user": user_name}, {"$pull": {"subscriptions": sub}}
-                    )
-            except Exception as e:
-                logger.error(f"❌ Error inesperado enviando push: {e}")
-
-        return success_count > 0
-
-    except Exception as e:
-        logger.error(f"❌ Error en send_push_to_user: {e}")
-        return False
-
-
 # ============================================================
 #   NOTIFICACIONES DE TAREAS MEJORADAS
 # ============================================================
@@ -153,25 +27,30 @@ def notificar_tarea_a_usuario(tarea):
             logger.warning("⚠️ Tarea sin asignado")
             return
 
-        # Intentar notificación por socket primero
-        sid = user_sockets.get(username.lower())
-
-        if sid:
+        # Si el usuario está conectado basta con el socket
+        sids = get_user_sids(username)
+        delivered = False
+        for sid in sids:
             try:
                 socketio.emit("nueva_tarea", tarea, to=sid)
+                delivered = True
                 logger.info(f"✅ Notificada tarea a {username} por socket ({sid})")
             except Exception as e:
                 logger.error(f"Error enviando socket a {username}: {e}")
 
-        # Enviar notificación push como respaldo
-        success = send_push_to_user(
+        if delivered:
+            return
+
+        # Push solo para usuarios desconectados
+        success = queue_push_to_user(
             user_name=username,
             title="📋 Tarea asignada",
             body=tarea.get("titulo", "Nueva tarea"),
             url="/tareas",
+            skip_online="any",
         )
 
-        if not success and not sid:
+        if not success:
             logger.warning(f"⚠️ No se pudo notificar a {username} por ningún medio")
 
     except Exception as e:
@@ -200,31 +79,13 @@ def register_chat_events():
                 or session.get("user", "Anónimo")
             )
 
-            # Foto que viene del cliente o de la sesión
-            photo = (data.get("photo") or "").strip() or (
-                session.get("photo") or ""
-            ).strip()
-
             message = data.get("message", "").strip()
             if not message:
                 logger.warning("Mensaje vacío recibido")
                 return  # Evitar mensajes vacíos
 
-            # 🔹 Si no tenemos foto, buscarla en Mongo
-            if not photo or photo == "/static/images/default-avatar.png":
-                try:
-                    user_doc = mongo.db.users.find_one({"nombre": user})
-                    if user_doc and user_doc.get("imagen"):
-                        imagen_data = user_doc["imagen"]
-                        if str(imagen_data).startswith("data:image"):
-                            photo = imagen_data
-                        else:
-                            photo = f"data:image/jpeg;base64,{imagen_data}"
-                    else:
-                        photo = "/static/images/default-avatar.png"
-                except Exception as e:
-                    logger.error(f"Error obteniendo foto de usuario {user}: {e}")
-                    photo = "/static/images/default-avatar.png"
+            # Solo se guarda la URL del avatar (cacheada por usuario), no la imagen
+            photo = avatar_cache.get_url(user)
 
             # Guardar mensaje en MongoDB
             try:
@@ -255,13 +116,15 @@ def register_chat_events():
             except Exception as e:
                 logger.error(f"Error emitiendo mensaje por socket: {e}")
 
-            # Notificación push a todos los usuarios
+            # Push solo a quien no tiene el chat abierto (se entrega en segundo plano)
             try:
-                send_push_to_all(
+                queue_push_to_all(
                     title=f"💬 Mensaje nuevo de {user}",
                     body=message[:100]
                     + ("..." if len(message) > 100 else ""),  # Limitar longitud
                     url="/chat",
+                    topic="chat",
+                    skip_online=CHAT_ROOM,
                 )
             except Exception as e:
                 logger.error(f"Error enviando notificación push: {e}")
@@ -276,9 +139,9 @@ def register_chat_events():
             user = session.get("user") or session.get("username", "Anonymous")
             logger.info(f"Usuario {user} conectado por socket")
 
-            # Opcional: almacenar el socket ID del usuario
+            # Registrar el socket del usuario (puede tener varias pestañas)
             if user != "Anonymous":
-                user_sockets[user.lower()] = request.sid
+                register_socket(user, request.sid)
 
         except Exception as e:
             logger.error(f"Error en connect handler: {e}")
@@ -290,13 +153,24 @@ def register_chat_events():
             user = session.get("user") or session.get("username", "Unknown")
             logger.info(f"Usuario {user} desconectado")
 
-            # Limpiar del diccionario de sockets activos
-            if user != "Unknown" and user.lower() in user_sockets:
-                del user_sockets[user.lower()]
+            # Limpiar solo este socket; las demás pestañas siguen conectadas
+            unregister_socket(request.sid)
 
         except Exception as e:
             logger.error(f"Error en disconnect handler: {e}")
 
+    @socketio.on("join")
+    def handle_join(data):
+        """El cliente indica la sala que tiene abierta (p. ej. el chat)"""
+        try:
+            room = (data or {}).get("room")
+            if room != CHAT_ROOM:
+                return
+            join_room(room)
+            join_room_presence(request.sid, room)
+        except Exception as e:
+            logger.error(f"Error en join handler: {e}")
+
     logger.info("Eventos de chat registrados correctamente")
 
 
@@ -0,0 +1,190 @@
+"""
+Benchmark: coincidencia y puntuación de productos por búsqueda, con el
+procesado de cadenas por producto y query (antes) frente a los campos
+normalizados una vez al ingerir (después, app.mercadona.normalize) y frente
+al índice invertido del catálogo local (candidatos por prefijo o aproximados
+por trigramas, ordenados por BM25). Las últimas queries tienen erratas: solo
+el índice las encuentra.
+
+Se usa un catálogo sintético con nombres, marcas y formatos realistas.
+
+Uso: python benchmarks/bench_search_normalization.py [n_productos] [repeticiones]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.mercadona.catalog import CatalogIndex
+from app.mercadona.normalize import (normalize_product, parse_query,
+                                     product_matches, tokenize)
+from app.mercadona.ranking import Bm25, prefix_expansions
+
+NAMES = [
+    "Leche entera",
+    "Leche semidesnatada sin lactosa",
+    "Yogur natural",
+    "Yogur griego azucarado",
+    "Plátano de Canarias",
+    "Manzana golden",
+    "Pan de molde integral",
+    "Aceite de oliva virgen extra",
+    "Tomate triturado",
+    "Atún claro en aceite de girasol",
+    "Café molido natural",
+    "Galletas María",
+    "Queso curado de oveja",
+    "Jamón cocido extra",
+    "Agua mineral natural",
+    "Arroz redondo",
+    "Macarrones",
+    "Detergente líquido",
+    "Papel higiénico doble rollo",
+    "Cerveza especial",
+]
+VARIANTS = ["", "ecológico", "pack 6", "bajo en sal", "0%", "familiar", "mini"]
+BRANDS = ["Hacendado", "Deliplus", "Bosque Verde", "Central Lechera", "Danone"]
+PACKAGING = ["Brick", "Botella", "Paquete", "Lata", "Tarro", "Bolsa", "Pieza"]
+QUERIES = [
+    "leche",
+    "platano",
+    "yogur griego",
+    "aceite oliva",
+    "agua",
+    "pan",
+    "queso",
+    "yogurt",
+    "lehce entera",
+    "aceyte olvia",
+]
+
+
+def make_products(n_products, seed=1):
+    rng = random.Random(seed)
+    return [
+        {
+            "id": str(i),
+            "display_name": f"{rng.choice(NAMES)} {rng.choice(VARIANTS)}".strip(),
+            "brand": rng.choice(BRANDS),
+            "packaging": f"{rng.choice(PACKAGING)} {rng.randint(1, 12)} ud",
+            "price": f"{rng.uniform(0.3, 15):.2f}",
+        }
+        for i in range(n_products)
+    ]
+
+
+def legacy_match(product, query_normalized, query_words):
+    """is_product_match original: cadenas recalculadas en cada llamada"""
+    product_name = (product.get("display_name") or "").lower()
+    product_brand = (product.get("brand") or "").lower()
+    product_packaging = (product.get("packaging") or "").lower()
+    full_product_text = f"{product_name} {product_brand} {product_packaging}".strip()
+    if not full_product_text:
+        return False
+    if query_normalized in full_product_text:
+        return True
+    if len(query_words) > 1:
+        words_found = sum(
+            1 for word in query_words if len(word) >= 2 and word in full_product_text
+        )
+        if words_found >= len(query_words) * 0.7:
+            return True
+    for word in query_words:
+        if len(word) >= 3:
+            for prod_word in full_product_text.split():
+                if prod_word.startswith(word) or word in prod_word:
+                    return True
+    return False
+
+
+def legacy_score(product, query_normalized, query_words):
+    """calculate_relevance_score original"""
+    product_name = (product.get("display_name") or "").lower()
+    product_brand = (product.get("brand") or "").lower()
+    score = 0
+    if query_normalized == product_name:
+        score += 100
+    elif product_name.startswith(query_normalized):
+        score += 80
+    elif query_normalized in product_name:
+        score += 60
+    for word in query_words:
+        if len(word) >= 2:
+            if word in product_name:
+                score += 10
+            if word in product_brand:
+                score += 5
+    price = float(product.get("price", "999"))
+    score += 5 if price < 5 else 2 if price < 10 else 0
+    return score
+
+
+def run_legacy(products, query):
+    query_normalized = query.lower().strip()
+    query_words = query_normalized.split()
+    matched = [p for p in products if legacy_match(p, query_normalized, query_words)]
+    return sorted(
+        matched,
+        key=lambda p: legacy_score(p, query_normalized, query_words),
+        reverse=True,
+    )
+
+
+def run_normalized(entries, query):
+    parsed = parse_query(query)
+    matched = [
+        (product, normalized)
+        for product, normalized in entries
+        if product_matches(normalized, parsed)
+    ]
+    bm25 = Bm25.from_products(normalized for _product, normalized in matched)
+    expansions = [prefix_expansions(word, bm25.vocabulary) for word in tokenize(query)]
+    return sorted(
+        matched,
+        key=lambda entry: bm25.score(entry[1], expansions),
+        reverse=True,
+    )
+
+
+def run_index(index, query):
+    """El índice ya devuelve los resultados ordenados por BM25"""
+    return index.search(query)
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+
+if __name__ == "__main__":
+    n_products = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    products = make_products(n_products)
+
+    start = time.perf_counter()
+    entries = [(product, normalize_product(product)) for product in products]
+    ingest_ms = (time.perf_counter() - start) * 1000
+
+    index = CatalogIndex()
+    index.replace({1: [(product, "", "") for product in products]})
+
+    print(f"{n_products} productos, ingesta normalizada en {ingest_ms:.0f} ms\n")
+    print(
+        f"{'Query':<16} {'Antes':>10} {'Después':>10} {'Índice':>10} "
+        f"{'Mejora':>8} {'Resultados':>17}"
+    )
+    for query in QUERIES:
+        before, legacy = timed(lambda: run_legacy(products, query), repeat)
+        after, normalized = timed(lambda: run_normalized(entries, query), repeat)
+        indexed, from_index = timed(lambda: run_index(index, query), repeat)
+        print(
+            f"{query:<16} {before:>7.2f} ms {after:>7.2f} ms {indexed:>7.2f} ms "
+            f"{before / after:>7.1f}x "
+            f"{len(legacy):>5}/{len(normalized):>5}/{len(from_index):>5}"
+        )
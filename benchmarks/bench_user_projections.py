@@ -0,0 +1,98 @@
+"""
+Benchmark: bytes transferidos desde Mongo por página al leer usuarios,
+con find() sin proyección (antes) frente a las proyecciones con nombre
+de app.data (después).
+
+Se usa una familia sintética (avatar base64 + tareas) y se mide el tamaño
+BSON de los documentos que devolvería cada consulta.
+
+Uso: python benchmarks/bench_user_projections.py [n_usuarios] [n_tareas] [kb_avatar]
+"""
+
+import base64
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import bson
+from bson import ObjectId
+
+from app.data import USER_PROJECTIONS
+
+# Página -> (proyección usada, ¿cuenta tareas por agregación?)
+PAGES = {
+    "/login": ("user_summary", False),
+    "/": ("user_summary", True),
+    "/users_cards": ("user_summary", False),
+    "/tareas": ("user_with_tasks", False),
+    "/calendario": ("user_with_tasks", False),
+    "/configuracion": ("user_summary", False),
+    "/menus": ("user_names", False),
+    "/api/users": ("user_with_tasks", False),
+}
+
+
+def make_users(n_users, n_tasks, avatar_kb):
+    imagen = base64.b64encode(os.urandom(avatar_kb * 1024)).decode()
+    users = []
+    for i in range(n_users):
+        users.append(
+            {
+                "_id": ObjectId(),
+                "nombre": f"Usuario{i}",
+                "encasa": i % 2 == 0,
+                "imagen": imagen,
+                "imagen_hash": "0123456789ab",
+                "last_status_change": datetime.now(),
+                "tareas": [
+                    {
+                        "titulo": f"Tarea {t}",
+                        "due_date": "2025-01-01",
+                        "pasos": "Paso 1, paso 2, paso 3",
+                        "prioridad": "normal",
+                        "created_by": "joso",
+                        "created_at": datetime.now(),
+                    }
+                    for t in range(n_tasks)
+                ],
+                "calendario": [],
+                "created_at": datetime.now(),
+            }
+        )
+    return users
+
+
+def project(user, projection):
+    """Aplicar una proyección de inclusión como lo haría Mongo"""
+    return {
+        key: value for key, value in user.items() if key == "_id" or projection.get(key)
+    }
+
+
+def size_of(docs):
+    return sum(len(bson.encode(doc)) for doc in docs)
+
+
+if __name__ == "__main__":
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    n_tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    avatar_kb = int(sys.argv[3]) if len(sys.argv) > 3 else 150
+
+    users = make_users(n_users, n_tasks, avatar_kb)
+    full = size_of(users)
+    count_reply = len(bson.encode({"_id": None, "total": n_users * n_tasks}))
+
+    print(f"{n_users} usuarios, {n_tasks} tareas/usuario, avatar de {avatar_kb} KB\n")
+    print(
+        f"{'Página':<16} {'Proyección':<16} {'Antes':>12} {'Después':>12} {'Ahorro':>8}"
+    )
+    for page, (name, counts_tasks) in PAGES.items():
+        after = size_of(project(u, USER_PROJECTIONS[name]) for u in users)
+        if counts_tasks:
+            after += count_reply
+        print(
+            f"{page:<16} {name:<16} {full:>10} B {after:>10} B "
+            f"{full / max(after, 1):>7.0f}x"
+        )
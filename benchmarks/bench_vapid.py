@@ -0,0 +1,68 @@
+"""
+Micro-benchmark: firma VAPID por envío (camino antiguo de webpush())
+frente a VapidSigner con cabeceras cacheadas por origen.
+
+Uso: python benchmarks/bench_vapid.py [n_envios]
+"""
+
+import os
+import sys
+import time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_vapid import Vapid, b64urlencode
+
+from app.notifications.vapid import VapidSigner
+
+ENDPOINTS = [
+    "https://fcm.googleapis.com/fcm/send/abc",
+    "https://updates.push.services.mozilla.com/wpush/v2/def",
+    "https://web.push.apple.com/ghi",
+]
+
+
+def generate_raw_key():
+    vapid = Vapid()
+    vapid.generate_keys()
+    private_value = vapid.private_key.private_numbers().private_value
+    return b64urlencode(private_value.to_bytes(32, "big"))
+
+
+def per_call_path(private_key, n):
+    """Lo que hacía webpush() en cada suscripción: parsear, cargar clave y firmar"""
+    for i in range(n):
+        parsed = urlparse(ENDPOINTS[i % len(ENDPOINTS)])
+        claims = {
+            "aud": f"{parsed.scheme}://{parsed.netloc}",
+            "sub": "mailto:joso.jmf@gmail.com",
+            "exp": int(time.time()) + 12 * 60 * 60,
+        }
+        Vapid.from_string(private_key=private_key).sign(claims)
+
+
+def cached_path(private_key, n):
+    signer = VapidSigner(private_key)
+    for i in range(n):
+        parsed = urlparse(ENDPOINTS[i % len(ENDPOINTS)])
+        signer.get_headers(f"{parsed.scheme}://{parsed.netloc}")
+
+
+def run(label, func, private_key, n):
+    start = time.perf_counter()
+    func(private_key, n)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<22} {n} envíos: {elapsed * 1000:9.2f} ms ({elapsed / n * 1e6:8.1f} µs/envío)"
+    )
+    return elapsed
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    key = generate_raw_key()
+
+    old = run("Firma por envío", per_call_path, key, n)
+    new = run("VapidSigner cacheado", cached_path, key, n)
+    print(f"Mejora: x{old / max(new, 1e-9):.1f}")
@@ -0,0 +1,144 @@
+"""
+Tests de la caché de avatares del chat
+"""
+
+import base64
+import io
+import os
+import sys
+
+import pytest
+from bson import ObjectId
+from flask import Flask
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import avatars as avatars_module
+from app.avatars import (DEFAULT_AVATAR_URL, AvatarCache, decode_image,
+                         image_version, resize_image)
+
+PNG_BYTES = b"\x89PNG\r\n\x1a\nfake"
+
+
+class FakeUsers:
+    def __init__(self, users):
+        self.users = users
+        self.find_calls = 0
+
+    def find_one(self, query, projection=None):
+        self.find_calls += 1
+        for user in self.users:
+            if all(user.get(key) == value for key, value in query.items()):
+                return user
+        return None
+
+
+@pytest.fixture
+def fake_users(monkeypatch):
+    imagen = "data:image/png;base64," + base64.b64encode(PNG_BYTES).decode()
+    users = FakeUsers(
+        [
+            {
+                "_id": ObjectId(),
+                "nombre": "Ana",
+                "imagen": imagen,
+                "imagen_hash": image_version(imagen),
+            },
+            {"_id": ObjectId(), "nombre": "Papa", "imagen": ""},
+        ]
+    )
+    fake_mongo = type("Mongo", (), {"db": type("DB", (), {"users": users})()})()
+    monkeypatch.setattr(avatars_module, "mongo", fake_mongo)
+    return users
+
+
+class TestAvatarCache:
+    """Test de la caché de avatares."""
+
+    def test_url_cached_per_user(self, fake_users):
+        cache = AvatarCache()
+        url = cache.get_url("Ana")
+        assert url.startswith(f"/avatars/{fake_users.users[0]['_id']}?v=")
+        assert cache.get_url("Ana") == url
+        assert fake_users.find_calls == 1
+
+    def test_user_entries_are_bounded(self, fake_users):
+        """Los nombres del chat los controla el cliente: LRU acotada."""
+        cache = AvatarCache(max_users=2)
+        cache.get_url("Ana")
+        for nombre in ("Nadie 1", "Nadie 2", "Ana", "Nadie 3"):
+            cache.get_url(nombre)
+        assert list(cache.urls) == ["Ana", "Nadie 3"]
+
+        for user_id in (str(ObjectId()) for _ in range(3)):
+            cache.get_version(user_id)
+        assert len(cache.versions) == 2
+
+    def test_default_avatar_without_image(self, fake_users):
+        cache = AvatarCache()
+        assert cache.get_url("Papa") == DEFAULT_AVATAR_URL
+        assert cache.get_url("Nadie") == DEFAULT_AVATAR_URL
+
+    def test_invalidate_changes_version(self, fake_users, tmp_path):
+        cache = AvatarCache()
+        cache.directory = str(tmp_path)
+        ana = fake_users.users[0]
+        old_url = cache.get_url("Ana")
+        assert cache.get_image(str(ana["_id"]))[0] == PNG_BYTES
+        assert len(list(tmp_path.iterdir())) == 1
+
+        ana["imagen"] = base64.b64encode(b"otra imagen").decode()
+        ana["imagen_hash"] = image_version(ana["imagen"])
+        cache.invalidate(ana["_id"])
+        assert list(tmp_path.iterdir()) == []
+
+        assert cache.get_url("Ana") != old_url
+        data, mimetype, _version = cache.get_image(str(ana["_id"]))
+        assert data == b"otra imagen"
+        assert mimetype == "image/jpeg"
+
+    def test_image_served_from_disk(self, fake_users, tmp_path):
+        """Tras reiniciar, la imagen se lee de disco sin decodificar Mongo."""
+        ana_id = str(fake_users.users[0]["_id"])
+        first = AvatarCache()
+        first.directory = str(tmp_path)
+        first.get_image(ana_id)
+
+        second = AvatarCache()
+        second.directory = str(tmp_path)
+        data, mimetype, _version = second.get_image(ana_id)
+        assert data == PNG_BYTES
+        assert mimetype == "image/png"
+        assert second.stats["disk_hits"] == 1
+
+    def test_avatar_served_without_session(self, fake_users, monkeypatch):
+        """La página de login (sin sesión) también muestra los avatares."""
+        import app.routes as routes
+
+        monkeypatch.setattr(routes, "avatar_cache", AvatarCache())
+        app = Flask(__name__)
+        app.secret_key = "test"
+        app.register_blueprint(routes.main)
+
+        url = routes.avatar_url(fake_users.users[0])
+        response = app.test_client().get(url)
+        assert response.status_code == 200
+        assert response.data == PNG_BYTES
+
+    def test_thumbnail_resized(self):
+        Image = pytest.importorskip("PIL.Image")
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (400, 300), "red").save(buffer, format="JPEG")
+        data, mimetype = resize_image(buffer.getvalue(), "image/jpeg", 96)
+
+        assert mimetype == "image/jpeg"
+        assert Image.open(io.BytesIO(data)).size == (96, 96)
+
+    def test_decode_invalid_image(self):
+        assert decode_image("no es base64!") == (None, None)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,49 @@
+"""
+Tests de la capa de acceso a datos de usuarios
+"""
+
+import os
+import sys
+
+import pytest
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.data import USER_PROJECTIONS, find_users
+from app.data import users as users_module
+
+
+class FakeUsers:
+    def __init__(self):
+        self.projections = []
+
+    def find(self, query, projection):
+        self.projections.append(projection)
+        return [{"_id": 1, "nombre": "Ana"}]
+
+
+class TestUserProjections:
+    """Test de las proyecciones con nombre."""
+
+    def test_no_projection_loads_images(self):
+        for name, projection in USER_PROJECTIONS.items():
+            assert "imagen" not in projection, name
+
+    def test_find_users_uses_named_projection(self, monkeypatch):
+        fake_users = FakeUsers()
+        fake_mongo = type("Mongo", (), {"db": type("DB", (), {"users": fake_users})()})
+        monkeypatch.setattr(users_module, "mongo", fake_mongo)
+
+        users = find_users("user_names", stringify_ids=True)
+
+        assert fake_users.projections == [{"nombre": 1}]
+        assert users == [{"_id": "1", "nombre": "Ana"}]
+
+    def test_unknown_projection(self):
+        with pytest.raises(ValueError):
+            find_users("todo")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
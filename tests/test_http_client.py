@@ -0,0 +1,145 @@
+"""
+Tests del cliente HTTP saliente compartido (sin red)
+"""
+
+import os
+import sys
+
+import pytest
+import requests
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app import http_client as http_client_module
+from app.http_client import (CircuitBreaker, CircuitOpenError, HttpClient,
+                             LatencyHistogram)
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    """Respuestas (códigos o excepciones) en orden"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(http_client_module.time, "sleep", lambda seconds: None)
+    return HttpClient(retries=2, failure_threshold=3, reset_seconds=30)
+
+
+class TestCircuitBreaker:
+    """Test del circuit breaker por host."""
+
+    def test_opens_after_threshold_and_half_opens(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=10)
+        breaker.record_failure(now=0)
+        assert breaker.allow(now=0)
+        breaker.record_failure(now=1)
+
+        assert not breaker.allow(now=5)
+        assert breaker.retry_in(now=5) == 6
+        # Pasado el tiempo, una sola petición de prueba
+        assert breaker.allow(now=11)
+        assert not breaker.allow(now=11)
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=10)
+        breaker.record_failure(now=0)
+        assert breaker.allow(now=10)
+        breaker.record_failure(now=10)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow(now=15)
+        assert breaker.stats["opened"] == 2
+
+
+class TestLatencyHistogram:
+    """Test del histograma de latencias."""
+
+    def test_percentiles_from_buckets(self):
+        histogram = LatencyHistogram(buckets=(10, 100, 1000))
+        for elapsed in [5] * 90 + [50] * 9 + [2000]:
+            histogram.observe(elapsed)
+
+        stats = histogram.get_stats()
+        assert stats["p50_ms"] == 10
+        assert stats["p95_ms"] == 100
+        assert stats["max_ms"] == 2000
+        assert stats["buckets"] == {"<=10": 90, "<=100": 9, "<=1000": 0, ">1000": 1}
+
+
+class TestHttpClient:
+    """Test de reintentos, circuit breaker y métricas del cliente."""
+
+    def test_retries_server_errors_then_succeeds(self, client):
+        client.session = FakeSession(503, requests.ConnectionError("reset"), 200)
+        response = client.get("https://api.example.com/items")
+
+        assert response.status_code == 200
+        stats = client.get_stats()["hosts"]["api.example.com"]
+        assert (stats["requests"], stats["retries"], stats["errors"]) == (3, 2, 1)
+        assert stats["statuses"] == {"503": 1, "200": 1}
+        assert stats["latency"]["count"] == 3
+
+    def test_post_is_not_retried_by_default(self, client):
+        client.session = FakeSession(503)
+        assert client.post("https://api.example.com/chat").status_code == 503
+        assert len(client.session.calls) == 1
+
+    def test_open_circuit_fails_fast(self, client):
+        client.session = FakeSession(*[requests.Timeout("lento")] * 3)
+        with pytest.raises(requests.Timeout):
+            client.get("https://slow.example.com/")
+
+        with pytest.raises(CircuitOpenError):
+            client.get("https://slow.example.com/")
+        # Otros hosts no se ven afectados
+        client.session = FakeSession(200)
+        assert client.get("https://api.example.com/").status_code == 200
+
+    def test_session_with_headers_and_host_settings(self, client):
+        client.configure_host("blocked.example.com", failure_statuses={403})
+        client.session = FakeSession(403, 403, 403)
+        session = client.session_with({"User-Agent": "casa"})
+
+        response = session.get("https://blocked.example.com/", headers={"X": "1"})
+        assert response.status_code == 403
+        assert client.session.calls[0][2]["headers"] == {"User-Agent": "casa", "X": "1"}
+        # 403 cuenta como fallo del host pero no se reintenta
+        assert len(client.session.calls) == 1
+        session.get("https://blocked.example.com/")
+        session.get("https://blocked.example.com/")
+        assert client.breaker("blocked.example.com").state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            session.get("https://blocked.example.com/")
+
+    def test_call_tracks_other_clients(self, client):
+        assert client.call("duckduckgo.com", lambda: ["imagen"]) == ["imagen"]
+        with pytest.raises(ValueError):
+            client.call("duckduckgo.com", lambda: int("x"))
+        stats = client.get_stats()["hosts"]["duckduckgo.com"]
+        assert (stats["requests"], stats["errors"]) == (2, 1)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
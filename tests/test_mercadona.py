@@ -0,0 +1,1177 @@
+"""
+Tests de la integración con Mercadona (sin red)
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+from flask import Flask
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.mercadona import (Bm25, CatalogIndex, MemoryBackend, MercadonaCache,
+                           ProductCatalog, RedisBackend, SearchCache,
+                           SingleFlight, SQLiteBackend, SubcategoryFetcher,
+                           SuggestIndex)
+from app.mercadona import catalog as catalog_module
+from app.mercadona import (create_backend, deep_sizeof, downsample,
+                           edit_distance, fold, normalize_product, parse_query,
+                           prefix_expansions, price_point)
+from app.mercadona import prices as prices_module
+from app.mercadona import product_matches
+
+
+@pytest.fixture
+def app_context():
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+class TestSubcategoryFetcher:
+    """Test de la descarga concurrente de subcategorías."""
+
+    def test_fetches_concurrently(self, app_context):
+        fetcher = SubcategoryFetcher({}, max_workers=4, deadline_seconds=5)
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def fetch(session, task):
+            assert session is fetcher.session
+            with lock:
+                active.append(task)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(task)
+            return [{"id": task}]
+
+        report = fetcher.fetch_all(range(8), fetch)
+
+        assert sorted(task for task, _ in report.results) == list(range(8))
+        assert not report.partial
+        assert max(peak) > 1
+        assert max(peak) <= 4
+
+    def test_deadline_returns_partial_results(self, app_context):
+        fetcher = SubcategoryFetcher({}, max_workers=2, deadline_seconds=0.2)
+
+        def fetch(session, task):
+            if task == "lenta":
+                time.sleep(1)
+            return [task]
+
+        report = fetcher.fetch_all(["rapida", "lenta"], fetch)
+
+        assert report.results == [("rapida", ["rapida"])]
+        assert report.timed_out == 1
+        assert report.partial
+        assert report.duration_seconds < 0.9
+
+    def test_errors_are_counted(self, app_context):
+        fetcher = SubcategoryFetcher({}, max_workers=2)
+
+        def fetch(session, task):
+            raise RuntimeError("403")
+
+        report = fetcher.fetch_all([1, 2], fetch)
+        assert report.errors == 2
+        assert report.results == []
+
+
+def make_product(product_id, name, brand="Hacendado", packaging="Brick"):
+    return {
+        "id": product_id,
+        "display_name": name,
+        "brand": brand,
+        "packaging": packaging,
+    }
+
+
+CATALOG = {
+    10: [
+        (make_product("1", "Leche entera"), "Lácteos", "Leche"),
+        (make_product("2", "Leche semidesnatada sin lactosa"), "Lácteos", "Leche"),
+    ],
+    20: [
+        (make_product("3", "Tomate triturado", packaging="Lata"), "Conservas", "Tomate")
+    ],
+    30: [(make_product("4", "Yogur natural", brand="Danone"), "Lácteos", "Yogures")],
+}
+
+
+def ids(results):
+    return sorted(product["id"] for product, _cat, _subcat, _score in results)
+
+
+class TestCatalogIndex:
+    """Test del índice invertido del catálogo local."""
+
+    @pytest.fixture
+    def index(self):
+        index = CatalogIndex()
+        index.replace(CATALOG)
+        return index
+
+    def test_prefix_search(self, index):
+        assert ids(index.search("lec")) == ["1", "2"]
+        results = index.search("Leche Entera")
+        assert [product["id"] for product, *_ in results] == ["1", "2"]
+
+    def test_brand_and_packaging_indexed(self, index):
+        assert ids(index.search("danone")) == ["4"]
+        assert ids(index.search("lata")) == ["3"]
+
+    def test_partial_word_match_fallback(self, index):
+        """Basta el 70% de las palabras o una de 3+ letras (como is_product_match)."""
+        results = index.search("leche semidesnatada lactosa xyz")
+        assert [product["id"] for product, *_ in results] == ["2", "1"]
+        assert ids(index.search("leche tomate")) == ["1", "2", "3"]
+        assert ids(index.search("yo xy")) == []
+        assert index.search("x") == []
+
+    def test_any_word_like_live_search(self, index):
+        """El catálogo encuentra lo mismo que is_product_match."""
+        for query in ("leche tomate", "yogur lata", "entera xyz", "yo xy"):
+            live = [
+                product["id"]
+                for entries in CATALOG.values()
+                for product, _cat, _subcat in entries
+                if product_matches(normalize_product(product), parse_query(query))
+            ]
+            assert ids(index.search(query, fuzzy=False)) == sorted(live)
+
+    def test_keeps_category(self, index):
+        [(product, category, subcategory, _score)] = index.search("tomate")
+        assert (category, subcategory) == ("Conservas", "Tomate")
+
+    def test_replace_only_touches_changed_subcategory(self, index):
+        old_prefixes = index.prefixes
+        tomate = old_prefixes["tomate"]
+        index.replace({10: [(make_product("5", "Leche de avena"), "Lácteos", "Leche")]})
+
+        assert ids(index.search("leche")) == ["5"]
+        assert index.search("entera") == []
+        assert "entera" not in index.tokens
+        assert ids(index.search("tomate")) == ["3"]
+        # Copia en escritura: los conjuntos no afectados se comparten
+        assert index.prefixes["tomate"] is tomate
+        assert old_prefixes["leche"] == {"1", "2"}
+
+    def test_empty_replace_removes_subcategory(self, index):
+        index.replace({30: []})
+        assert index.search("yogur") == []
+        assert 30 not in index.by_subcategory
+        assert "yo" not in index.vocabulary_prefixes
+
+    def test_product_in_several_subcategories(self, index):
+        """Solo sale del índice cuando ya no lo lista ninguna subcategoría."""
+        leche = make_product("1", "Leche entera")
+        index.replace({40: [(leche, "Ofertas", "Destacados")]})
+        assert index.memberships["1"] == {10, 40}
+
+        updated, removed = index.replace(
+            {10: [(make_product("2", "Leche semidesnatada"), "Lácteos", "Leche")]}
+        )
+        assert ("1" in updated, removed) == (True, set())
+        [(product, category, subcategory, _score)] = index.search("entera")
+        assert (category, subcategory) == ("Ofertas", "Destacados")
+
+        assert index.replace({40: []}) == (set(), {"1"})
+        assert index.search("entera") == []
+        assert "1" not in index.memberships
+
+    def test_fuzzy_search_tolerates_typos(self, index):
+        assert ids(index.search("yogurt")) == ["4"]
+        assert index.search("lehce entera")[0][0]["id"] == "1"
+        assert ids(index.search("tomte")) == ["3"]
+        assert index.search("yogurt", fuzzy=False) == []
+
+    def test_results_ranked_by_bm25(self, index):
+        index.replace(
+            {40: [(make_product("6", "Leche"), "Lácteos", "Leche")]},
+        )
+        results = index.search("leche")
+        assert [product["id"] for product, *_ in results][0] == "6"
+        scores = [score for *_, score in results]
+        assert scores == sorted(scores, reverse=True)
+        # La coincidencia exacta puntúa más que la aproximada
+        [(*_, exact)] = index.search("yogur")
+        [(*_, fuzzy)] = index.search("yogurt")
+        assert exact > fuzzy > 0
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = {}
+
+    def _matches(self, doc, query):
+        for key, condition in query.items():
+            value = doc.get(key)
+            if isinstance(condition, dict):
+                if "$in" in condition and value not in condition["$in"]:
+                    return False
+                if "$nin" in condition and value in condition["$nin"]:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            name = type(operation).__name__
+            if name == "ReplaceOne":
+                doc_id = operation._filter["_id"]
+                self.docs[doc_id] = {"_id": doc_id, **operation._doc}
+            elif name == "UpdateOne":
+                doc_id = operation._filter["_id"]
+                doc = self.docs.setdefault(doc_id, {"_id": doc_id})
+                doc.update(operation._doc["$set"])
+            elif name == "DeleteMany":
+                self.delete_many(operation._filter)
+
+    def delete_many(self, query):
+        for key in [k for k, doc in self.docs.items() if self._matches(doc, query)]:
+            del self.docs[key]
+
+    def find(self, query, projection=None):
+        return [doc for doc in self.docs.values() if self._matches(doc, query)]
+
+
+class FakeMercadona:
+    """Árbol de categorías y respuestas de subcategorías modificables"""
+
+    def __init__(self, monkeypatch):
+        self.subcategories = {
+            10: {"products": [make_product("1", "Leche entera")]},
+            11: {"categories": [{"products": [make_product("2", "Pan de molde")]}]},
+        }
+        self.fetched = []
+        monkeypatch.setattr(catalog_module, "fetch_categories", self.categories)
+        monkeypatch.setattr(catalog_module, "fetch_subcategory", self.subcategory)
+
+    def categories(self, session):
+        return {
+            "results": [
+                {
+                    "name": "Despensa",
+                    "categories": [
+                        {"id": subcat_id, "name": f"Sub {subcat_id}"}
+                        for subcat_id in self.subcategories
+                    ],
+                }
+            ]
+        }
+
+    def subcategory(self, session, subcat_id, timeout=None):
+        self.fetched.append(subcat_id)
+        return self.subcategories[subcat_id]
+
+
+class TestProductCatalog:
+    """Test de la sincronización incremental del catálogo local."""
+
+    @pytest.fixture
+    def store(self, monkeypatch):
+        db = type("DB", (), {})()
+        db.mercadona_products = FakeCollection()
+        db.mercadona_categories = FakeCollection()
+        db.mercadona_price_history = FakeCollection()
+        mongo = type("Mongo", (), {"db": db})()
+        monkeypatch.setattr(catalog_module, "mongo", mongo)
+        monkeypatch.setattr(prices_module, "mongo", mongo)
+        return db
+
+    @pytest.fixture
+    def mercadona(self, monkeypatch):
+        return FakeMercadona(monkeypatch)
+
+    def test_sync_stores_and_indexes(self, app_context, store, mercadona):
+        catalog = ProductCatalog()
+        report = catalog.sync()
+
+        assert report["changed"] == 2
+        assert sorted(store.mercadona_products.docs) == ["1", "2"]
+        assert sorted(store.mercadona_categories.docs) == [10, 11]
+        assert catalog.is_ready()
+        [(product, category, subcategory, _score)] = catalog.search("pan")
+        assert product["id"] == "2"
+        assert (category, subcategory) == ("Despensa", "Sub 11")
+
+    def test_refresh_applies_only_changed_subcategories(
+        self, app_context, store, mercadona
+    ):
+        catalog = ProductCatalog(batch_size=10)
+        catalog.sync()
+        version = catalog.version
+
+        report = catalog.refresh_next()
+        assert report["changed"] == 0
+        assert catalog.version == version
+
+        mercadona.subcategories[10] = {
+            "products": [make_product("3", "Leche de avena")]
+        }
+        report = catalog.refresh_next()
+        assert report["checked"] == 2
+        assert report["changed"] == 1
+        assert catalog.version == version + 1
+        assert ids(catalog.search("leche")) == ["3"]
+        assert catalog.suggest("lec") == [{"name": "Leche de avena", "id": "3"}]
+        assert sorted(store.mercadona_products.docs) == ["2", "3"]
+
+    def test_sync_records_only_price_changes(self, app_context, store, mercadona):
+        mercadona.subcategories[10] = {
+            "products": [
+                priced(make_product("1", "Leche entera"), "0.99"),
+                priced(make_product("3", "Leche de avena"), "1.50"),
+            ]
+        }
+        catalog = ProductCatalog()
+        catalog.sync()
+        assert sorted(
+            doc["product_id"] for doc in store.mercadona_price_history.docs.values()
+        ) == ["1", "3"]
+
+        # Cambia la subcategoría pero solo un precio
+        mercadona.subcategories[10] = {
+            "products": [
+                priced(make_product("1", "Leche entera"), "1.09", discounted=True),
+                priced(make_product("3", "Leche de avena sin azúcar"), "1.50"),
+            ]
+        }
+        store.mercadona_price_history.docs.clear()
+        catalog.sync()
+        [row] = store.mercadona_price_history.docs.values()
+        assert (row["product_id"], row["price"], row["is_discounted"]) == (
+            "1",
+            1.09,
+            True,
+        )
+
+    def test_rolling_batches_and_removed_subcategories(
+        self, app_context, store, mercadona
+    ):
+        catalog = ProductCatalog(batch_size=1)
+        catalog.sync()
+
+        mercadona.fetched.clear()
+        catalog.refresh_next()
+        assert mercadona.fetched == [10]
+        assert len(catalog.queue) == 1
+
+        catalog.refresh_next()
+        del mercadona.subcategories[11]
+        catalog.refresh_next()
+        assert catalog.search("pan") == []
+        assert sorted(store.mercadona_products.docs) == ["1"]
+        assert 11 not in store.mercadona_categories.docs
+
+    def test_product_kept_while_another_subcategory_lists_it(
+        self, app_context, store, mercadona
+    ):
+        leche = make_product("1", "Leche entera")
+        mercadona.subcategories[11]["categories"][0]["products"].append(leche)
+        catalog = ProductCatalog()
+        catalog.sync()
+        assert store.mercadona_products.docs["1"]["subcategory_ids"] == [10, 11]
+
+        mercadona.subcategories[10] = {"products": []}
+        catalog.sync()
+        assert ids(catalog.search("entera")) == ["1"]
+        doc = store.mercadona_products.docs["1"]
+        assert (doc["subcategory_id"], doc["subcategory_ids"]) == (11, [11])
+
+        # Tras reiniciar se recupera de Mongo con sus subcategorías
+        reloaded = ProductCatalog()
+        reloaded.load()
+        assert reloaded.index.memberships["1"] == {11}
+
+        mercadona.subcategories[11] = {"products": []}
+        catalog.sync()
+        assert catalog.search("entera") == []
+        assert store.mercadona_products.docs == {}
+
+    def test_load_from_store(self, app_context, store, mercadona):
+        ProductCatalog().sync()
+
+        catalog = ProductCatalog()
+        assert not catalog.is_ready()
+        assert catalog.load() == 2
+        assert len(catalog.search("entera")) == 1
+
+        mercadona.fetched.clear()
+        assert catalog.refresh_next()["changed"] == 0
+
+
+class TestMercadonaCache:
+    """Test de la caché acotada de respuestas de Mercadona."""
+
+    def test_ttl_and_stale(self):
+        cache = MercadonaCache(ttl_seconds=10)
+        cache.set("subcategory", 1, [{"id": "1"}], now=0)
+
+        assert cache.get("subcategory", 1, now=5) == [{"id": "1"}]
+        assert cache.get("subcategory", 1, now=11) is None
+        assert cache.get("subcategory", 1, allow_stale=True, now=11) == [{"id": "1"}]
+        assert cache.stats["stale_hits"] == 1
+
+    def test_ttl_per_kind(self):
+        cache = MercadonaCache(ttl_seconds=10, kind_ttl_seconds={"product": 100})
+        cache.set("product", "7", {"etag": "x"}, now=0)
+        cache.set("subcategory", 1, [], now=0)
+
+        assert cache.get("product", "7", now=50) == {"etag": "x"}
+        assert cache.get("subcategory", 1, now=50) is None
+
+    def test_byte_budget_evicts_lru(self):
+        product = [{"id": "x", "display_name": "Producto " * 20}]
+        size = deep_sizeof(product)
+        cache = MercadonaCache(max_bytes=size * 2 + size // 2)
+
+        cache.set("subcategory", 1, product)
+        cache.set("subcategory", 2, [dict(product[0])])
+        cache.get("subcategory", 1)
+        cache.set("subcategory", 3, [dict(product[0])])
+
+        assert cache.get("subcategory", 2) is None
+        assert cache.get("subcategory", 1) is not None
+        assert cache.total_bytes <= cache.max_bytes
+        assert cache.stats["evictions"] == 1
+
+    def test_stats_report_bytes_per_kind(self):
+        cache = MercadonaCache()
+        cache.set("categories", None, {"results": [{"id": 1}]})
+        cache.set("subcategory", 1, [{"id": "1"}])
+
+        stats = cache.get_stats()
+        assert stats["entries"] == 2
+        assert stats["bytes"] == cache.total_bytes > 0
+        assert stats["kinds"]["subcategory"]["entries"] == 1
+        assert stats["kinds"]["category"]["bytes"] == 0
+
+    def test_oversized_value_rejected(self):
+        cache = MercadonaCache(max_bytes=100)
+        assert not cache.set("subcategory", 1, ["x" * 1000])
+        assert len(cache) == 0
+
+    def test_unknown_kind(self):
+        with pytest.raises(ValueError):
+            MercadonaCache().get("data")
+
+    def test_backend_io_outside_lock(self, tmp_path):
+        """Una lectura lenta del backend no bloquea los aciertos en memoria."""
+        backend = SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+        reading = threading.Event()
+        release = threading.Event()
+        shared_get = backend.get
+
+        def slow_get(namespace, key, now=None):
+            reading.set()
+            release.wait(5)
+            return shared_get(namespace, key, now=now)
+
+        cache = MercadonaCache(ttl_seconds=60, backend=backend)
+        cache.set("subcategory", 1, [{"id": "1"}])
+        backend.set(cache.NAMESPACE, "subcategory:2", [{"id": "2"}], 60)
+        backend.get = slow_get
+
+        result = {}
+        reader = threading.Thread(
+            target=lambda: result.update(value=cache.get("subcategory", 2))
+        )
+        reader.start()
+        assert reading.wait(5)
+        try:
+            start = time.monotonic()
+            assert cache.get("subcategory", 1) == [{"id": "1"}]
+            assert cache.set("subcategory", 3, [])
+            assert time.monotonic() - start < 1
+        finally:
+            release.set()
+            reader.join(5)
+
+        assert result["value"] == [{"id": "2"}]
+        assert cache.stats["shared_hits"] == 1
+
+
+class FakeRedis:
+    """Cliente mínimo con la interfaz de redis.Redis (get/set/delete/scan_iter)"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        entry = self.data.get(key)
+        return entry.encode("utf-8") if entry is not None else None
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        prefix = match.rstrip("*")
+        return [key for key in list(self.data) if key.startswith(prefix)]
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend()
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+    return RedisBackend(FakeRedis())
+
+
+class TestCacheBackends:
+    """Test de los backends de caché intercambiables."""
+
+    def test_roundtrip_and_namespaces(self, backend):
+        before = time.time()
+        backend.set("search", "k", {"products": [{"id": "1"}]}, 60)
+        backend.set("mercadona", "k", [1, 2], 60)
+
+        value, stored_at = backend.get("search", "k")
+        assert value == {"products": [{"id": "1"}]}
+        assert before <= stored_at <= time.time()
+        assert backend.count("search") == 1
+
+        backend.clear("search")
+        assert backend.get("search", "k") is None
+        assert backend.get("mercadona", "k")[0] == [1, 2]
+
+    def test_expired_entries_ignored(self, backend):
+        if backend.name == "redis":
+            pytest.skip("en Redis la caducidad la aplica el servidor")
+        backend.set("search", "k", "valor", 60, now=100)
+        assert backend.get("search", "k", now=150) == ("valor", 100)
+        assert backend.get("search", "k", now=161) is None
+
+    def test_search_cache_shared_between_workers(self, backend):
+        """Dos workers con el mismo backend comparten resultados."""
+        worker_a = SearchCache(backend=backend)
+        worker_b = SearchCache(backend=backend)
+
+        worker_a.set("Leche", {"products": [{"id": "1"}]}, {"discount_only": True})
+        assert worker_b.get("leche ", {"discount_only": True}) == {
+            "products": [{"id": "1"}]
+        }
+        assert worker_b.get("leche") is None
+        assert worker_b.get_stats()["backend"] == backend.name
+
+    def test_search_key_is_public_and_normalized(self):
+        cache = SearchCache()
+        filters = {"discount_only": True}
+        assert cache.key("Leche ", filters) == cache.key("leche", filters)
+        assert cache.key("leche") != cache.key("leche", filters)
+
+    def test_mercadona_cache_reads_shared_entries(self, backend):
+        if backend.name == "memory":
+            pytest.skip("el backend en memoria no se comparte")
+        writer = MercadonaCache(ttl_seconds=60, backend=backend)
+        reader = MercadonaCache(ttl_seconds=60, backend=backend)
+
+        writer.set("subcategory", 7, [{"id": "1"}])
+        assert reader.get("subcategory", 7) == [{"id": "1"}]
+        assert reader.stats["shared_hits"] == 1
+        assert len(reader) == 1
+
+    def test_redis_round_trips_outside_lock(self):
+        """Mientras Redis responde, la caché en memoria sigue atendiendo."""
+        client = FakeRedis()
+        reading = threading.Event()
+        release = threading.Event()
+        redis_get = client.get
+
+        def slow_get(key):
+            reading.set()
+            release.wait(5)
+            return redis_get(key)
+
+        writer = MercadonaCache(ttl_seconds=60, backend=RedisBackend(client))
+        writer.set("subcategory", 2, [{"id": "2"}])
+        cache = MercadonaCache(ttl_seconds=60, backend=RedisBackend(client))
+        cache.set("subcategory", 1, [{"id": "1"}])
+        client.get = slow_get
+
+        result = {}
+        reader = threading.Thread(
+            target=lambda: result.update(value=cache.get("subcategory", 2))
+        )
+        reader.start()
+        assert reading.wait(5)
+        try:
+            start = time.monotonic()
+            assert cache.get("subcategory", 1) == [{"id": "1"}]
+            cache.delete("subcategory", 1)
+            assert time.monotonic() - start < 1
+        finally:
+            release.set()
+            reader.join(5)
+        assert result["value"] == [{"id": "2"}]
+
+    def test_redis_errors_do_not_break_the_cache(self):
+        client = FakeRedis()
+        cache = MercadonaCache(ttl_seconds=60, backend=RedisBackend(client))
+        cache.set("subcategory", 1, [{"id": "1"}])
+
+        def down(*_args, **_kwargs):
+            raise ConnectionError("Redis caído")
+
+        client.get = client.set = client.delete = client.scan_iter = down
+        assert cache.get("subcategory", 1) == [{"id": "1"}]
+        assert cache.get("subcategory", 2) is None
+        assert cache.set("subcategory", 3, [])
+        cache.delete("subcategory", 1)
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.stats["backend_errors"] == 4
+
+    def test_sqlite_survives_restart(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite3")
+        SearchCache(backend=SQLiteBackend(path)).set("pan", {"products": []})
+        assert SearchCache(backend=SQLiteBackend(path)).get("pan") == {"products": []}
+
+    def test_create_backend(self, tmp_path):
+        assert create_backend("memory://").name == "memory"
+        sqlite = create_backend(f"sqlite:///{tmp_path / 'c.sqlite3'}")
+        assert sqlite.path == str(tmp_path / "c.sqlite3")
+        with pytest.raises(ValueError):
+            create_backend("ftp://cache")
+
+
+class TestSingleFlight:
+    """Test de la deduplicación de búsquedas concurrentes."""
+
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        executions = []
+        results = []
+
+        def crawl():
+            executions.append(1)
+            started.set()
+            release.wait(2)
+            return {"products": ["leche"]}
+
+        def search():
+            results.append(flight.do("leche", crawl))
+
+        leader = threading.Thread(target=search)
+        leader.start()
+        started.wait(2)
+        followers = [threading.Thread(target=search) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        while flight.get_stats()["coalesced"] < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(2)
+
+        assert len(executions) == 1
+        assert sorted(shared for _result, shared in results) == [
+            False,
+            True,
+            True,
+            True,
+        ]
+        assert all(result is results[0][0] for result, _shared in results)
+        assert flight.get_stats()["in_flight"] == 0
+
+    def test_error_propagates_and_key_is_released(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise RuntimeError("Mercadona caído")
+
+        with pytest.raises(RuntimeError):
+            flight.do("pan", fail)
+        assert flight.do("pan", lambda: "ok") == ("ok", False)
+        assert flight.stats["errors"] == 1
+
+
+class TestNormalizedSearch:
+    """Test de los campos de búsqueda precalculados."""
+
+    def matches(self, product, query):
+        return product_matches(normalize_product(product), parse_query(query))
+
+    def test_fold_removes_accents(self):
+        assert fold("Plátano de CANARIAS") == "platano de canarias"
+
+    def test_accent_insensitive_match(self):
+        assert self.matches(make_product("1", "Plátano de Canarias"), "platano")
+        assert self.matches(make_product("1", "Platano"), "plátano")
+
+    def test_prefix_infix_and_partial_words(self):
+        leche = make_product("1", "Leche semidesnatada")
+        assert self.matches(leche, "semi")
+        assert self.matches(leche, "desnatada")
+        assert self.matches(leche, "leche semidesnatada sin lactosa entera")
+        assert not self.matches(leche, "yogur")
+
+    def test_infix_must_be_inside_one_word(self):
+        """Los trigramas de 'tomate' están repartidos en varias palabras."""
+        tomillo = make_product("1", "Tomillo aroma mate")
+        assert not self.matches(tomillo, "queso tomate")
+        assert self.matches(tomillo, "queso aroma")
+
+    def test_normalized_once_per_product(self):
+        product = make_product("1", "Aceite de oliva")
+        assert normalize_product(product) is normalize_product(dict(product))
+
+    def test_edit_distance(self):
+        assert edit_distance("leche", "leche", 1) == 0
+        assert edit_distance("lehce", "leche", 1) == 1
+        assert edit_distance("yogurt", "yogur", 1) == 1
+        assert edit_distance("platano", "tomate", 2) == 3
+
+    def test_bm25_prefers_name_and_rare_words(self):
+        products = [
+            normalize_product(make_product("1", "Leche")),
+            normalize_product(make_product("2", "Leche entera")),
+            normalize_product(make_product("3", "Galletas", brand="Leche")),
+            normalize_product(make_product("4", "Aceite de oliva")),
+        ]
+        bm25 = Bm25.from_products(products)
+
+        def score(product, query):
+            words = query.split()
+            return bm25.score(
+                product, [prefix_expansions(w, bm25.vocabulary) for w in words]
+            )
+
+        assert score(products[0], "leche") > score(products[1], "leche")
+        assert score(products[1], "leche") > score(products[2], "leche")
+        assert score(products[3], "leche") == 0
+        # Prefijo: puntúa, pero menos que la palabra completa
+        assert 0 < score(products[0], "lec") < score(products[0], "leche")
+
+
+class TestSuggestIndex:
+    """Test del índice de autocompletado."""
+
+    @pytest.fixture
+    def suggestions(self):
+        return SuggestIndex(
+            [
+                ("Leche entera", "1"),
+                ("Leche semidesnatada", "2"),
+                ("Café con leche", "3"),
+                ("Plátano de Canarias", "4"),
+                ("Leche entera", "5"),
+            ]
+        )
+
+    def names(self, suggestions, prefix, limit=10):
+        return [s["name"] for s in suggestions.suggest(prefix, limit)]
+
+    def test_prefix_of_any_word(self, suggestions):
+        # Primero los nombres que empiezan por el prefijo
+        assert self.names(suggestions, "lech") == [
+            "Leche entera",
+            "Leche semidesnatada",
+            "Café con leche",
+        ]
+        assert self.names(suggestions, "leche ent") == ["Leche entera"]
+        assert self.names(suggestions, "PLATA") == ["Plátano de Canarias"]
+
+    def test_short_prefix_and_limit(self, suggestions):
+        assert self.names(suggestions, "l", limit=2) == [
+            "Leche entera",
+            "Leche semidesnatada",
+        ]
+        assert self.names(suggestions, "x") == []
+        assert suggestions.suggest("  ") == []
+
+    def test_built_from_catalog(self):
+        index = CatalogIndex()
+        index.replace(CATALOG)
+        suggestions = SuggestIndex.from_catalog(index)
+        assert suggestions.suggest("tom") == [{"name": "Tomate triturado", "id": "3"}]
+
+
+def priced(product, price, discounted=False):
+    product["price_instructions"] = {
+        "unit_price": str(price),
+        "price_decreased": discounted,
+    }
+    return product
+
+
+class TestPriceHistory:
+    """Test del histórico de precios y su reducción en el servidor."""
+
+    def rows(self, *changes):
+        start = date(2025, 1, 1)
+        return [
+            {"day": start + timedelta(days=offset), "price": price, "is_discounted": d}
+            for offset, price, d in changes
+        ]
+
+    def test_price_point(self):
+        assert price_point(priced(make_product("1", "Pan"), "1.25")) == (
+            1.25,
+            None,
+            False,
+        )
+        assert price_point(make_product("1", "Pan")) is None
+
+    def test_downsample_carries_price_forward(self):
+        rows = self.rows((0, 1.0, False), (5, 2.0, True))
+        points = downsample(rows, date(2025, 1, 1), date(2025, 1, 10), 2)
+
+        assert points == [
+            {
+                "date": "2025-01-01",
+                "min": 1.0,
+                "max": 1.0,
+                "avg": 1.0,
+                "last": 1.0,
+                "discounted": False,
+            },
+            {
+                "date": "2025-01-06",
+                "min": 2.0,
+                "max": 2.0,
+                "avg": 2.0,
+                "last": 2.0,
+                "discounted": True,
+            },
+        ]
+
+    def test_downsample_limits_points_and_skips_unknown_days(self):
+        rows = self.rows((100, 3.0, False))
+        points = downsample(rows, date(2025, 1, 1), date(2025, 12, 31), 30)
+        assert len(points) <= 30
+        assert "2025-03-29" < points[0]["date"] <= "2025-04-11"
+        # Un tramo con días anteriores al primer precio solo promedia los conocidos
+        assert {point["avg"] for point in points} == {3.0}
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class TestProductDetailCache:
+    """Test de la caché del detalle de producto."""
+
+    @pytest.fixture
+    def routes(self, monkeypatch):
+        import app.routes as routes
+
+        self.calls = []
+        self.status = 200
+
+        def get(url, timeout=None):
+            self.calls.append(url)
+            if self.status is None:
+                raise routes.requests.ConnectionError("sin red")
+            return FakeResponse(self.status, make_product("7", "Pan de molde"))
+
+        monkeypatch.setattr(routes, "mercadona_cache", MercadonaCache())
+        monkeypatch.setattr(routes.subcategory_fetcher.session, "get", get)
+        return routes
+
+    def test_repeat_opens_hit_cache(self, routes):
+        entry = routes.get_product_detail_cached("7")
+        assert entry["product"]["name"] == "Pan de molde"
+        assert routes.get_product_detail_cached("7") == entry
+        assert len(self.calls) == 1
+
+    def test_etag_follows_content(self, routes):
+        etag = routes.get_product_detail_cached("7")["etag"]
+        same = routes.product_detail_entry(make_product("7", "Pan de molde"))
+        other = routes.product_detail_entry(make_product("7", "Otro"))
+        assert same["etag"] == etag
+        assert other["etag"] != etag
+
+    def test_not_found_and_catalog_fallback(self, routes, monkeypatch):
+        self.status = 404
+        assert routes.get_product_detail_cached("8") is None
+
+        self.status = None
+        monkeypatch.setattr(
+            routes.product_catalog, "get_product", lambda _id: make_product("9", "Sal")
+        )
+        entry = routes.get_product_detail_cached("9")
+        assert entry["partial"] is True
+        assert entry["product"]["name"] == "Sal"
+
+    def test_blocked_is_not_not_found(self, routes, monkeypatch):
+        """Un 403 (bloqueo) sirve la copia caducada o la del catálogo."""
+        routes.get_product_detail_cached("7")
+        entry = routes.mercadona_cache.get("product", "7")
+        monkeypatch.setattr(
+            routes.mercadona_cache,
+            "get",
+            lambda kind, key, allow_stale=False: (
+                entry if allow_stale and key == "7" else None
+            ),
+        )
+        self.status = 403
+        assert routes.get_product_detail_cached("7")["stale"] is True
+
+        monkeypatch.setattr(
+            routes.product_catalog, "get_product", lambda _id: make_product("9", "Sal")
+        )
+        assert routes.get_product_detail_cached("9")["partial"] is True
+
+        monkeypatch.setattr(routes.product_catalog, "get_product", lambda _id: None)
+        with pytest.raises(RuntimeError):
+            routes.get_product_detail_cached("10")
+
+    def test_invalid_body_falls_back(self, routes, monkeypatch):
+        """Un 200 que no es JSON sirve la copia caducada o la del catálogo."""
+        routes.get_product_detail_cached("7")
+        entry = routes.mercadona_cache.get("product", "7")
+        monkeypatch.setattr(
+            routes.mercadona_cache,
+            "get",
+            lambda kind, key, allow_stale=False: (
+                entry if allow_stale and key == "7" else None
+            ),
+        )
+
+        class HtmlResponse(FakeResponse):
+            def json(self):
+                raise ValueError("Expecting value: line 1 column 1 (char 0)")
+
+        monkeypatch.setattr(
+            routes.subcategory_fetcher.session,
+            "get",
+            lambda url, timeout=None: HtmlResponse(200),
+        )
+        assert routes.get_product_detail_cached("7")["stale"] is True
+
+        monkeypatch.setattr(
+            routes.product_catalog, "get_product", lambda _id: make_product("9", "Sal")
+        )
+        assert routes.get_product_detail_cached("9")["partial"] is True
+
+        monkeypatch.setattr(
+            routes.subcategory_fetcher.session,
+            "get",
+            lambda url, timeout=None: FakeResponse(200, ["no", "es", "un", "producto"]),
+        )
+        assert routes.get_product_detail_cached("9")["partial"] is True
+
+    def test_batch_fetches_only_misses(self, routes, monkeypatch):
+        catalog = {"1": priced(make_product("1", "Leche entera"), "0.99")}
+        monkeypatch.setattr(routes.product_catalog, "get_product", catalog.get)
+        routes.mercadona_cache.set(
+            "product", "2", routes.product_detail_entry(make_product("2", "Pan"))
+        )
+
+        app = Flask(__name__)
+        app.secret_key = "test"
+        app.register_blueprint(routes.main)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["user"] = "test"
+
+        response = client.post(
+            "/api/mercadona/products/batch", json={"ids": ["1", "2", "7", "1"]}
+        )
+        data = response.get_json()
+        assert [(p["id"], p["source"]) for p in data["products"]] == [
+            ("1", "catalog"),
+            ("2", "cache"),
+            ("7", "mercadona"),
+        ]
+        assert data["products"][0]["price"] == "0.99"
+        assert len(self.calls) == 1
+
+        self.status = 404
+        data = client.post(
+            "/api/mercadona/products/batch", json={"ids": ["8"]}
+        ).get_json()
+        assert (data["missing"], data["unavailable"]) == (["8"], [])
+        self.status = 403
+        data = client.post(
+            "/api/mercadona/products/batch", json={"ids": ["10"]}
+        ).get_json()
+        assert (data["missing"], data["unavailable"]) == ([], ["10"])
+
+        too_many = client.post(
+            "/api/mercadona/products/batch", json={"ids": list(range(301))}
+        )
+        assert too_many.status_code == 400
+
+    def test_batch_not_starved_by_catalog_sync(self, routes, monkeypatch):
+        """Con el pool de la sincronización ocupado, el lote sigue respondiendo."""
+        monkeypatch.setattr(routes.product_catalog, "get_product", lambda _id: None)
+        monkeypatch.setattr(routes.subcategory_fetcher, "deadline_seconds", 2)
+        sync_fetcher = catalog_module.catalog_fetcher
+        release = threading.Event()
+        busy = [
+            sync_fetcher.executor.submit(release.wait, 10)
+            for _ in range(sync_fetcher.max_workers * 2)
+        ]
+
+        app = Flask(__name__)
+        app.secret_key = "test"
+        app.register_blueprint(routes.main)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["user"] = "test"
+
+        try:
+            data = client.post(
+                "/api/mercadona/products/batch", json={"ids": ["7"]}
+            ).get_json()
+        finally:
+            release.set()
+            for future in busy:
+                future.result()
+
+        assert [(p["id"], p["source"]) for p in data["products"]] == [
+            ("7", "mercadona")
+        ]
+        assert data["stats"]["timed_out"] == 0
+
+
+class TestMercadonaOutage:
+    """Test del modo sin Mercadona (circuito abierto)."""
+
+    @pytest.fixture
+    def client(self, monkeypatch):
+        import app.routes as routes
+
+        self.catalog = ProductCatalog()
+        self.available = False
+        monkeypatch.setattr(routes, "product_catalog", self.catalog)
+        monkeypatch.setattr(routes, "search_cache", SearchCache())
+        monkeypatch.setattr(routes, "mercadona_available", lambda: self.available)
+        monkeypatch.setattr(routes, "mercadona_retry_in", lambda: 42)
+        self.live_searches = []
+
+        def run_live_search(query, *args):
+            self.live_searches.append(query)
+            return {"success": True, "products": [], "partial": False, "source": "live"}
+
+        monkeypatch.setattr(routes, "run_live_search", run_live_search)
+
+        app = Flask(__name__)
+        app.secret_key = "test"
+        app.register_blueprint(routes.main)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["user"] = "test"
+        return client
+
+    def test_serves_snapshot_only_while_circuit_is_open(self, client, monkeypatch):
+        snapshot = CatalogIndex()
+        snapshot.replace(CATALOG)
+        monkeypatch.setattr(self.catalog, "_read_store", lambda: (snapshot, {}))
+
+        data = client.get("/mercadona/search?q=leche").get_json()
+        assert (data["source"], data["stale"]) == ("snapshot", True)
+        assert len(data["products"]) == 2
+        assert self.live_searches == []
+        # La copia no pasa por catálogo sincronizado
+        assert not self.catalog.is_ready()
+
+        # Mercadona vuelve: búsqueda en vivo y la copia se descarta
+        self.available = True
+        data = client.get("/mercadona/search?q=leche").get_json()
+        assert data["source"] == "live"
+        assert self.live_searches == ["leche"]
+        assert self.catalog.snapshot is None
+
+    def test_without_snapshot_fails_fast(self, client, monkeypatch):
+        monkeypatch.setattr(self.catalog, "_read_store", lambda: (CatalogIndex(), {}))
+        response = client.get("/mercadona/search?q=leche")
+        assert response.status_code == 503
+        assert response.get_json()["retry_in_seconds"] == 42
+
+
+class TestSearchPagination:
+    """Test de la paginación y el streaming NDJSON de las búsquedas."""
+
+    RESULT = {
+        "success": True,
+        "products": [{"id": str(i)} for i in range(5)],
+        "total_found": 5,
+        "catalog_version": 3,
+    }
+
+    def test_pages_follow_cursor(self):
+        from app.routes import decode_search_cursor, paginate_search_result
+
+        page = paginate_search_result(self.RESULT, 2, 0)
+        assert [p["id"] for p in page["products"]] == ["0", "1"]
+        assert page["total_found"] == 5
+
+        offset = decode_search_cursor(page["page"]["next_cursor"], 3)
+        page = paginate_search_result(self.RESULT, 2, offset)
+        assert [p["id"] for p in page["products"]] == ["2", "3"]
+
+        offset = decode_search_cursor(page["page"]["next_cursor"], 3)
+        page = paginate_search_result(self.RESULT, 2, offset)
+        assert [p["id"] for p in page["products"]] == ["4"]
+        assert page["page"]["next_cursor"] is None
+
+    def test_without_limit_returns_everything(self):
+        from app.routes import paginate_search_result
+
+        page = paginate_search_result(self.RESULT, None, 0)
+        assert len(page["products"]) == 5
+        assert page["page"]["next_cursor"] is None
+
+    def test_cursor_rejected_after_catalog_change(self):
+        from app.routes import decode_search_cursor, encode_search_cursor
+
+        cursor = encode_search_cursor(2, 3)
+        with pytest.raises(ValueError):
+            decode_search_cursor(cursor, 4)
+        with pytest.raises(ValueError):
+            decode_search_cursor("no-es-un-cursor", 3)
+
+    def test_ndjson_stream_emits_page_lazily(self):
+        from app.routes import ndjson_search_stream
+
+        produced = []
+
+        def products():
+            for product in self.RESULT["products"]:
+                produced.append(product["id"])
+                yield product
+
+        finished = []
+        lines = ndjson_search_stream(
+            self.RESULT, products(), 2, 1, 3, finish=finished.append
+        )
+        assert json.loads(next(lines))["type"] == "meta"
+        first = json.loads(next(lines))
+        # El primer producto de la página sale antes de terminar la búsqueda
+        assert first == {"type": "product", "product": {"id": "1"}}
+        assert produced == ["0", "1"]
+
+        rest = [json.loads(line) for line in lines]
+        assert [line["type"] for line in rest] == ["product", "end"]
+        assert rest[-1]["total_found"] == 5
+        assert rest[-1]["page"]["returned"] == 2
+        assert len(finished[0]) == 5
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
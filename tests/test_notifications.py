@@ -0,0 +1,448 @@
+"""
+Tests del sistema de notificaciones push
+"""
+
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+# Añadir el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from py_vapid import Vapid, b64urldecode, b64urlencode
+from pywebpush import WebPushException
+
+from app.notifications import (DeviceRateLimiter, PushDispatcher, PushMetrics,
+                               PushReport, SubscriptionCache, VapidSigner)
+from app.notifications import dispatcher as dispatcher_module
+from app.notifications import get_vapid_signer
+from app.notifications import outbox as outbox_module
+from app.notifications import presence
+from app.notifications import pruning as pruning_module
+from app.notifications import service as service_module
+from app.notifications import subscriptions as subscriptions_module
+from app.notifications.vapid import VAPID_SUB
+
+
+@pytest.fixture(scope="module")
+def vapid_key():
+    """Clave VAPID privada en formato raw (igual que en .env)."""
+    vapid = Vapid()
+    vapid.generate_keys()
+    private_value = vapid.private_key.private_numbers().private_value
+    return b64urlencode(private_value.to_bytes(32, "big"))
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def make_sub(endpoint):
+    return {"endpoint": endpoint, "keys": {"p256dh": "x", "auth": "y"}}
+
+
+class TestPushDispatcher:
+    """Test del envío concurrente de notificaciones."""
+
+    def test_dispatch_report(self, monkeypatch, vapid_key):
+        """Los envíos correctos, fallidos y expirados se agregan en el informe."""
+
+        def fake_webpush(subscription_info, **kwargs):
+            assert kwargs["headers"]["Authorization"].startswith("vapid ")
+            endpoint = subscription_info["endpoint"]
+            if endpoint.endswith("gone"):
+                raise WebPushException("gone", response=FakeResponse(410))
+            if endpoint.endswith("error"):
+                raise WebPushException("error", response=FakeResponse(500))
+            return FakeResponse(201)
+
+        monkeypatch.setattr(dispatcher_module, "webpush", fake_webpush)
+
+        dispatcher = PushDispatcher(max_workers=4)
+        targets = [
+            ("ana", make_sub("https://push.example.com/ok")),
+            ("ana", make_sub("https://push.example.com/gone")),
+            ("papa", make_sub("https://push.example.com/error")),
+            ("mama", {}),
+        ]
+        report = dispatcher.dispatch(targets, {"title": "t"}, vapid_key)
+
+        assert report.sent == 1
+        assert report.failed == 2
+        assert report.skipped == 1
+        assert report.expired == [("ana", targets[1][1])]
+
+    def test_session_reused_per_origin(self):
+        """Se reutiliza una sesión HTTP por origen."""
+        dispatcher = PushDispatcher(max_workers=2)
+        first = dispatcher._get_session("https://fcm.googleapis.com")
+        second = dispatcher._get_session("https://fcm.googleapis.com")
+        other = dispatcher._get_session("https://updates.push.services.mozilla.com")
+        assert first is second
+        assert first is not other
+
+
+class TestVapidSigner:
+    """Test del firmador VAPID cacheado."""
+
+    def test_audience_is_endpoint_origin(self, vapid_key):
+        """El 'aud' firmado es el origen del endpoint."""
+        origin = dispatcher_module.get_endpoint_origin(
+            "https://fcm.googleapis.com/fcm/send/abc"
+        )
+        assert origin == "https://fcm.googleapis.com"
+
+        headers = VapidSigner(vapid_key).get_headers(origin)
+        token = headers["Authorization"].split("t=")[1].split(",")[0]
+        claims = json.loads(b64urldecode(token.split(".")[1].encode()))
+        assert claims["aud"] == origin
+        assert claims["sub"] == VAPID_SUB
+
+    def test_headers_cached_per_audience(self, vapid_key):
+        """La cabecera se firma una vez por origen y se reutiliza."""
+        signer = get_vapid_signer(vapid_key)
+        assert get_vapid_signer(vapid_key) is signer
+
+        fcm = signer.get_headers("https://fcm.googleapis.com")
+        assert signer.get_headers("https://fcm.googleapis.com") == fcm
+        mozilla = signer.get_headers("https://updates.push.services.mozilla.com")
+        assert mozilla != fcm
+
+
+class FakeCollection:
+    def __init__(self, docs=None):
+        self.docs = docs or []
+        self.bulk_calls = []
+        self.find_calls = 0
+
+    def find(self, query=None, projection=None):
+        self.find_calls += 1
+        return list(self.docs)
+
+    def bulk_write(self, operations, ordered=True):
+        self.bulk_calls.append(operations)
+
+        class Result:
+            modified_count = len(operations)
+
+        return Result()
+
+
+class FakeMongo:
+    def __init__(self, docs=None):
+        self.db = type("DB", (), {"subscriptions": FakeCollection(docs)})()
+
+
+class TestPruning:
+    """Test de la limpieza de suscripciones caducadas."""
+
+    def test_prune_single_bulk_write(self, monkeypatch):
+        """Todas las suscripciones caducadas se eliminan en un único bulk_write."""
+        fake_mongo = FakeMongo()
+        monkeypatch.setattr(pruning_module, "mongo", fake_mongo)
+
+        expired = [
+            ("ana", make_sub("https://push.example.com/1")),
+            ("ana", make_sub("https://push.example.com/2")),
+            ("papa", make_sub("https://push.example.com/3")),
+        ]
+        modified = pruning_module.prune_subscriptions(expired)
+
+        calls = fake_mongo.db.subscriptions.bulk_calls
+        assert len(calls) == 1
+        assert len(calls[0]) == 2  # una operación por usuario
+        assert modified == 2
+
+    def test_prune_nothing(self, monkeypatch):
+        """Sin suscripciones caducadas no se toca la base de datos."""
+        fake_mongo = FakeMongo()
+        monkeypatch.setattr(pruning_module, "mongo", fake_mongo)
+
+        assert pruning_module.prune_subscriptions([]) == 0
+        assert fake_mongo.db.subscriptions.bulk_calls == []
+
+
+class TestSubscriptionCache:
+    """Test de la caché de suscripciones."""
+
+    def test_loaded_once_until_invalidated(self, monkeypatch):
+        """La colección se lee una vez y se recarga tras invalidar."""
+        fake_mongo = FakeMongo(
+            [
+                {"user": "ana", "subscriptions": [make_sub("https://a/1")]},
+                {"user": "papa", "subscriptions": [make_sub("https://a/2")]},
+            ]
+        )
+        monkeypatch.setattr(subscriptions_module, "mongo", fake_mongo)
+
+        cache = SubscriptionCache(ttl_seconds=300)
+        assert len(cache.all_targets()) == 2
+        assert cache.get_user("ana") == [("ana", make_sub("https://a/1"))]
+        assert cache.get_user("nadie") == []
+        assert fake_mongo.db.subscriptions.find_calls == 1
+
+        cache.invalidate()
+        cache.all_targets()
+        assert fake_mongo.db.subscriptions.find_calls == 2
+
+
+class TestPushMetrics:
+    """Test de las métricas de envío."""
+
+    def test_counters_and_latency(self):
+        metrics = PushMetrics(window_size=10)
+        metrics.record("https://fcm.googleapis.com", "sent", 0.1)
+        metrics.record("https://fcm.googleapis.com", "expired", 0.3)
+        metrics.record_pruned(1)
+
+        stats = metrics.get_stats()
+        assert stats["sent"] == 1
+        assert stats["failed"] == 1
+        assert stats["expired"] == 1
+        assert stats["pruned"] == 1
+        endpoint = stats["endpoints"]["https://fcm.googleapis.com"]
+        assert endpoint["count"] == 2
+        assert endpoint["errors"] == 1
+        assert endpoint["max_ms"] == 300.0
+
+
+class TestCoalescingAndRateLimit:
+    """Test del agrupado de notificaciones y del token bucket por dispositivo."""
+
+    def test_token_bucket_per_device(self):
+        limiter = DeviceRateLimiter(rate_per_minute=60, burst=2)
+        assert limiter.allow("https://a/1", now=0)
+        assert limiter.allow("https://a/1", now=0)
+        assert not limiter.allow("https://a/1", now=0)
+        # Otro dispositivo tiene su propio bucket
+        assert limiter.allow("https://a/2", now=0)
+        # Un token por segundo
+        assert limiter.allow("https://a/1", now=1.0)
+
+    def test_dispatch_counts_throttled(self, monkeypatch, vapid_key):
+        monkeypatch.setattr(
+            dispatcher_module, "webpush", lambda **kwargs: FakeResponse(201)
+        )
+        limiter = DeviceRateLimiter(rate_per_minute=1, burst=1)
+        targets = [("ana", make_sub("https://push.example.com/ok"))]
+
+        dispatcher = PushDispatcher(max_workers=2)
+        first = dispatcher.dispatch(targets, {}, vapid_key, rate_limiter=limiter)
+        second = dispatcher.dispatch(targets, {}, vapid_key, rate_limiter=limiter)
+
+        assert (first.sent, first.throttled) == (1, 0)
+        assert (second.sent, second.throttled) == (0, 1)
+
+    def test_only_coalesced_topics_are_rate_limited(self, monkeypatch):
+        limiters = []
+
+        def fake_dispatch(targets, payload, vapid_private_key, rate_limiter=None):
+            limiters.append(rate_limiter)
+            return PushReport()
+
+        fake_app = type("App", (), {"config": {"VAPID_PRIVATE_KEY": "key"}})()
+        monkeypatch.setattr(service_module, "current_app", fake_app)
+        monkeypatch.setattr(service_module.push_dispatcher, "dispatch", fake_dispatch)
+
+        targets = [("ana", make_sub("https://push.example.com/1"))]
+        service_module._send(targets, {}, topic="chat")
+        service_module._send(targets, {}, topic=None)
+        assert limiters == [service_module.device_rate_limiter, None]
+
+    def test_coalesced_payload_is_summary(self):
+        entry = {
+            "topic": "chat",
+            "count": 5,
+            "payload": {
+                "title": "💬 Mensaje nuevo de ana",
+                "body": "hola",
+                "url": "/chat",
+            },
+        }
+        payload = outbox_module.build_delivery_payload(entry)
+        assert payload["body"] == "5 mensajes nuevos en el chat"
+        assert payload["url"] == "/chat"
+
+        entry["count"] = 1
+        assert outbox_module.build_delivery_payload(entry)["body"] == "hola"
+
+
+def matches(doc, query):
+    """Subconjunto de consultas Mongo usado por el outbox"""
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, option) for option in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = doc.get(key)
+            if "$lte" in condition and not (
+                value is not None and value <= condition["$lte"]
+            ):
+                return False
+        elif doc.get(key) != condition:
+            return False
+    return True
+
+
+class FakeOutbox:
+    """Colección notification_outbox en memoria"""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def _apply(self, doc, update):
+        doc.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = doc.get(key, 0) + amount
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+
+    def find_one_and_update(self, query, update, sort=None, return_document=None):
+        candidates = sorted(
+            (doc for doc in self.docs if matches(doc, query)),
+            key=lambda doc: doc["created_at"],
+        )
+        if not candidates:
+            return None
+        self._apply(candidates[0], update)
+        return dict(candidates[0])
+
+    def update_one(self, query, update):
+        for doc in self.docs:
+            if matches(doc, query):
+                self._apply(doc, update)
+                return
+
+
+class TestOutboxWorker:
+    """Test del lease, los reintentos y el límite de intentos del outbox."""
+
+    @pytest.fixture
+    def outbox(self, monkeypatch):
+        now = datetime.now()
+        self.docs = [
+            {
+                "_id": "n1",
+                "target": "user",
+                "user": "ana",
+                "payload": {"title": "t", "body": "b", "url": "/"},
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+                "next_attempt_at": now,
+            }
+        ]
+        fake_mongo = type("Mongo", (), {})()
+        fake_mongo.db = type("DB", (), {"notification_outbox": FakeOutbox(self.docs)})()
+        monkeypatch.setattr(outbox_module, "mongo", fake_mongo)
+
+        self.reports = []
+        monkeypatch.setattr(
+            service_module, "deliver_push", lambda *args: self.reports.pop(0)
+        )
+        return outbox_module.OutboxWorker(lease_seconds=60, max_attempts=2)
+
+    def report(self, sent=0, failed=0, expired=0):
+        report = PushReport()
+        report.sent = sent
+        report.failed = failed + expired
+        report.expired = [("ana", make_sub("https://a/gone"))] * expired
+        return report
+
+    def test_claim_takes_lease(self, outbox):
+        entry = outbox._claim()
+        assert entry["status"] == "processing"
+        assert entry["attempts"] == 1
+        # Con el lease vigente nadie más la reclama
+        assert outbox._claim() is None
+
+        # Si el proceso muere, al caducar el lease se vuelve a reclamar
+        self.docs[0]["locked_until"] = datetime.now() - timedelta(seconds=1)
+        assert outbox._claim()["attempts"] == 2
+
+    def test_failed_delivery_is_retried(self, outbox):
+        self.reports = [self.report(failed=2)]
+        assert outbox.process_pending() == 1
+
+        entry = self.docs[0]
+        assert entry["status"] == "pending"
+        assert entry["next_attempt_at"] > datetime.now()
+        assert "locked_until" not in entry
+
+        entry["next_attempt_at"] = datetime.now()
+        self.reports = [self.report(sent=1, failed=1)]
+        outbox.process_pending()
+        assert entry["status"] == "sent"
+
+    def test_gives_up_after_max_attempts(self, outbox):
+        self.reports = [self.report(failed=1), self.report(failed=1)]
+        outbox.process_pending()
+        self.docs[0]["next_attempt_at"] = datetime.now()
+        outbox.process_pending()
+
+        assert self.docs[0]["status"] == "failed"
+        assert self.docs[0]["attempts"] == 2
+
+    def test_throttled_delivery_is_requeued(self, outbox):
+        throttled = self.report()
+        throttled.throttled = 1
+        self.reports = [throttled]
+        outbox.process_pending()
+        assert self.docs[0]["status"] == "pending"
+
+    def test_expired_subscriptions_are_not_retried(self, outbox):
+        self.reports = [self.report(expired=1)]
+        outbox.process_pending()
+        assert self.docs[0]["status"] == "sent"
+
+
+class TestPresenceRouting:
+    """Test del enrutado según presencia por socket."""
+
+    def test_presence_per_room(self):
+        presence.register_socket("Ana", "sid-1")
+        presence.register_socket("ana", "sid-2")
+        try:
+            presence.join_room_presence("sid-2", presence.CHAT_ROOM)
+            assert presence.is_online("ana")
+            assert presence.is_online("ANA", presence.CHAT_ROOM)
+
+            # Cerrar la pestaña del chat no desconecta al usuario
+            presence.unregister_socket("sid-2")
+            assert presence.is_online("ana")
+            assert not presence.is_online("ana", presence.CHAT_ROOM)
+        finally:
+            presence.unregister_socket("sid-1")
+            presence.unregister_socket("sid-2")
+        assert not presence.is_online("ana")
+
+    def test_logout_forgets_all_sockets(self):
+        presence.register_socket("ana", "sid-1")
+        presence.register_socket("ana", "sid-2")
+        presence.join_room_presence("sid-2", presence.CHAT_ROOM)
+
+        assert sorted(presence.unregister_user("Ana")) == ["sid-1", "sid-2"]
+        assert not presence.is_online("ana")
+        assert presence.unregister_socket("sid-2") is None
+
+    def test_online_users_skip_push(self):
+        targets = [
+            ("ana", make_sub("https://push.example.com/1")),
+            ("papa", make_sub("https://push.example.com/2")),
+        ]
+        presence.register_socket("ana", "sid-chat")
+        presence.join_room_presence("sid-chat", presence.CHAT_ROOM)
+        try:
+            offline = service_module._filter_online(targets, presence.CHAT_ROOM)
+            assert offline == [targets[1]]
+            assert service_module._filter_online(targets, None) == targets
+        finally:
+            presence.unregister_socket("sid-chat")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])